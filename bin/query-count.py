@@ -0,0 +1,6 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from cli.query_count import QueryCountCli
+QueryCountCli().run()
@@ -0,0 +1,5 @@
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from cli.run_result_writer import RunResultWriterCli
+RunResultWriterCli().run()
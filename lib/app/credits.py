@@ -0,0 +1,351 @@
+'''
+A ledger of user credits in Redis.
+
+Credits for a search are reserved when it is requested, and each result of
+the search either charges or refunds one reserved credit (error results are
+free). Charges are kept in Redis and periodically moved into ``User.credits``
+by ``reconcile_credits()``, so scrape workers never update ``user`` rows.
+
+For each user, the ledger holds:
+
+* ``balance``: the credits that are available for new searches, i.e.
+  ``User.credits`` minus the pending charges and the reserved credits,
+* ``pending``: the charges that are not yet reconciled, and
+* ``r:<tracker ID>``: the credits still reserved for each search.
+
+The balance is computed from ``User.credits`` when it is first needed, and
+whenever ``User.credits`` is set (see ``CreditLedger.set_credits()``).
+'''
+
+import json
+
+from model import User
+
+KEY_PREFIX = 'credits'
+
+# Compute the balance of a user's ledger if it is not known.
+_init_function = '''
+local function init(key, credits)
+    if redis.call('hexists', key, 'balance') == 1 then
+        return
+    end
+
+    local balance = tonumber(credits)
+    local fields = redis.call('hgetall', key)
+
+    for i = 1, #fields, 2 do
+        if fields[i] == 'pending' or string.sub(fields[i], 1, 2) == 'r:' then
+            balance = balance - tonumber(fields[i + 1])
+        end
+    end
+
+    redis.call('hset', key, 'balance', balance)
+end
+'''
+
+# Reserve credits for one or more searches if the balance allows. Returns
+# a list of 1 (or 0 if the balance is too low) and the balance.
+#
+# KEYS: ledger, dirty users
+# ARGV: user ID, User.credits, then a tracker ID and an amount per search
+_reserve_script = _init_function + '''
+init(KEYS[1], ARGV[2])
+
+local total = 0
+
+for i = 3, #ARGV, 2 do
+    total = total + tonumber(ARGV[i + 1])
+end
+
+local balance = tonumber(redis.call('hget', KEYS[1], 'balance'))
+
+if balance < total then
+    return {0, balance}
+end
+
+for i = 3, #ARGV, 2 do
+    redis.call('hincrby', KEYS[1], 'r:' .. ARGV[i], ARGV[i + 1])
+end
+
+redis.call('sadd', KEYS[2], ARGV[1])
+return {1, redis.call('hincrby', KEYS[1], 'balance', -total)}
+'''
+
+# Use one credit reserved for a search, and charge it or refund it. If there
+# is no reservation (e.g. it was released because the search timed out),
+# then a charge is taken from the balance instead.
+#
+# KEYS: ledger, dirty users
+# ARGV: user ID, tracker ID, 1 to charge or 0 to refund
+_charge_script = '''
+local field = 'r:' .. ARGV[2]
+local reserved = tonumber(redis.call('hget', KEYS[1], field) or '0')
+local known = redis.call('hexists', KEYS[1], 'balance') == 1
+
+if reserved > 1 then
+    redis.call('hincrby', KEYS[1], field, -1)
+elseif reserved == 1 then
+    redis.call('hdel', KEYS[1], field)
+end
+
+if ARGV[3] == '1' then
+    redis.call('hincrby', KEYS[1], 'pending', 1)
+
+    if reserved == 0 and known then
+        redis.call('hincrby', KEYS[1], 'balance', -1)
+    end
+elseif reserved > 0 and known then
+    redis.call('hincrby', KEYS[1], 'balance', 1)
+end
+
+redis.call('sadd', KEYS[2], ARGV[1])
+'''
+
+# Return the credits still reserved for a search to the balance.
+#
+# KEYS: ledger, dirty users
+# ARGV: user ID, tracker ID
+_release_script = '''
+local field = 'r:' .. ARGV[2]
+local reserved = tonumber(redis.call('hget', KEYS[1], field) or '0')
+
+redis.call('hdel', KEYS[1], field)
+
+if reserved > 0 and redis.call('hexists', KEYS[1], 'balance') == 1 then
+    redis.call('hincrby', KEYS[1], 'balance', reserved)
+    redis.call('sadd', KEYS[2], ARGV[1])
+end
+
+return reserved
+'''
+
+# Add credits (e.g. purchased credits) to the balance, if it is known.
+#
+# KEYS: ledger, dirty users
+# ARGV: user ID, amount
+_add_script = '''
+if redis.call('hexists', KEYS[1], 'balance') == 1 then
+    redis.call('hincrby', KEYS[1], 'balance', ARGV[2])
+end
+
+redis.call('sadd', KEYS[2], ARGV[1])
+'''
+
+# Recompute the balance from User.credits, and return it.
+#
+# KEYS: ledger, dirty users
+# ARGV: user ID, User.credits
+_set_credits_script = _init_function + '''
+redis.call('hdel', KEYS[1], 'balance')
+init(KEYS[1], ARGV[2])
+redis.call('sadd', KEYS[2], ARGV[1])
+
+return redis.call('hget', KEYS[1], 'balance')
+'''
+
+# Return the balance, computing it from User.credits if necessary.
+#
+# KEYS: ledger
+# ARGV: User.credits
+_balance_script = _init_function + '''
+init(KEYS[1], ARGV[1])
+
+return redis.call('hget', KEYS[1], 'balance')
+'''
+
+# Take the pending charges, to be reconciled, and return them.
+#
+# KEYS: ledger
+_take_pending_script = '''
+local pending = tonumber(redis.call('hget', KEYS[1], 'pending') or '0')
+
+if pending ~= 0 then
+    redis.call('hincrby', KEYS[1], 'pending', -pending)
+end
+
+return pending
+'''
+
+# Return the members of a set and delete it.
+#
+# KEYS: set
+_pop_all_script = '''
+local members = redis.call('smembers', KEYS[1])
+redis.call('del', KEYS[1])
+
+return members
+'''
+
+
+class CreditLedger:
+    ''' The credit ledgers of all users. '''
+
+    def __init__(self, redis):
+        ''' Constructor. '''
+
+        self.redis = redis
+        self._dirty_key = '{}:dirty'.format(KEY_PREFIX)
+        self._reserve = redis.register_script(_reserve_script)
+        self._charge = redis.register_script(_charge_script)
+        self._release = redis.register_script(_release_script)
+        self._add = redis.register_script(_add_script)
+        self._set_credits = redis.register_script(_set_credits_script)
+        self._balance = redis.register_script(_balance_script)
+        self._take_pending = redis.register_script(_take_pending_script)
+        self._pop_all = redis.register_script(_pop_all_script)
+
+    def add(self, user_id, amount):
+        '''
+        Add `amount` credits to a user's balance, after they are added to
+        ``User.credits``.
+        '''
+
+        self._add(keys=[self._key(user_id), self._dirty_key],
+                  args=[user_id, amount])
+
+    def balance(self, user_id, credits):
+        '''
+        Return a user's balance. `credits` is the user's ``User.credits``,
+        which is used if the balance is not known.
+        '''
+
+        return int(self._balance(keys=[self._key(user_id)], args=[credits]))
+
+    def charge(self, user_id, tracker_id, charged=True):
+        '''
+        Use one of the credits reserved for a search: charge it if
+        `charged`, or else refund it.
+        '''
+
+        self._charge(keys=[self._key(user_id), self._dirty_key],
+                     args=[user_id, tracker_id, 1 if charged else 0])
+
+    def pop_changed(self):
+        '''
+        Return the IDs of the users whose balances changed since the last
+        call, e.g. to notify them.
+        '''
+
+        return [int(user_id) for user_id in
+                self._pop_all(keys=[self._dirty_key])]
+
+    def release(self, user_id, tracker_id):
+        '''
+        Return the credits still reserved for a search to the balance, e.g.
+        because it is complete.
+        '''
+
+        return int(self._release(keys=[self._key(user_id), self._dirty_key],
+                                 args=[user_id, tracker_id]))
+
+    def reservations(self, user_id):
+        ''' Return the tracker IDs of a user's reservations. '''
+
+        return [field.decode('utf8')[2:]
+                for field in self.redis.hkeys(self._key(user_id))
+                if field.startswith(b'r:')]
+
+    def reserve(self, user_id, credits, amounts):
+        '''
+        Reserve credits for searches, where `amounts` is a dict of the
+        number of credits to reserve for each tracker ID. `credits` is the
+        user's ``User.credits``.
+
+        Returns True if the balance allowed it, or else False.
+        '''
+
+        args = [user_id, credits]
+
+        for tracker_id, amount in amounts.items():
+            args.extend((tracker_id, amount))
+
+        reserved = self._reserve(keys=[self._key(user_id), self._dirty_key],
+                                 args=args)[0]
+
+        return reserved == 1
+
+    def return_pending(self, user_id, charges):
+        '''
+        Give back charges taken by ``take_pending()`` that could not be
+        reconciled.
+        '''
+
+        self.redis.hincrby(self._key(user_id), 'pending', charges)
+
+    def set_credits(self, user_id, credits):
+        '''
+        Recompute a user's balance after ``User.credits`` is set to
+        `credits`, and return it.
+        '''
+
+        return int(self._set_credits(
+            keys=[self._key(user_id), self._dirty_key],
+            args=[user_id, credits]
+        ))
+
+    def take_pending(self, user_id):
+        ''' Take a user's pending charges, and return how many there are. '''
+
+        return int(self._take_pending(keys=[self._key(user_id)]))
+
+    def user_ids(self):
+        ''' Generate the IDs of the users that have ledgers. '''
+
+        prefix = '{}:user:'.format(KEY_PREFIX)
+
+        for key in self.redis.scan_iter(match=prefix + '*'):
+            yield int(key.decode('utf8')[len(prefix):])
+
+    def _key(self, user_id):
+        ''' Return the key of a user's ledger. '''
+
+        return '{}:user:{}'.format(KEY_PREFIX, user_id)
+
+
+def reconcile_credits(db_session, redis):
+    '''
+    Move pending charges into ``User.credits``, release the reservations of
+    searches that ended without finishing, and notify users whose balances
+    changed.
+
+    Each user is charged with a single ``UPDATE``, and is notified at most
+    once per call, however many results were charged since the last call.
+    '''
+
+    ledger = CreditLedger(redis)
+    taken = {}
+
+    try:
+        for user_id in ledger.user_ids():
+            # Trackers expire when their searches time out.
+            for tracker_id in ledger.reservations(user_id):
+                if not redis.exists(tracker_id):
+                    ledger.release(user_id, tracker_id)
+
+            charges = ledger.take_pending(user_id)
+
+            if charges != 0:
+                taken[user_id] = charges
+                db_session.query(User) \
+                          .filter(User.id == user_id) \
+                          .update({User.credits: User.credits - charges},
+                                  synchronize_session=False)
+
+        db_session.commit()
+    except:
+        db_session.rollback()
+
+        for user_id, charges in taken.items():
+            ledger.return_pending(user_id, charges)
+
+        raise
+
+    user_ids = ledger.pop_changed()
+
+    if len(user_ids) == 0:
+        return
+
+    for user in db_session.query(User).filter(User.id.in_(user_ids)):
+        user_dict = user.as_dict()
+        user_dict['credits'] = ledger.balance(user.id, user.credits)
+        redis.publish('user', json.dumps(user_dict))
@@ -1,13 +1,93 @@
+import base64
+import json
+from datetime import datetime
+
+import dateutil.parser
 import redis
 import sqlalchemy
-from sqlalchemy import case, func
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import case, func, tuple_
+from sqlalchemy.orm import sessionmaker, undefer
 from sqlalchemy.types import TypeDecorator, UnicodeText
 
 _engine = None
 _sessionmaker = None
 
 
+def count_rows(query, mode='exact'):
+    '''
+    Count the rows of ``query``.
+
+    ``mode`` is "exact" (``COUNT(*)``, which reads every row), "estimate"
+    (Postgres' planner estimate, which is cheap but may be far off), or
+    "none" (returns None).
+    '''
+
+    if mode == 'none':
+        return None
+
+    if mode == 'exact':
+        return query.count()
+
+    return int(explain(query)['Plan Rows'])
+
+
+def decode_cursor(cursor, columns):
+    '''
+    Decode a cursor made by ``encode_cursor()`` for ``columns``.
+
+    Raises ValueError if the cursor is invalid.
+    '''
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii'))
+                            .decode('utf8'))
+    except Exception:
+        raise ValueError('Invalid cursor.')
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor.')
+
+    decoded = []
+
+    for column, value in zip(columns, values):
+        if column.type.python_type is datetime:
+            try:
+                value = dateutil.parser.parse(value)
+            except (TypeError, ValueError, OverflowError):
+                raise ValueError('Invalid cursor.')
+
+        decoded.append(value)
+
+    return decoded
+
+
+def encode_cursor(values):
+    ''' Encode a list of column values as an opaque cursor. '''
+
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    cursor = json.dumps(values, separators=(',', ':')).encode('utf8')
+
+    return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+
+def explain(query):
+    '''
+    Return Postgres' plan for ``query``: the top node of
+    ``EXPLAIN (FORMAT JSON)``, whose child nodes are in its "Plans" list.
+    '''
+
+    statement = query.statement.compile(dialect=query.session.bind.dialect)
+    plan = query.session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(statement),
+        statement.params
+    ).scalar()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return plan[0]['Plan']
+
+
 def get_engine(config, super_user=False):
     '''
     Get a SQLAlchemy engine from a configuration object.
@@ -60,6 +140,56 @@ def get_session(engine):
     return _sessionmaker(bind=engine)
 
 
+def keyset_page(query, columns, limit, after=None, offset=0,
+                descending=False):
+    '''
+    Get a page of up to ``limit`` rows of ``query``, starting after the row
+    whose ``columns`` have the values ``after`` (a list decoded from a cursor
+    with ``decode_cursor()``), or else after skipping ``offset`` rows.
+
+    This is keyset pagination: the query must be sorted on ``columns`` (in
+    descending order, if ``descending``), and together they must identify a
+    row uniquely. Unlike an OFFSET clause, finding the start of the page does
+    not get slower the further the page is into the result set.
+
+    Returns a tuple of the rows and the cursor for the next page (None if
+    this is the last page).
+    '''
+
+    query = keyset_query(query, columns, limit, after, offset, descending)
+    rows = query.all()
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    cursor = encode_cursor([getattr(rows[-1], column.key)
+                            for column in columns])
+
+    return rows, cursor
+
+
+def keyset_query(query, columns, limit, after=None, offset=0,
+                 descending=False):
+    '''
+    Return the query that ``keyset_page()`` runs to get a page of ``query``.
+
+    It selects one row more than ``limit``, to tell if there is a next page.
+    '''
+
+    query = query.options(*[undefer(column) for column in columns])
+
+    if after is not None:
+        if descending:
+            query = query.filter(tuple_(*columns) < tuple_(*after))
+        else:
+            query = query.filter(tuple_(*columns) > tuple_(*after))
+    elif offset > 0:
+        query = query.offset(offset)
+
+    return query.limit(limit + 1)
+
+
 def make_date_columns(date_column, start_date, end_date, delta, unit):
     '''
     Produce a list of query columns suitable for a time series query.
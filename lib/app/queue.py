@@ -1,7 +1,10 @@
 ''' Message queues. '''
 
+import random
+import time
 from functools import wraps
 from rq import Connection, Queue
+from rq.job import Job
 
 import coalesce as co
 import app.config
@@ -10,8 +13,13 @@ _config = app.config.get_config()
 _redis = app.database.get_redis(dict(_config.items('redis')))
 _redis_worker = dict(_config.items('redis_worker'))
 scrape_queue = Queue('scrape', connection=_redis)
+scrape_retry_queue = Queue('scrape_retry', connection=_redis)
 archive_queue = Queue('archive', connection=_redis)
 
+# Delayed jobs (e.g. retries) are kept in a sorted set per queue, scored by
+# the time when they should be enqueued.
+_delayed_key = 'delayed:{}'
+
 
 def dummy_job():
     '''
@@ -67,17 +75,29 @@ class queueable:
         * "jobflags" is a list of strings assigned to job.meta['flags']
         * "queue" is the default queue that this job will be sent to.
         * "timeout" is the job's timeout.
+        * "retries" is the number of times that the job may be retried (see
+          ``retry_job()``).
+        * "retry_queue" is the queue that retries are sent to (default: the
+          job's queue).
+        * "backoff" is the delay (in seconds) before the first retry. The
+          delay doubles with each subsequent retry.
     Any of these keywords can be passed to the decorator's constructor or to
-    the ``enqueue()`` method.
+    the ``enqueue()`` method. In addition, ``enqueue()`` accepts "delay": the
+    number of seconds to wait before the job is enqueued (see
+    ``enqueue_delayed_jobs()``).
     '''
 
-    def __init__(self, queue=None, timeout=60, jobdesc=None, jobflags=None):
+    def __init__(self, queue=None, timeout=60, jobdesc=None, jobflags=None,
+                 retries=0, retry_queue=None, backoff=5):
         ''' Constructor. '''
 
         self.queue = queue
         self.timeout = timeout
         self.jobdesc = jobdesc
         self.jobflags = co.first(jobflags, lambda: list)
+        self.retries = retries
+        self.retry_queue = retry_queue
+        self.backoff = backoff
 
     def __call__(self, fn):
         ''' Wraps a queue-able function. '''
@@ -88,26 +108,114 @@ class queueable:
             jobflags = co.first(kwargs.pop('jobflags', None), self.jobflags)
             queue = co.first(kwargs.pop('queue', None), self.queue)
             timeout = co.first(kwargs.pop('timeout', None), self.timeout)
+            retries = co.first(kwargs.pop('retries', None), self.retries)
+            retry_queue = co.first(kwargs.pop('retry_queue', None),
+                                   self.retry_queue,
+                                   queue)
+            backoff = co.first(kwargs.pop('backoff', None), self.backoff)
+            delay = kwargs.pop('delay', None)
 
             if queue is None:
                 raise ValueError('This job has no queue defined.')
 
-            job = queue.enqueue_call(
-                fn,
-                args=args,
-                kwargs=kwargs,
-                timeout=timeout
-            )
+            if delay:
+                job = Job.create(fn,
+                                 args=args,
+                                 kwargs=kwargs,
+                                 connection=_redis,
+                                 timeout=timeout,
+                                 origin=queue.name)
+            else:
+                job = queue.enqueue_call(
+                    fn,
+                    args=args,
+                    kwargs=kwargs,
+                    timeout=timeout
+                )
 
             job.meta['description'] = jobdesc
             job.meta['flags'] = list(jobflags)
+            job.meta['attempt'] = 1
+            job.meta['max_attempts'] = retries + 1
+            job.meta['retry_queue'] = retry_queue.name
+            job.meta['backoff'] = backoff
             job.save()
+
+            if delay:
+                _redis.zadd(_delayed_key.format(queue.name),
+                            {job.id: time.time() + delay})
+
             return job
 
         fn.enqueue = enqueue
         return fn
 
 
+def retry_job(job, max_backoff=None):
+    '''
+    Schedule a new attempt at ``job`` on its retry queue, if it has attempts
+    left. Returns the new job, or None if the attempts are exhausted.
+
+    The delay before the new attempt is the job's backoff doubled for each
+    previous attempt, with random jitter of +/-50% (capped at
+    ``max_backoff`` seconds). The new attempt inherits the job's metadata,
+    so it can see what previous attempts did.
+    '''
+
+    attempt = job.meta.get('attempt', 1)
+
+    if attempt >= job.meta.get('max_attempts', 1):
+        return None
+
+    queue = get_queues()[job.meta['retry_queue']]
+    delay = job.meta['backoff'] * 2 ** (attempt - 1)
+
+    if max_backoff is not None:
+        delay = min(delay, max_backoff)
+
+    delay *= random.uniform(0.5, 1.5)
+
+    retry = Job.create(job.func,
+                       args=job.args,
+                       kwargs=job.kwargs,
+                       connection=_redis,
+                       timeout=job.timeout,
+                       origin=queue.name)
+    retry.meta.update(job.meta)
+    retry.meta['attempt'] = attempt + 1
+    retry.meta['retry_of'] = job.id
+    retry.save()
+
+    _redis.zadd(_delayed_key.format(queue.name),
+                {retry.id: time.time() + delay})
+
+    return retry
+
+
+def enqueue_delayed_jobs():
+    '''
+    Enqueue delayed jobs (i.e. retries) that are due. Returns the number of
+    jobs enqueued.
+    '''
+
+    count = 0
+    now = time.time()
+
+    for queue in get_queues().values():
+        key = _delayed_key.format(queue.name)
+
+        for job_id in _redis.zrangebyscore(key, 0, now):
+            # If another process removed the job first, then it enqueues it.
+            if _redis.zrem(key, job_id) == 0:
+                continue
+
+            job = Job.fetch(job_id.decode('ascii'), connection=_redis)
+            queue.enqueue_job(job)
+            count += 1
+
+    return count
+
+
 def remove_unused_queues(redis):
     '''
     Remove queues in RQ that are not defined in this file.
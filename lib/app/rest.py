@@ -1,8 +1,57 @@
 ''' Utility functions for the REST API. '''
 from flask import url_for as flask_url_for
-from sqlalchemy import case, extract, func
+from sqlalchemy import case, extract, func, inspect
+from sqlalchemy.orm import lazyload, load_only, selectinload
 from werkzeug.exceptions import BadRequest
 
+from app.database import decode_cursor
+
+
+def get_cursor_arguments(args, columns):
+    '''
+    Get the ``after`` cursor (decoded for the pagination ``columns``) and the
+    ``count`` mode from a request.args object.
+
+    The cursor is None if there is no ``after`` argument, and the count mode
+    defaults to "exact".
+    '''
+
+    count = args.get('count', 'exact')
+
+    if count not in ('exact', 'estimate', 'none'):
+        raise BadRequest('`count` must be one of: exact, estimate, none.')
+
+    if not args.get('after'):
+        return None, count
+
+    try:
+        after = decode_cursor(args['after'], columns)
+    except ValueError:
+        raise BadRequest('`after` is not a valid cursor.')
+
+    return after, count
+
+
+def get_fields_argument(args, model):
+    '''
+    Get the fields of ``model`` to include in a response from the ``fields``
+    argument (a comma separated list) of a request.args object.
+
+    Returns ``model.DEFAULT_FIELDS`` if there is no ``fields`` argument.
+    '''
+
+    if 'fields' not in args:
+        return model.DEFAULT_FIELDS
+
+    fields = tuple(f.strip() for f in args['fields'].split(',') if f.strip())
+
+    for field in fields:
+        if field not in model.FIELDS:
+            raise BadRequest('`fields` must be a subset of: {}.'
+                             .format(', '.join(sorted(model.FIELDS))))
+
+    return fields
+
 
 def get_int_arg(name, arg, optional=False):
     ''' Convert argument to int or return 400 BAD REQUEST. '''
@@ -18,6 +67,63 @@ def get_int_arg(name, arg, optional=False):
     return arg
 
 
+def get_load_options(model, fields):
+    '''
+    Return query options that load only the attributes of ``model`` needed by
+    ``model.as_dict(fields)``.
+
+    ``model.FIELDS`` maps each field to the attributes it needs. An attribute
+    may be a column, a relationship (whose default fields are needed), or
+    ``relationship.field`` (to need only that field of the related model).
+    Needed relationships are loaded with ``selectinload()``, and the others
+    are not loaded unless they are used.
+    '''
+
+    mapper = inspect(model)
+    attrs = {'id'}
+    related_fields = {}
+
+    for field in fields:
+        for attr in model.FIELDS[field]:
+            attr, _, related_field = attr.partition('.')
+            attrs.add(attr)
+
+            if attr in mapper.relationships.keys():
+                related = related_fields.setdefault(attr, set())
+
+                if related_field:
+                    related.add(related_field)
+                else:
+                    related.update(getattr(mapper.relationships[attr]
+                                           .mapper.class_,
+                                           'DEFAULT_FIELDS',
+                                           ()))
+
+    columns = [getattr(model, attr) for attr in attrs
+               if attr in mapper.column_attrs.keys()]
+    options = [load_only(*columns)]
+
+    for relationship in mapper.relationships:
+        attr = getattr(model, relationship.key)
+
+        if relationship.key not in attrs:
+            options.append(lazyload(attr))
+            continue
+
+        related_model = relationship.mapper.class_
+        option = selectinload(attr)
+
+        if hasattr(related_model, 'FIELDS'):
+            option = option.options(*get_load_options(
+                related_model,
+                related_fields[relationship.key]
+            ))
+
+        options.append(option)
+
+    return options
+
+
 def get_paging_arguments(args):
     ''' Get a standard pair of paging arguments from a request.args object. '''
 
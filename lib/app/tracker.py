@@ -0,0 +1,305 @@
+'''
+Progress trackers for username searches.
+
+Each search has a tracker: a Redis hash, keyed by the tracker ID, that holds
+the search's parameters, its progress and the state of each site:
+
+* ``username``, ``user_id``, ``category_id`` and ``test``: the search,
+* ``state``: "running", "complete" or "timed_out",
+* ``current`` and ``total``: the number of sites that are done, out of all,
+* ``created_at`` and ``updated_at``: UNIX times,
+* ``site:<site ID>``: "p" while the site is pending, or else the status of
+  its result ("f", "n" or "e"), and
+* ``staged`` and ``staging_failed``: in the "incremental" archive mode, the
+  number of results whose archive entries were staged, or that could not be
+  staged (see ``worker.archive.stage_result()``).
+
+Each site is recorded once, so a search completes exactly once, however its
+results arrive. A running tracker expires if it makes no progress for twice
+``[tracker] stale_after`` seconds, but the sweeper (see
+``worker.scrape.time_out_searches()``) finishes it before then. Finished
+trackers are kept for ``[tracker] finished_ttl`` seconds.
+'''
+
+import re
+import time
+from datetime import datetime
+
+import app.config
+import coalesce as co
+
+_config = app.config.get_config()
+_stale_after = _config.getint('tracker', 'stale_after')
+_finished_ttl = _config.getint('tracker', 'finished_ttl')
+
+KEY_PREFIX = 'tracker'
+
+# Tracker IDs are the key prefix and a random string, e.g. "tracker.a1B2c3".
+_tracker_id_pattern = re.compile(r'{}\.[A-Za-z0-9]+'.format(KEY_PREFIX))
+
+# The fields that every tracker has.
+_fields = ('username', 'user_id', 'category_id', 'test', 'state', 'current',
+           'total', 'created_at', 'updated_at')
+
+# Create a tracker with a pending field for each site.
+#
+# KEYS: tracker, active trackers
+# ARGV: TTL, now, username, user ID, category ID, 1 if test, then site IDs
+_create_script = '''
+redis.call('del', KEYS[1])
+
+local total = 0
+
+for i = 7, #ARGV do
+    total = total + redis.call('hsetnx', KEYS[1], 'site:' .. ARGV[i], 'p')
+end
+
+redis.call('hmset', KEYS[1],
+           'username', ARGV[3],
+           'user_id', ARGV[4],
+           'category_id', ARGV[5],
+           'test', ARGV[6],
+           'state', 'running',
+           'current', 0,
+           'total', total,
+           'created_at', ARGV[2],
+           'updated_at', ARGV[2])
+redis.call('expire', KEYS[1], ARGV[1])
+redis.call('zadd', KEYS[2], ARGV[2], KEYS[1])
+'''
+
+# Record the status of a pending site. Returns nil if the site is not
+# pending (e.g. it is already recorded, or the tracker expired), or else a
+# list of the number of sites done, the total, 1 if this completes the search
+# (or else 0) and 1 if it is a test search (or else 0).
+#
+# KEYS: tracker, active trackers
+# ARGV: site ID, status, TTL, finished TTL, now
+_record_script = '''
+local field = 'site:' .. ARGV[1]
+
+if redis.call('hget', KEYS[1], field) ~= 'p' then
+    return nil
+end
+
+redis.call('hmset', KEYS[1], field, ARGV[2], 'updated_at', ARGV[5])
+
+local current = redis.call('hincrby', KEYS[1], 'current', 1)
+local total = tonumber(redis.call('hget', KEYS[1], 'total'))
+local test = tonumber(redis.call('hget', KEYS[1], 'test'))
+
+if current < total then
+    redis.call('expire', KEYS[1], ARGV[3])
+    redis.call('zadd', KEYS[2], ARGV[5], KEYS[1])
+    return {current, total, 0, test}
+end
+
+if redis.call('hget', KEYS[1], 'state') == 'running' then
+    redis.call('hset', KEYS[1], 'state', 'complete')
+end
+
+redis.call('expire', KEYS[1], ARGV[4])
+redis.call('zrem', KEYS[2], KEYS[1])
+return {current, total, 1, test}
+'''
+
+# Count a staged result (or a failure to stage one), unless the tracker
+# expired.
+#
+# KEYS: tracker
+# ARGV: field ("staged" or "staging_failed")
+_staging_script = '''
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('hincrby', KEYS[1], ARGV[1], 1)
+end
+'''
+
+# Mark a running tracker as timed out, and return the IDs of its pending
+# sites. Trackers that expired are forgotten.
+#
+# KEYS: tracker, active trackers
+_time_out_script = '''
+if redis.call('exists', KEYS[1]) == 0 then
+    redis.call('zrem', KEYS[2], KEYS[1])
+    return {}
+end
+
+if redis.call('hget', KEYS[1], 'state') == 'running' then
+    redis.call('hset', KEYS[1], 'state', 'timed_out')
+end
+
+local fields = redis.call('hgetall', KEYS[1])
+local pending = {}
+
+for i = 1, #fields, 2 do
+    if string.sub(fields[i], 1, 5) == 'site:' and fields[i + 1] == 'p' then
+        table.insert(pending, string.sub(fields[i], 6))
+    end
+end
+
+return pending
+'''
+
+
+class Tracker:
+    ''' The progress trackers of all username searches. '''
+
+    def __init__(self, redis):
+        ''' Constructor. '''
+
+        self.redis = redis
+        self._active_key = '{}:active'.format(KEY_PREFIX)
+        self._ttl = 2 * _stale_after
+        self._create = redis.register_script(_create_script)
+        self._record = redis.register_script(_record_script)
+        self._staging = redis.register_script(_staging_script)
+        self._time_out = redis.register_script(_time_out_script)
+
+    def create(self, tracker_id, username, user_id, category_id, site_ids,
+               test=False):
+        ''' Create a tracker for a search of `site_ids`. '''
+
+        args = [self._ttl,
+                time.time(),
+                username,
+                user_id,
+                '' if category_id is None else category_id,
+                1 if test else 0]
+        args.extend(site_ids)
+        self._create(keys=[tracker_id, self._active_key], args=args)
+
+    def delete(self, *tracker_ids):
+        ''' Delete trackers, e.g. of searches that could not be queued. '''
+
+        self.redis.delete(*tracker_ids)
+        self.redis.zrem(self._active_key, *tracker_ids)
+
+    def expects(self, tracker_id, site_id):
+        ''' Return True if a tracker's site is pending. '''
+
+        field = 'site:{}'.format(site_id)
+
+        return self.redis.hget(tracker_id, field) == b'p'
+
+    def get(self, tracker_id):
+        '''
+        Return a dict of a tracker's search, progress and site states, or
+        None if the tracker does not exist.
+
+        The state of each pending site is None. `tracker_id` may come from a
+        client, so anything other than a well-formed ID of a tracker hash
+        (with all of its fields) is treated as a tracker that does not
+        exist.
+        '''
+
+        if _tracker_id_pattern.fullmatch(tracker_id) is None or \
+           self.redis.type(tracker_id) != b'hash':
+            return None
+
+        fields = {key.decode('utf8'): value.decode('utf8') for key, value in
+                  self.redis.hgetall(tracker_id).items()}
+
+        if any(field not in fields for field in _fields):
+            return None
+
+        sites = {}
+
+        for key, value in fields.items():
+            if key.startswith('site:'):
+                sites[int(key[5:])] = None if value == 'p' else value
+
+        category_id = fields['category_id']
+
+        return {
+            'tracker_id': tracker_id,
+            'username': fields['username'],
+            'user_id': int(fields['user_id']),
+            'category_id': int(category_id) if category_id else None,
+            'test': fields['test'] == '1',
+            'state': fields['state'],
+            'current': int(fields['current']),
+            'total': int(fields['total']),
+            'created_at': _isoformat(fields['created_at']),
+            'updated_at': _isoformat(fields['updated_at']),
+            'sites': sites,
+        }
+
+    def record(self, tracker_id, site_id, status):
+        '''
+        Record the `status` of a pending site.
+
+        Returns None if the site is not pending. Otherwise, returns a dict of
+        the search's progress (``current`` and ``total``), whether this
+        completes it (``complete``) and whether it is a test search
+        (``test``).
+        '''
+
+        progress = self._record(keys=[tracker_id, self._active_key],
+                                args=[site_id,
+                                      status,
+                                      self._ttl,
+                                      _finished_ttl,
+                                      time.time()])
+
+        if progress is None:
+            return None
+
+        current, total, complete, test = progress
+
+        return {
+            'current': current,
+            'total': total,
+            'complete': complete == 1,
+            'test': test == 1,
+        }
+
+    def record_staging(self, tracker_id, staged):
+        '''
+        Count a result whose archive entries were `staged`, or could not be.
+        '''
+
+        field = 'staged' if staged else 'staging_failed'
+        self._staging(keys=[tracker_id], args=[field])
+
+    def staging_complete(self, tracker_id):
+        '''
+        Return True if the archive entries of every site's result were
+        staged, so that the staging archive is complete.
+        '''
+
+        total, staged, failed = self.redis.hmget(tracker_id,
+                                                 'total',
+                                                 'staged',
+                                                 'staging_failed')
+
+        return total is not None and failed is None and \
+            int(co.first(staged, 0)) == int(total)
+
+    def stale(self):
+        '''
+        Return the IDs of running trackers that have not made progress for
+        ``[tracker] stale_after`` seconds.
+        '''
+
+        return [tracker_id.decode('utf8') for tracker_id in
+                self.redis.zrangebyscore(self._active_key,
+                                         0,
+                                         time.time() - _stale_after)]
+
+    def time_out(self, tracker_id):
+        '''
+        Mark a tracker as timed out and return the IDs of its pending sites.
+
+        The tracker remains stale until its pending sites are recorded or it
+        expires.
+        '''
+
+        site_ids = self._time_out(keys=[tracker_id, self._active_key])
+
+        return [int(site_id) for site_id in site_ids]
+
+
+def _isoformat(timestamp):
+    ''' Format a UNIX time as an ISO-8601 UTC date. '''
+
+    return datetime.utcfromtimestamp(float(timestamp)).isoformat()
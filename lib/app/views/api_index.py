@@ -1,5 +1,5 @@
 from flask import jsonify
-from flask.ext.classy import FlaskView
+from flask.ext.classy import FlaskView, route
 
 from app.rest import url_for
 
@@ -31,3 +31,16 @@ class ApiIndexView(FlaskView):
             authentication_url=url_for('AuthenticationView:index'),
             search_url=url_for('UsernameView:index')
         )
+
+    @route('/canary')
+    def canary(self):
+        '''
+        Return an empty response.
+
+        Proxy health checks fetch this endpoint through each proxy (see
+        ``worker.proxy_health``).
+
+        :status 204: ok
+        '''
+
+        return '', 204
@@ -1,13 +1,28 @@
-from flask import g, jsonify, request
-from flask.ext.classy import FlaskView
+from flask import (g,
+                   jsonify,
+                   request,
+                   Response,
+                   send_from_directory,
+                   stream_with_context)
+from flask.ext.classy import FlaskView, route
 from werkzeug.exceptions import BadRequest, NotFound
 from sqlalchemy.exc import IntegrityError
 
+import app.config
+import worker.archive
 from app.authorization import login_required
+from app.database import count_rows, keyset_page
 from app.notify import notify_mask_client
-from app.rest import (get_int_arg,
+from app.rest import (get_cursor_arguments,
+                      get_fields_argument,
+                      get_int_arg,
+                      get_load_options,
                       get_paging_arguments)
-from model import Archive, Category
+from model import Archive, Category, File
+from model.file import iter_zip
+
+_cache_downloads = app.config.get_config().getboolean('archive',
+                                                      'cache_downloads')
 
 
 class ArchiveView(FlaskView):
@@ -37,20 +52,29 @@ class ArchiveView(FlaskView):
                         "found_count": 65,
                         "not_found_count": 101,
                         "error_count": 9,
-                        "zip_file": "bob-2298d96a-653d-42f2.zip",
+                        "zip_file_url": "/api/archives/1/download",
                         "category_id": 2,
                         "category_name": "Business",
                     },
                     ...
                 ],
-                "total_count": 5
+                "total_count": 5,
+                "next_after": "WyIyMDE3LTAxLTMwVDE2OjIyOjE5LjgyNjg0MSIsMTBd"
             }
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
-        :query page: the page number to display (default: 1)
+        :query page: the page number to display (default: 1), if there is
+            no cursor
         :query rpp: the number of results per page (default: 10)
+        :query after: the cursor of the page to display, from the previous
+            page's ``next_after``
+        :query count: how to compute ``total_count``: exact, estimate or none
+            (default: exact)
         :query username: filter by matching usernames
+        :query fields: a comma separated list of fields to include in each
+            archive (default: all, plus category_name if category_id is
+            included)
 
         :>header Content-Type: application/json
         :>json list archives: a list of result archive objects
@@ -70,9 +94,14 @@ class ArchiveView(FlaskView):
         :>json str archives[n].error_count: the number sites in
             this archive that raised an error
         while searching for username
-        :>json str archives[n].zip_file: the zip file location for this archive
+        :>json str archives[n].zip_file_url: the URL to download this
+            archive's zip file
         :>json str archives[n].category_id: category ID of the archive
         :>json str archives[n].category_name: category name of the archive
+        :>json int total_count: the (estimated) number of archives, or null
+            if the count is "none"
+        :>json str next_after: the cursor of the next page, or null if this
+            is the last page
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -80,38 +109,51 @@ class ArchiveView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
+        fields = get_fields_argument(request.args, Archive)
         username = request.args.get('username', '')
+        keys = [Archive.date, Archive.id]
+        after, count = get_cursor_arguments(request.args, keys)
 
         query = g.db.query(Archive).filter(Archive.user_id == g.user.id)
 
         if username:
             query = query.filter(Archive.username == username)
 
-        total_count = query.count()
+        total_count = count_rows(query, count)
 
-        query = query.order_by(Archive.date.desc()) \
-                     .limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+        query = query.options(*get_load_options(Archive, fields)) \
+                     .order_by(Archive.date.desc(), Archive.id.desc())
+        rows, next_after = keyset_page(query,
+                                       keys,
+                                       results_per_page,
+                                       after=after,
+                                       offset=(page - 1) * results_per_page,
+                                       descending=True)
 
         # Get categories
         categories = {}
-        for category in g.db.query(Category).all():
+        category_query = g.db.query(Category) \
+                             .options(*get_load_options(Category, ('name',)))
+        for category in category_query:
             categories[category.id] = category.name
 
         archives = list()
 
-        for archive in query:
-            archive_dict = archive.as_dict()
-            try:
-                archive_dict['category_name'] = categories[archive.category_id]
-            except KeyError:
-                archive_dict['category_name'] = 'All sites'
+        for archive in rows:
+            archive_dict = archive.as_dict(fields)
+
+            if 'category_id' in fields:
+                archive_dict['category_name'] = categories.get(
+                    archive.category_id,
+                    'All sites'
+                )
 
             archives.append(archive_dict)
 
         return jsonify(
             archives=archives,
-            total_count=total_count
+            total_count=total_count,
+            next_after=next_after
         )
 
     def get(self, id_):
@@ -120,6 +162,62 @@ class ArchiveView(FlaskView):
         '''
         raise BadRequest('Endpoint not configured')
 
+    @route('/<id_>/download')
+    def download(self, id_):
+        '''
+        Download the zip archive of the archive identified by `id_`.
+
+        The archive contains the screenshot and HTML of each found result and
+        a CSV summary of all results. Unless the archive is stored in the
+        data directory, it is generated while it is sent. If
+        ``[archive] cache_downloads`` is set, then it is stored for later
+        downloads.
+
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/zip
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 404: archive does not exist
+        '''
+
+        id_ = get_int_arg('id_', id_)
+        archive = g.db.query(Archive).filter(Archive.id == id_).filter(
+            Archive.user_id == g.user.id).first()
+
+        if archive is None:
+            raise NotFound("Archive '%s' does not exist." % id_)
+
+        filename = worker.archive.zip_filename(archive.username)
+
+        if archive.zip_file_id is not None:
+            zip_file = g.db.query(File).get(archive.zip_file_id)
+
+            return send_from_directory(
+                app.config.get_path('data'),
+                zip_file.relpath(),
+                mimetype=zip_file.mime,
+                as_attachment=True,
+                attachment_filename=zip_file.name,
+                cache_timeout=0 if g.debug else None
+            )
+
+        # HTML is fetched while streaming, so the request context (and its
+        # database session) must stay open until the response is sent.
+        files, str_files = worker.archive.zip_entries(g.db,
+                                                      filename,
+                                                      archive.tracker_id)
+
+        if _cache_downloads:
+            worker.archive.cache_archive.enqueue(archive_id=archive.id)
+
+        disposition = 'attachment; filename="{}.zip"'.format(filename)
+
+        return Response(stream_with_context(iter_zip(files, str_files)),
+                        mimetype='application/zip',
+                        headers={'Content-Disposition': disposition})
+
     def delete(self, id_):
         '''
         Delete archive identified by `id_`.
@@ -1,11 +1,14 @@
 from flask import g, jsonify, request
 from flask.ext.classy import FlaskView
 from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.orm import selectinload
 from werkzeug.exceptions import BadRequest, NotFound
 
 from app.authorization import login_required
 from app.notify import notify_mask_client
-from app.rest import (get_int_arg,
+from app.rest import (get_fields_argument,
+                      get_int_arg,
+                      get_load_options,
                       url_for,
                       get_paging_arguments,
                       validate_request_json,
@@ -20,6 +23,12 @@ GROUP_ATTRS = {
     'sites': {'type': list, 'required': True},
 }
 
+# Categories include their sites' test results.
+_test_result_options = (
+    selectinload(Site.test_result_pos),
+    selectinload(Site.test_result_neg),
+)
+
 
 class CategoryView(FlaskView):
     '''
@@ -54,6 +63,8 @@ class CategoryView(FlaskView):
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
+        :query fields: a comma separated list of fields to include
+            (default: all)
 
         :>header Content-Type: application/json
         :>json int id: unique identifier for category
@@ -68,12 +79,16 @@ class CategoryView(FlaskView):
 
         # Get category.
         id_ = get_int_arg('id_', id_)
-        category = g.db.query(Category).filter(Category.id == id_).first()
+        fields = get_fields_argument(request.args, Category)
+        category = g.db.query(Category) \
+                       .options(*get_load_options(Category, fields)) \
+                       .filter(Category.id == id_) \
+                       .first()
 
         if category is None:
             raise NotFound("Category '%s' does not exist." % id_)
 
-        response = category.as_dict()
+        response = category.as_dict(fields)
         response['url-for'] = url_for('CategoryView:get', id_=category.id)
 
         # Send response.
@@ -134,6 +149,7 @@ class CategoryView(FlaskView):
                 raise BadRequest('At least one site is required.')
 
             sites = g.db.query(Site)\
+                        .options(*_test_result_options)\
                         .filter(Site.id.in_(request_site_ids))\
                         .all()
             site_ids = [site.id for site in sites]
@@ -225,6 +241,8 @@ class CategoryView(FlaskView):
         :<header X-Auth: the client's auth token
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
+        :query fields: a comma separated list of fields to include in each
+            category (default: all)
 
         :>header Content-Type: application/json
         :>json list categories: a list of category objects
@@ -247,16 +265,18 @@ class CategoryView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
+        fields = get_fields_argument(request.args, Category)
         query = g.db.query(Category)
         total_count = query.count()
-        query = query.order_by(Category.name.asc()) \
+        query = query.options(*get_load_options(Category, fields)) \
+                     .order_by(Category.name.asc()) \
                      .limit(results_per_page) \
                      .offset((page - 1) * results_per_page)
 
         categories = list()
 
         for category in query:
-            data = category.as_dict()
+            data = category.as_dict(fields)
             data['url-for'] = url_for('CategoryView:get', id_=category.id)
             categories.append(data)
 
@@ -369,6 +389,7 @@ class CategoryView(FlaskView):
                 raise BadRequest('Categorys must have at least one site')
 
             sites = g.db.query(Site) \
+                .options(*_test_result_options) \
                 .filter(Site.id.in_(request_site_ids)) \
                 .all()
             site_ids = [site.id for site in sites]
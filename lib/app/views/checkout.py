@@ -8,6 +8,7 @@ from werkzeug.exceptions import (BadRequest, Forbidden,
                                  NotFound, ServiceUnavailable)
 
 from app.authorization import login_required
+from app.credits import CreditLedger
 from app.rest import validate_request_json
 from model import Configuration, Site, User
 from model.configuration import get_config
@@ -237,9 +238,19 @@ class CheckoutView(FlaskView):
             # Something else happened, completely unrelated to Stripe
             raise ServiceUnavailable('Error: {}'.format(e))
 
-        user.credits += credits
+        # Add the credits in the database rather than in Python, so that
+        # charges reconciled in the meantime are not overwritten.
+        g.db.query(User) \
+            .filter(User.id == user.id) \
+            .update({User.credits: User.credits + credits},
+                    synchronize_session=False)
         g.db.commit()
-        g.redis.publish('user', json.dumps(user.as_dict()))
+        ledger = CreditLedger(g.redis)
+        ledger.add(user.id, credits)
+
+        user_dict = user.as_dict()
+        user_dict['credits'] = ledger.balance(user.id, user.credits)
+        g.redis.publish('user', json.dumps(user_dict))
 
         message = '{} credits added.'.format(amount)
         response = jsonify(message=message)
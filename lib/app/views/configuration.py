@@ -4,6 +4,7 @@ from werkzeug.exceptions import BadRequest, NotFound
 
 import app.config
 from app.authorization import admin_required
+from app.notify import notify
 from app.rest import url_for
 from model import Configuration
 
@@ -94,4 +95,7 @@ class ConfigurationView(FlaskView):
         configuration.value = value
         g.db.commit()
 
+        # Invalidate cached configuration in workers.
+        notify(g.redis, 'configuration', {'key': key, 'status': 'updated'})
+
         return jsonify(message='Configuration saved.')
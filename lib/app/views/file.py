@@ -8,6 +8,7 @@ from app.authorization import login_required, admin_required
 from app.config import get_path
 from app.rest import get_int_arg
 from model import File
+from model.file import remove_unused_content
 
 
 class FileView(FlaskView):
@@ -83,9 +84,12 @@ class FileView(FlaskView):
             g.db.rollback()
             raise BadRequest(e)
 
-        # Delete file from filesystem
-        if os.path.isfile(file_object_path):
-            os.unlink(file_object_path)
+        # Delete file from filesystem, unless another file has the same
+        # content.
+        shared = g.db.query(File.id).filter(File.hash == file_.hash).first()
+
+        if shared is None:
+            remove_unused_content(file_object_path)
 
         message = 'File id "{}" deleted'.format(id_)
         response = jsonify(message=message)
@@ -8,6 +8,7 @@ from app.notify import notify_mask_client
 from app.rest import get_int_arg, validate_request_json
 
 from model import Proxy
+from worker.proxy_pool import get_proxy_stats
 
 
 # Dictionary of proxy attributes used for validation of json POST/PUT requests
@@ -48,6 +49,19 @@ class ProxiesView(FlaskView):
                         "username": "user",
                         "password": "pass",
                         "active": true,
+                        "latency": 0.84,
+                        "failure_rate": 0.1,
+                        "consecutive_failures": 0,
+                        "checked_at": "2016-01-01T00:00:00.000000",
+                        "auto_disabled": false,
+                        "stats": {
+                            "success_rate": 0.95,
+                            "latency": 3.2,
+                            "successes": 120,
+                            "failures": 4,
+                            "consecutive_failures": 0,
+                            "quarantined": false
+                        }
                     },
                     ...
                 ]
@@ -66,6 +80,18 @@ class ProxiesView(FlaskView):
         :>json str proxies[n]["username"]: username of proxy
         :>json str proxies[n]["password"]: password of proxy
         :>json bool proxies[n]["active"]: proxy active status
+        :>json float proxies[n]["latency"]: moving average latency (in
+            seconds) of health checks
+        :>json float proxies[n]["failure_rate"]: moving average failure rate
+            of health checks
+        :>json int proxies[n]["consecutive_failures"]: number of consecutive
+            failed health checks
+        :>json str proxies[n]["checked_at"]: time of the last health check
+        :>json bool proxies[n]["auto_disabled"]: whether the proxy was
+            deactivated by the health check
+        :>json dict proxies[n]["stats"]: moving average success rate and
+            latency of scrape requests made through the proxy, and whether it
+            is quarantined
 
         :status 200: ok
         :status 401: authentication required
@@ -75,9 +101,13 @@ class ProxiesView(FlaskView):
         proxies = list()
         query = g.db.query(Proxy)
         total_count = query.count()
+        all_proxies = query.all()
+        stats = get_proxy_stats(g.redis, [proxy.id for proxy in all_proxies])
 
-        for proxy in query:
-            proxies.append(proxy.as_dict())
+        for proxy in all_proxies:
+            proxy_dict = proxy.as_dict()
+            proxy_dict['stats'] = stats[proxy.id]
+            proxies.append(proxy_dict)
 
         return jsonify(proxies=proxies, total_count=total_count)
 
@@ -264,6 +294,8 @@ class ProxiesView(FlaskView):
         proxy.host = request_json['host']
         proxy.port = request_json['port']
         proxy.active = request_json['active']
+        # An administrator's decision overrides the health check.
+        proxy.auto_disabled = False
 
         try:
             proxy.username = request_json['username']
@@ -1,8 +1,14 @@
 from flask import g, jsonify, request
 from flask.ext.classy import FlaskView, route
+from werkzeug.exceptions import NotFound
 
 from app.authorization import login_required
-from app.rest import get_paging_arguments
+from app.database import count_rows, keyset_page
+from app.rest import (get_cursor_arguments,
+                      get_fields_argument,
+                      get_int_arg,
+                      get_load_options,
+                      get_paging_arguments)
 from model import Result
 
 
@@ -33,21 +39,29 @@ class ResultView(FlaskView):
                         "username": "bob",
                         "created_at": "2017-01-30T16:22:19.826841",
                         "status": "Found",
-                        "html": "<html><head><title....",
                         "number": "5",
                         "total": "166",
                         "image_file_id": "1234"
+                        "thumb_file_id": "1235"
                         "error": "",
                     },
                     ...
                 ],
-                "total_count": 5
+                "total_count": 5,
+                "next_after": "WyIyMDE3LTAxLTMwVDE2OjIyOjE5LjgyNjg0MSIsMTBd"
             }
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
-        :query page: the page number to display (default: 1)
+        :query page: the page number to display (default: 1), if there is
+            no cursor
         :query rpp: the number of results per page (default: 10)
+        :query after: the cursor of the page to display, from the previous
+            page's ``next_after``
+        :query count: how to compute ``total_count``: exact, estimate or none
+            (default: exact)
+        :query fields: a comma separated list of fields to include in each
+            result (default: all except html)
 
         :>header Content-Type: application/json
         :>json list results: a list of result objects
@@ -63,7 +77,13 @@ class ResultView(FlaskView):
         :>json str results[n].status: result status (Found, Not Found, Error)
         :>json str results[n].image_file_id: the file
             ID of the result screenshot
+        :>json str results[n].thumb_file_id: the file
+            ID of the result screenshot's thumbnail
         :>json str results[n].error: result error message
+        :>json int total_count: the (estimated) number of results, or null
+            if the count is "none"
+        :>json str next_after: the cursor of the next page, or null if this
+            is the last page
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -71,24 +91,73 @@ class ResultView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
+        fields = get_fields_argument(request.args, Result)
+        keys = [Result.created_at, Result.id]
+        after, count = get_cursor_arguments(request.args, keys)
 
         query = g.db.query(Result).filter(Result.user_id == g.user.id)
 
-        total_count = query.count()
+        total_count = count_rows(query, count)
 
-        query = query.limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+        query = query.options(*get_load_options(Result, fields)) \
+                     .order_by(*keys)
+        rows, next_after = keyset_page(query,
+                                       keys,
+                                       results_per_page,
+                                       after=after,
+                                       offset=(page - 1) * results_per_page)
 
         results = list()
 
-        for result in query:
-            results.append(result.as_dict())
+        for result in rows:
+            results.append(result.as_dict(fields))
 
         return jsonify(
             results=results,
-            total_count=total_count
+            total_count=total_count,
+            next_after=next_after
         )
 
+    @route('/<id_>/html')
+    def get_html(self, id_):
+        '''
+        Return the HTML of the result identified by `id_`.
+
+        HTML is left out of other result responses unless it is requested,
+        because it is large.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "id": 1,
+                "html": "<html><head><title...."
+            }
+
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json int id: the unique id of this result
+        :>json str html: the HTML of the result page (null if there is none)
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 404: result does not exist
+        '''
+
+        id_ = get_int_arg('id_', id_)
+        result = g.db.query(Result) \
+                     .options(*get_load_options(Result, ('id', 'html'))) \
+                     .filter(Result.id == id_) \
+                     .filter(Result.user_id == g.user.id) \
+                     .first()
+
+        if result is None:
+            raise NotFound("Result '%s' does not exist." % id_)
+
+        return jsonify(**result.as_dict(('id', 'html')))
+
     @route('/tracker/<string:tracker_id>')
     def get_by_tracker_id(self, tracker_id):
         '''
@@ -110,21 +179,29 @@ class ResultView(FlaskView):
                         "username": "bob",
                         "created_at": "2017-01-30T16:22:19.826841",
                         "status": "Found",
-                        "html": "<html><head><title....",
                         "number": "5",
                         "total": "166",
                         "image_file_id": "1234"
+                        "thumb_file_id": "1235"
                         "error": "",
                     },
                     ...
                 ],
-                "total_count": 5
+                "total_count": 5,
+                "next_after": "WyIyMDE3LTAxLTMwVDE2OjIyOjE5LjgyNjg0MSIsMTBd"
             }
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
-        :query page: the page number to display (default: 1)
+        :query page: the page number to display (default: 1), if there is
+            no cursor
         :query rpp: the number of results per page (default: 10)
+        :query after: the cursor of the page to display, from the previous
+            page's ``next_after``
+        :query count: how to compute ``total_count``: exact, estimate or none
+            (default: exact)
+        :query fields: a comma separated list of fields to include in each
+            result (default: all except html)
 
         :>header Content-Type: application/json
         :>json list results: a list of result objects
@@ -141,6 +218,10 @@ class ResultView(FlaskView):
         :>json str results[n].image_file_id: the file ID
             of the result screenshot
         :>json str results[n].error: result error message
+        :>json int total_count: the (estimated) number of results, or null
+            if the count is "none"
+        :>json str next_after: the cursor of the next page, or null if this
+            is the last page
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -148,24 +229,33 @@ class ResultView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
+        fields = get_fields_argument(request.args, Result)
+        keys = [Result.created_at, Result.id]
+        after, count = get_cursor_arguments(request.args, keys)
 
         query = g.db.query(Result).filter(
             Result.tracker_id == tracker_id).filter(
                 Result.user_id == g.user.id)
 
-        total_count = query.count()
+        total_count = count_rows(query, count)
 
-        query = query.limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+        query = query.options(*get_load_options(Result, fields)) \
+                     .order_by(*keys)
+        rows, next_after = keyset_page(query,
+                                       keys,
+                                       results_per_page,
+                                       after=after,
+                                       offset=(page - 1) * results_per_page)
 
         results = list()
 
-        for result in query:
-            results.append(result.as_dict())
+        for result in rows:
+            results.append(result.as_dict(fields))
 
         return jsonify(
             results=results,
-            total_count=total_count
+            total_count=total_count,
+            next_after=next_after
         )
 
     @route('/username/<string:username>')
@@ -189,21 +279,29 @@ class ResultView(FlaskView):
                         "username": "bob",
                         "created_at": "2017-01-30T16:22:19.826841",
                         "status": "Found",
-                        "html": "<html><head><title....",
                         "number": "5",
                         "total": "166",
                         "image_file_id": "1234"
+                        "thumb_file_id": "1235"
                         "error": "",
                     },
                     ...
                 ],
-                "total_count": 5
+                "total_count": 5,
+                "next_after": "WyIyMDE3LTAxLTMwVDE2OjIyOjE5LjgyNjg0MSIsMTBd"
             }
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
-        :query page: the page number to display (default: 1)
+        :query page: the page number to display (default: 1), if there is
+            no cursor
         :query rpp: the number of results per page (default: 10)
+        :query after: the cursor of the page to display, from the previous
+            page's ``next_after``
+        :query count: how to compute ``total_count``: exact, estimate or none
+            (default: exact)
+        :query fields: a comma separated list of fields to include in each
+            result (default: all except html)
 
         :>header Content-Type: application/json
         :>json list results: a list of result objects
@@ -220,6 +318,10 @@ class ResultView(FlaskView):
         :>json str results[n].image_file_id: the file ID
             of the result screenshot
         :>json str results[n].error: result error message
+        :>json int total_count: the (estimated) number of results, or null
+            if the count is "none"
+        :>json str next_after: the cursor of the next page, or null if this
+            is the last page
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -227,6 +329,10 @@ class ResultView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
+        fields = get_fields_argument(request.args, Result)
+        # There is one result per site name, so the site name is the key.
+        keys = [Result.site_name]
+        after, count = get_cursor_arguments(request.args, keys)
 
         query = g.db.query(Result).filter(
             Result.username == username).filter(
@@ -235,17 +341,22 @@ class ResultView(FlaskView):
                     Result.created_at.desc()).distinct(
                         Result.site_name)
 
-        total_count = query.count()
+        total_count = count_rows(query, count)
 
-        query = query.limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+        query = query.options(*get_load_options(Result, fields))
+        rows, next_after = keyset_page(query,
+                                       keys,
+                                       results_per_page,
+                                       after=after,
+                                       offset=(page - 1) * results_per_page)
 
         results = list()
 
-        for result in query:
-            results.append(result.as_dict())
+        for result in rows:
+            results.append(result.as_dict(fields))
 
         return jsonify(
             results=results,
-            total_count=total_count
+            total_count=total_count,
+            next_after=next_after
         )
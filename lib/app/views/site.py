@@ -2,16 +2,20 @@ from flask import g, jsonify, request
 from flask.ext.classy import FlaskView, route
 from werkzeug.exceptions import BadRequest, NotFound
 from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.orm import load_only
 
 import worker
 from app.authorization import login_required
 from app.notify import notify_mask_client
-from app.rest import (get_int_arg,
+from app.rest import (get_fields_argument,
+                      get_int_arg,
+                      get_load_options,
                       get_paging_arguments,
                       validate_request_json,
                       validate_json_attr)
 from helper.functions import random_string
 from model import Site, Category
+from worker.matcher import compile_matcher
 
 # Dictionary of site attributes used for validation of json POST/PUT requests
 _site_attrs = {
@@ -26,6 +30,10 @@ _site_attrs = {
     'censor_images': {'type': bool, 'required': True},
     'wait_time': {'type': int, 'required': True},
     'use_proxy': {'type': bool, 'required': True},
+    'probe_mode': {'type': str, 'required': False},
+    'cache_ttl': {'type': int, 'required': False, 'allow_null': True},
+    'rate_limit': {'type': int, 'required': False, 'allow_null': True},
+    'max_concurrency': {'type': int, 'required': False, 'allow_null': True},
 }
 
 
@@ -60,6 +68,10 @@ class SiteView(FlaskView):
                         "censor_images": false,
                         "wait_time": 5,
                         "use_proxy": false,
+                        "probe_mode": "render",
+                        "cache_ttl": null,
+                        "rate_limit": null,
+                        "max_concurrency": null,
                     },
                     ...
                 ],
@@ -73,6 +85,8 @@ class SiteView(FlaskView):
         :<header X-Auth: the client's auth token
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
+        :query fields: a comma separated list of fields to include in each
+            site (default: all)
 
         :>header Content-Type: application/json
         :>json list sites: a list of site objects
@@ -104,6 +118,7 @@ class SiteView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
+        fields = get_fields_argument(request.args, Site)
 
         query = g.db.query(Site)
 
@@ -112,14 +127,15 @@ class SiteView(FlaskView):
         total_invalid_count = query.filter(Site.valid == False).count() # noqa
         total_tested_count = query.filter(Site.tested_at != None).count() # noqa
 
-        query = query.order_by(Site.name.asc()) \
+        query = query.options(*get_load_options(Site, fields)) \
+                     .order_by(Site.name.asc()) \
                      .limit(results_per_page) \
                      .offset((page - 1) * results_per_page)
 
         sites = list()
 
         for site in query:
-            data = site.as_dict()
+            data = site.as_dict(fields)
             sites.append(data)
 
         return jsonify(
@@ -155,6 +171,10 @@ class SiteView(FlaskView):
                         "censor_images": false,
                         "wait_time": 5,
                         "use_proxy": false,
+                        "probe_mode": "render",
+                        "cache_ttl": null,
+                        "rate_limit": null,
+                        "max_concurrency": null,
                     },
                     ...
                 ]
@@ -190,6 +210,15 @@ class SiteView(FlaskView):
             after page is loaded
         :<json bool sites[n].use_proxy: whether to proxy requests
             for this profile URL
+        :<json string sites[n].probe_mode: how to check the profile URL (see
+            get_probe_modes() for valid probe modes) (default: render)
+        :<json int sites[n].cache_ttl: time (in seconds) that results for
+            this site are reused by other searches, or null to use the
+            default (optional)
+        :<json int sites[n].rate_limit: maximum requests per minute to this
+            site's host, or null to use the default (optional)
+        :<json int sites[n].max_concurrency: maximum concurrent requests to
+            this site's host, or null to use the default (optional)
 
         :>header Content-Type: application/json
         :>json string message: API response message
@@ -215,6 +244,20 @@ class SiteView(FlaskView):
             if '%s' not in site_json['url']:
                 raise BadRequest('URL must contain replacement character: %s')
 
+            if 'probe_mode' in site_json:
+                _validate_probe_mode(site_json['probe_mode'])
+
+            if site_json.get('cache_ttl') is not None:
+                _validate_cache_ttl(site_json['cache_ttl'])
+
+            for attr in ('rate_limit', 'max_concurrency'):
+                if site_json.get(attr) is not None:
+                    _validate_limit(attr, site_json[attr])
+
+            if site_json['match_expr'] is not None:
+                _validate_match_expr(_match_type(site_json['match_type']),
+                                     site_json['match_expr'])
+
         # Save sites
         for site_json in request_json['sites']:
             test_username_pos = site_json['test_username_pos'].lower().strip()
@@ -224,7 +267,7 @@ class SiteView(FlaskView):
 
             site.status_code = site_json['status_code']
             site.match_expr = site_json['match_expr']
-            site.match_type = site_json['match_type']
+            site.match_type = _match_type(site_json['match_type'])
 
             if 'test_username_neg' in site_json:
                 site.test_username_neg = site_json['test_username_neg'] \
@@ -233,6 +276,18 @@ class SiteView(FlaskView):
             if 'headers' in site_json:
                 site.headers = site_json['headers']
 
+            if 'probe_mode' in site_json:
+                site.probe_mode = site_json['probe_mode']
+
+            if 'cache_ttl' in site_json:
+                site.cache_ttl = site_json['cache_ttl']
+
+            if 'rate_limit' in site_json:
+                site.rate_limit = site_json['rate_limit']
+
+            if 'max_concurrency' in site_json:
+                site.max_concurrency = site_json['max_concurrency']
+
             g.db.add(site)
 
             try:
@@ -321,6 +376,14 @@ class SiteView(FlaskView):
         :<json int wait_time: time (in seconds) to wait for updates
             after page is loaded
         :<json bool use_proxy: whether to proxy requests for this profile URL
+        :<json string probe_mode: how to check the profile URL (see
+            get_probe_modes() for valid probe modes)
+        :<json int cache_ttl: time (in seconds) that results for this site
+            are reused by other searches, or null to use the default
+        :<json int rate_limit: maximum requests per minute to this site's
+            host, or null to use the default
+        :<json int max_concurrency: maximum concurrent requests to this
+            site's host, or null to use the default
 
         :>header Content-Type: application/json
         :>json int id: unique identifier for site
@@ -343,6 +406,13 @@ class SiteView(FlaskView):
         :>json int wait_time: time (in seconds) to wait for updates after
             page is loaded
         :>json bool use_proxy: whether to proxy requests for this profile URL
+        :>json string probe_mode: how to check the profile URL
+        :>json int cache_ttl: time (in seconds) that results for this site
+            are reused by other searches (nullable)
+        :>json int rate_limit: maximum requests per minute to this site's
+            host (nullable)
+        :>json int max_concurrency: maximum concurrent requests to this
+            site's host (nullable)
 
         :status 202: updated
         :status 400: invalid request body
@@ -374,7 +444,7 @@ class SiteView(FlaskView):
 
         if 'match_type' in request_json:
             validate_json_attr('match_type', _site_attrs, request_json)
-            site.match_type = request_json['match_type'].strip()
+            site.match_type = _match_type(request_json['match_type'])
 
         if 'status_code' in request_json:
             validate_json_attr('status_code', _site_attrs, request_json)
@@ -388,6 +458,9 @@ class SiteView(FlaskView):
                                      'following is required: '
                                      'status code or page match.')
 
+        if site.match_expr is not None:
+            _validate_match_expr(site.match_type, site.match_expr)
+
         if 'test_username_pos' in request_json:
             validate_json_attr('test_username_pos', _site_attrs, request_json)
             site.test_username_pos = (request_json['test_username_pos']
@@ -415,6 +488,28 @@ class SiteView(FlaskView):
             validate_json_attr('wait_time', _site_attrs, request_json)
             site.wait_time = request_json['wait_time']
 
+        if 'probe_mode' in request_json:
+            validate_json_attr('probe_mode', _site_attrs, request_json)
+            _validate_probe_mode(request_json['probe_mode'])
+            site.probe_mode = request_json['probe_mode']
+
+        if 'cache_ttl' in request_json:
+            validate_json_attr('cache_ttl', _site_attrs, request_json)
+
+            if request_json['cache_ttl'] is not None:
+                _validate_cache_ttl(request_json['cache_ttl'])
+
+            site.cache_ttl = request_json['cache_ttl']
+
+        for attr in ('rate_limit', 'max_concurrency'):
+            if attr in request_json:
+                validate_json_attr(attr, _site_attrs, request_json)
+
+                if request_json[attr] is not None:
+                    _validate_limit(attr, request_json[attr])
+
+                setattr(site, attr, request_json[attr])
+
         # Save the updated site
         try:
             g.db.commit()
@@ -545,7 +640,7 @@ class SiteView(FlaskView):
                             ','.join(available_jobs)))
 
         # Get sites.
-        sites = g.db.query(Site).all()
+        sites = g.db.query(Site).options(load_only(Site.id, Site.name)).all()
 
         # Schedule jobs
         for job in request_json['jobs']:
@@ -686,3 +781,83 @@ class SiteView(FlaskView):
         '''
 
         return jsonify(match_types=Site.MATCH_TYPES)
+
+    @route('/probe-modes')
+    def get_probe_modes(self):
+        '''
+        Return a dict that maps probe modes to their human-readable
+        descriptions.
+
+        A site's probe mode determines how its profile URL is checked:
+
+        * ``render``: render the page with Splash.
+        * ``http``: make a direct HTTP request and match against the raw
+          response. No screenshot is taken.
+        * ``http_then_render``: make a direct HTTP request, and render the
+          page with Splash only if the profile is found (so that a
+          screenshot is taken) or the direct request is inconclusive.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "probe_modes": {
+                    'render': 'Render With Splash',
+                    'http': 'Direct HTTP Request',
+                    'http_then_render': 'Direct HTTP Request, Render If Needed',
+                }
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json dict probe_modes: a dict of probe modes
+
+        :status 200: ok
+        :status 401: authentication required
+        '''
+
+        return jsonify(probe_modes=Site.PROBE_MODES)
+
+
+def _validate_cache_ttl(cache_ttl):
+    ''' Raise BadRequest if `cache_ttl` is negative. '''
+
+    if cache_ttl < 0:
+        raise BadRequest('`cache_ttl` must be zero or greater.')
+
+
+def _validate_limit(attr, limit):
+    ''' Raise BadRequest if the host limit `attr` is negative. '''
+
+    if limit < 0:
+        raise BadRequest('`{}` must be zero (unlimited) or greater.'
+                         .format(attr))
+
+
+def _match_type(match_type):
+    '''
+    Return the match type to save for a requested `match_type`, which may be
+    null or blank (meaning the default, "text").
+    '''
+
+    return (match_type or '').strip() or 'text'
+
+
+def _validate_match_expr(match_type, match_expr):
+    ''' Raise BadRequest if `match_expr` does not compile. '''
+
+    try:
+        compile_matcher(match_type, match_expr)
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+
+def _validate_probe_mode(probe_mode):
+    ''' Raise BadRequest if `probe_mode` is not a valid probe mode. '''
+
+    if probe_mode not in Site.PROBE_MODES:
+        raise BadRequest('`probe_mode` must be one of: {}'
+                         .format(', '.join(sorted(Site.PROBE_MODES))))
@@ -10,6 +10,7 @@ from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, Conflict, Forbidden, NotFound
 
 from app.authorization import admin_required, login_required
+from app.credits import CreditLedger
 from app.rest import get_int_arg, get_paging_arguments
 from model import User
 from model.user import hash_password, valid_password
@@ -415,6 +416,9 @@ class UserView(FlaskView):
         g.db.commit()
         g.db.expire(user)
 
+        if 'credits' in request_json:
+            CreditLedger(g.redis).set_credits(user.id, user.credits)
+
         return jsonify(**self._user_dict(user))
 
     def _user_dict(self, user):
@@ -440,7 +444,7 @@ class UserView(FlaskView):
             'name': user.name,
             'phone_e164': user.phone,
             'phone': pretty_phone,
-            'credits': user.credits,
+            'credits': CreditLedger(g.redis).balance(user.id, user.credits),
             'thumb': user.thumb_data(),
         }
 
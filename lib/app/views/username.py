@@ -1,11 +1,16 @@
+from collections import OrderedDict
+
 from flask import g, jsonify, request
 from flask.ext.classy import FlaskView
+from sqlalchemy.orm import load_only
 from werkzeug.exceptions import BadRequest, NotFound
 
 import app.config
 import worker.scrape
 from app.authorization import login_required
+from app.credits import CreditLedger
 from app.rest import validate_request_json
+from app.tracker import Tracker
 from helper.functions import random_string
 from model import Category, Site
 
@@ -15,6 +20,7 @@ _username_attrs = {
     'category': {'type': int, 'required': False},
     'site': {'type': int, 'required': False},
     'test': {'type': bool, 'required': False},
+    'max_age': {'type': int, 'required': False},
 }
 
 _config = app.config.get_config()
@@ -44,6 +50,7 @@ class UsernameView(FlaskView):
                 ],
                 "category": 3,
                 "test": False,
+                "max_age": 300,
             }
 
         **Example Response**
@@ -62,6 +69,9 @@ class UsernameView(FlaskView):
         :>json int category: ID of site category to use (optional)
         :>json int site: ID of site to search (optional)
         :>json bool test: test results (optional, default: false)
+        :>json int max_age: reuse results of other searches only if they are
+            at most this many seconds old; 0 always checks the sites
+            (optional, default: each site's cache TTL)
 
         :>header Content-Type: application/json
         :>json list jobs: list of worker jobs
@@ -73,6 +83,7 @@ class UsernameView(FlaskView):
         :status 401: authentication required
         '''
         test = False
+        max_age = None
         category = None
         category_id = None
         jobs = []
@@ -89,6 +100,10 @@ class UsernameView(FlaskView):
         if len(request_json['usernames']) == 0:
             raise BadRequest('At least one username is required')
 
+        if not all(isinstance(username, str)
+                   for username in request_json['usernames']):
+            raise BadRequest('`usernames` must be a list of strings.')
+
         if 'category' in request_json and 'site' in request_json:
             raise BadRequest('Supply either `category` or `site`.')
 
@@ -112,12 +127,20 @@ class UsernameView(FlaskView):
         if 'test' in request_json:
             test = request_json['test']
 
+        if 'max_age' in request_json:
+            max_age = request_json['max_age']
+
+            if max_age < 0:
+                raise BadRequest('`max_age` must be zero or greater.')
+
         if category:
             sites = category.sites
         elif site:
-            sites = g.db.query(Site).filter(Site.id == site.id).all()
+            sites = [site]
         else:
-            sites = g.db.query(Site).all()
+            sites = g.db.query(Site) \
+                        .options(load_only(Site.id, Site.valid)) \
+                        .all()
 
         # Only check valid sites.
         valid_sites = []
@@ -126,45 +149,140 @@ class UsernameView(FlaskView):
                 valid_sites.append(site)
 
         # sites = sites.filter(Site.valid == True).all() # noqa
-        usernames = request_json['usernames']
-        requests = len(valid_sites) * len(usernames)
-        if requests > g.user.credits:
-            raise BadRequest('Insufficient credits.')
+        # Search each username once: trackers are keyed by username, so a
+        # duplicate would orphan the tracker of its first search.
+        usernames = list(OrderedDict.fromkeys(request_json['usernames']))
+        total = len(valid_sites)
 
-        if len(valid_sites) == 0:
+        if total == 0:
             raise NotFound('No valid sites to check')
 
+        site_ids = [site.id for site in valid_sites]
+        tracker = Tracker(redis)
+
         for username in usernames:
-            # Create an object in redis to track the number of sites completed
-            # in this search.
+            # Create a tracker for the progress of this search (see
+            # app.tracker).
             tracker_id = 'tracker.{}'.format(random_string(10))
             tracker_ids[username] = tracker_id
-            redis.set(tracker_id, 0)
-            redis.expire(tracker_id, 600)
-            total = len(valid_sites)
-
-            # Queue a job for each site.
-            for site in valid_sites:
-                description = 'Checking {} for user "{}"'.format(site.name,
-                                                                 username)
-                job = worker.scrape.check_username.enqueue(
-                    username=username,
-                    site_id=site.id,
-                    category_id=category_id,
-                    total=total,
-                    tracker_id=tracker_id,
-                    test=test,
-                    jobdesc=description,
-                    timeout=_redis_worker['username_timeout'],
-                    user_id=g.user.id
-                )
-                jobs.append({
-                    'id': job.id,
-                    'username': username,
-                    'category': category_id,
-                })
+            tracker.create(tracker_id=tracker_id,
+                           username=username,
+                           user_id=g.user.id,
+                           category_id=category_id,
+                           site_ids=site_ids,
+                           test=test)
+
+        # Reserve a credit for each site of each search, so that concurrent
+        # requests cannot spend the same credits. Test searches are free.
+        ledger = CreditLedger(redis)
+
+        if test:
+            balance = ledger.balance(g.user.id, g.user.credits)
+            sufficient = total * len(tracker_ids) <= balance
+        else:
+            sufficient = ledger.reserve(
+                g.user.id,
+                g.user.credits,
+                {tracker_id: total for tracker_id in tracker_ids.values()}
+            )
+
+        if not sufficient:
+            tracker.delete(*tracker_ids.values())
+            raise BadRequest('Insufficient credits.')
+
+        for username, tracker_id in tracker_ids.items():
+            # Queue one job to search all of the sites.
+            description = 'Searching {} sites for user "{}"'.format(total,
+                                                                    username)
+            job = worker.scrape.search_username.enqueue(
+                username=username,
+                site_ids=site_ids,
+                category_id=category_id,
+                total=total,
+                tracker_id=tracker_id,
+                test=test,
+                max_age=max_age,
+                jobdesc=description,
+                timeout=_redis_worker['search_timeout'],
+                user_id=g.user.id
+            )
+            jobs.append({
+                'id': job.id,
+                'username': username,
+                'category': category_id,
+            })
 
         response = jsonify(tracker_ids=tracker_ids)
         response.status_code = 202
 
         return response
+
+    def get(self, tracker_id):
+        '''
+        Return the progress of the search identified by `tracker_id`.
+
+        Progress is read from the search's tracker, which is kept for
+        ``[tracker] finished_ttl`` seconds after the search finishes.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "tracker_id": "tracker.12344565",
+                "username": "johndoe",
+                "category_id": 3,
+                "test": false,
+                "state": "running",
+                "current": 2,
+                "total": 3,
+                "found_count": 1,
+                "not_found_count": 0,
+                "error_count": 1,
+                "pending_site_ids": [7],
+                "sites": {"5": "f", "6": "e", "7": null},
+                "created_at": "2017-01-30T16:22:19.826841",
+                "updated_at": "2017-01-30T16:22:24.110294"
+            }
+
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json str tracker_id: the ID of the search's tracker
+        :>json str username: the username searched for
+        :>json int category_id: the ID of the category searched, or null
+        :>json bool test: whether this is a test search
+        :>json str state: "running", "complete" (all sites were checked) or
+            "timed_out" (sites that were not checked in time get errors)
+        :>json int current: the number of sites that are done
+        :>json int total: the number of sites searched
+        :>json int found_count: the number of sites with the username
+        :>json int not_found_count: the number of sites without the username
+        :>json int error_count: the number of sites that raised an error
+        :>json list pending_site_ids: the IDs of the sites not yet done
+        :>json dict sites: the status of each site's result (f, n or e) by
+            site ID, or null if it is pending
+        :>json str created_at: when the search was requested
+        :>json str updated_at: when the search last made progress
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 404: search does not exist or has expired
+        '''
+
+        search = Tracker(g.redis).get(tracker_id)
+
+        if search is None or search['user_id'] != g.user.id:
+            raise NotFound("Search '%s' does not exist." % tracker_id)
+
+        statuses = list(search['sites'].values())
+        del search['user_id']
+        search['found_count'] = statuses.count('f')
+        search['not_found_count'] = statuses.count('n')
+        search['error_count'] = statuses.count('e')
+        search['pending_site_ids'] = sorted(
+            site_id for site_id, status in search['sites'].items()
+            if status is None
+        )
+
+        return jsonify(**search)
@@ -16,10 +16,17 @@ import model.user
 
 from app.config import get_path
 from helper.functions import random_password
-from model import Base, Configuration, User, Site, File, Category
+from model import (Base,
+                   Configuration,
+                   User,
+                   Site,
+                   File,
+                   Category,
+                   ResultHtml)
 
 
 _system_user = 'system'
+_compress_batch_size = 500
 
 
 class DatabaseCli(cli.BaseCli):
@@ -53,6 +60,31 @@ class DatabaseCli(cli.BaseCli):
                                'with error code (%d):\n%s' % args)
             sys.exit(1)
 
+    def _compress_result_html(self):
+        '''
+        Compress result HTML that is stored uncompressed, e.g. HTML migrated
+        from the old result.html column.
+        '''
+
+        session = app.database.get_session(self._db)
+        count = 0
+
+        while True:
+            html_rows = session.query(ResultHtml) \
+                               .filter(ResultHtml.encoding == 'identity') \
+                               .limit(_compress_batch_size) \
+                               .all()
+
+            if len(html_rows) == 0:
+                break
+
+            for html_row in html_rows:
+                html_row.set_html(html_row.get_html())
+
+            session.commit()
+            count += len(html_rows)
+            self._logger.info('Compressed HTML of %d results.' % count)
+
     def _create_fixtures(self, config):
         ''' Create fixture data. '''
 
@@ -1872,7 +1904,7 @@ class DatabaseCli(cli.BaseCli):
 
         arg_parser.add_argument(
             'action',
-            choices=('build', 'drop'),
+            choices=('build', 'compress', 'drop'),
             help='Specify what action to take.'
         )
 
@@ -1931,3 +1963,7 @@ class DatabaseCli(cli.BaseCli):
         if args.action == 'build' and args.sample_data:
             self._logger.info('Creating sample data.')
             self._create_samples(config)
+
+        if args.action == 'compress':
+            self._logger.info('Compressing result HTML.')
+            self._compress_result_html()
@@ -0,0 +1,236 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, text
+from sqlalchemy.orm import selectinload
+
+import app.database
+import cli
+from app.rest import get_load_options
+from helper.functions import random_string
+from model import Archive, File, Result, User
+
+_seed_users = 20
+_seed_usernames = 1000
+_seed_sites = 200
+_days_to_keep_result = 7  # As in worker.scrape
+_results_per_page = 10
+
+
+class ExplainCli(cli.BaseCli):
+    '''
+    Check the query plans of the result, archive and file hot paths.
+
+    The database is seeded with synthetic rows and analyzed, then each query
+    is explained. A sequential scan of a table with more rows than
+    --max-seq-rows fails the check. The seed data is rolled back afterwards,
+    but its table statistics are not, so only run this on a local database.
+    '''
+
+    def _check(self, session, name, query, max_seq_rows):
+        '''
+        Explain a query and return False if it sequentially scans a large
+        table.
+        '''
+
+        plan = app.database.explain(query)
+        ok = True
+
+        for relation in _seq_scans(plan):
+            rows = session.execute(
+                text('SELECT reltuples FROM pg_class WHERE relname = :name'),
+                {'name': relation}
+            ).scalar()
+
+            if rows > max_seq_rows:
+                self._logger.error('%s: sequential scan of %s (%d rows).'
+                                   % (name, relation, rows))
+                ok = False
+
+        if ok:
+            self._logger.info('%s: ok (%s).' % (name, plan['Node Type']))
+
+        return ok
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--rows',
+            type=int,
+            default=50000,
+            help='Number of results to seed (default: 50000).'
+        )
+
+        arg_parser.add_argument(
+            '--max-seq-rows',
+            type=int,
+            default=1000,
+            help='Largest table that may be scanned sequentially '
+                 '(default: 1000).'
+        )
+
+    def _queries(self, session, user_id):
+        '''
+        Generate a name and query for each hot path, built as the views and
+        workers build them.
+        '''
+
+        result_options = get_load_options(Result, Result.DEFAULT_FIELDS)
+        result_keys = [Result.created_at, Result.id]
+        archive_keys = [Archive.date, Archive.id]
+        after = datetime.utcnow() - timedelta(days=1)
+        expiry = datetime.utcnow() - timedelta(days=_days_to_keep_result)
+
+        query = session.query(Result) \
+                       .filter(Result.user_id == user_id) \
+                       .options(*result_options) \
+                       .order_by(*result_keys)
+        yield 'ResultView.index', app.database.keyset_query(
+            query, result_keys, _results_per_page)
+        yield 'ResultView.index (cursor)', app.database.keyset_query(
+            query, result_keys, _results_per_page, after=[after, 0])
+
+        query = session.query(Result) \
+                       .filter(Result.tracker_id == 'explain.1') \
+                       .filter(Result.user_id == user_id) \
+                       .options(*result_options) \
+                       .order_by(*result_keys)
+        yield 'ResultView.get_by_tracker_id', app.database.keyset_query(
+            query, result_keys, _results_per_page)
+
+        query = session.query(Result) \
+                       .filter(Result.username == 'user1') \
+                       .filter(Result.user_id == user_id) \
+                       .order_by(Result.site_name, Result.created_at.desc()) \
+                       .distinct(Result.site_name) \
+                       .options(*result_options)
+        yield 'ResultView.get_by_username', app.database.keyset_query(
+            query, [Result.site_name], _results_per_page)
+
+        query = session.query(Archive) \
+                       .filter(Archive.user_id == user_id) \
+                       .order_by(Archive.date.desc(), Archive.id.desc())
+        yield 'ArchiveView.index', app.database.keyset_query(
+            query, archive_keys, _results_per_page, descending=True)
+        yield 'ArchiveView.index (username)', app.database.keyset_query(
+            query.filter(Archive.username == 'user1'),
+            archive_keys,
+            _results_per_page,
+            descending=True)
+
+        yield 'delete_expired_results', session.query(Result) \
+            .filter(Result.created_at < expiry) \
+            .options(selectinload(Result.image_file),
+                     selectinload(Result.thumb_file))
+        yield 'delete_expired_results (files)', session.query(Result.id) \
+            .filter(or_(Result.image_file_id == 1,
+                        Result.thumb_file_id == 1)) \
+            .limit(1)
+
+        yield 'FileView.get', session.query(File).filter(File.id == 1)
+        yield 'FileView.delete', session.query(File.id) \
+            .filter(File.hash == b'\0' * 32) \
+            .limit(1)
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        database_config = dict(config.items('database'))
+        db = app.database.get_engine(database_config, super_user=True)
+        session = app.database.get_session(db)
+
+        try:
+            self._logger.info('Seeding %d results.' % args.rows)
+            user_ids = self._seed(session, args.rows)
+
+            failures = 0
+
+            for name, query in self._queries(session, user_ids[0]):
+                if not self._check(session, name, query, args.max_seq_rows):
+                    failures += 1
+        finally:
+            session.rollback()
+
+        if failures > 0:
+            raise cli.CliError('%d queries scan large tables.' % failures)
+
+    def _seed(self, session, rows):
+        '''
+        Add users, files, results and archives that resemble production
+        data, analyze their tables and return the users' IDs.
+
+        Results are spread over one day more than results are kept, and a
+        third of them (the found ones) have a screenshot.
+        '''
+
+        suffix = random_string(10)
+        users = [User('explain-{}-{}'.format(n, suffix))
+                 for n in range(_seed_users)]
+        session.add_all(users)
+        session.flush()
+        user_ids = [user.id for user in users]
+
+        file_ids = [row[0] for row in session.execute(text('''
+            INSERT INTO file (name, mime, hash, access_type, user_id)
+            SELECT 'explain-' || i || '.jpg',
+                   'image/jpeg',
+                   decode(md5(i::text) || md5(i::text), 'hex'),
+                   'private',
+                   :user_id
+            FROM generate_series(0, :files) AS i
+            RETURNING id
+        '''), {'user_id': user_ids[0], 'files': rows // 3})]
+
+        session.execute(text('''
+            INSERT INTO result (tracker_id, site_name, site_url, site_id,
+                                status, username, created_at, user_id,
+                                image_file_id)
+            SELECT 'explain.' || (i / :sites),
+                   'Site ' || (i % :sites),
+                   'https://site' || (i % :sites) || '.example/' || i,
+                   i % :sites,
+                   CASE WHEN i % 3 = 0 THEN 'f' ELSE 'n' END,
+                   'user' || (i % :usernames),
+                   timezone('utc', now()) - i * :span / :rows,
+                   (:user_ids)[1 + i % :users],
+                   CASE WHEN i % 3 = 0 THEN (:file_ids)[1 + i / 3] END
+            FROM generate_series(1, :rows) AS i
+        '''), {'sites': _seed_sites,
+               'usernames': _seed_usernames,
+               'span': timedelta(days=_days_to_keep_result + 1),
+               'rows': rows,
+               'user_ids': user_ids,
+               'users': _seed_users,
+               'file_ids': file_ids})
+
+        session.execute(text('''
+            INSERT INTO archive (tracker_id, username, date, site_count,
+                                 found_count, not_found_count, error_count,
+                                 created_at, user_id)
+            SELECT 'explain.' || i,
+                   'user' || (i % :usernames),
+                   timezone('utc', now()) - i * interval '1 minute',
+                   :sites, 0, :sites, 0,
+                   timezone('utc', now()) - i * interval '1 minute',
+                   (:user_ids)[1 + i % :users]
+            FROM generate_series(1, :archives) AS i
+        '''), {'usernames': _seed_usernames,
+               'sites': _seed_sites,
+               'user_ids': user_ids,
+               'users': _seed_users,
+               'archives': rows // _seed_sites})
+
+        for table in ('file', 'result', 'archive', '"user"'):
+            session.execute('ANALYZE {}'.format(table))
+
+        return user_ids
+
+
+def _seq_scans(plan):
+    ''' Generate the names of the tables that a plan scans sequentially. '''
+
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+
+    for child in plan.get('Plans', []):
+        yield from _seq_scans(child)
@@ -0,0 +1,272 @@
+import json
+from datetime import datetime, timedelta
+
+from flask import Flask, g
+from itsdangerous import Signer
+from sqlalchemy import event, text
+
+import app.credits
+import app.database
+import cli
+from helper.functions import random_string
+from model import Category, User
+
+
+class QueryCountCli(cli.BaseCli):
+    '''
+    Count the queries of the site, category and username hot paths.
+
+    The database is seeded with a category of synthetic sites (each with
+    test results), then each view is requested through a test client and
+    the queries it executes are counted. The sites are seeded twice: a view
+    whose query count grows with the number of sites, or exceeds
+    --max-queries, fails the check. The seed data is rolled back afterwards,
+    but the views publish notifications to Redis, so only run this on a
+    local database and Redis.
+    '''
+
+    def _check(self, client, headers, requests, max_queries):
+        '''
+        Send each request and return a dict of the number of queries that
+        each view executed.
+        '''
+
+        counts = {}
+
+        for name, method, url, body, status in requests:
+            self._queries = 0
+            response = client.open(url,
+                                   method=method,
+                                   headers=headers,
+                                   data=json.dumps(body),
+                                   content_type='application/json')
+
+            if response.status_code != status:
+                raise cli.CliError('%s: expected status %d, got %d.'
+                                   % (name, status, response.status_code))
+
+            counts[name] = self._queries
+
+            if self._queries > max_queries:
+                self._logger.error('%s: %d queries.'
+                                   % (name, self._queries))
+            else:
+                self._logger.info('%s: ok (%d queries).'
+                                  % (name, self._queries))
+
+        return counts
+
+    def _count_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        ''' Count a query (a ``before_cursor_execute`` listener). '''
+
+        self._queries += 1
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--sites',
+            type=int,
+            default=50,
+            help='Number of sites to seed in each round (default: 50).'
+        )
+
+        arg_parser.add_argument(
+            '--max-queries',
+            type=int,
+            default=10,
+            help='Most queries that a request may execute (default: 10).'
+        )
+
+    def _get_flask_app(self, config, session, redis):
+        '''
+        Return a Flask app that serves the checked views from `session`.
+        '''
+
+        from app.views.category import CategoryView
+        from app.views.site import SiteView
+        from app.views.username import UsernameView
+
+        flask_app = Flask(__name__)
+        signer = Signer(config.get('flask', 'SECRET_KEY'))
+
+        @flask_app.before_request
+        def before_request():
+            ''' Initialize request context. '''
+
+            g.config = config
+            g.debug = False
+            g.db = session
+            g.redis = redis
+            g.sign = lambda s: signer.sign(str(s).encode('utf8')) \
+                                     .decode('utf-8')
+            g.unsign = signer.unsign
+
+        SiteView.register(flask_app, route_base='/api/sites/')
+        UsernameView.register(flask_app, route_base='/api/username/')
+        CategoryView.register(flask_app, route_base='/api/categories/')
+
+        return flask_app, signer
+
+    def _requests(self, category_id, site_ids):
+        '''
+        Generate a name, method, URL, JSON body and expected status for each
+        hot path.
+
+        The username search is expected to fail for lack of credits, after
+        its queries but before any jobs are queued.
+        '''
+
+        category_url = '/api/categories/{}'.format(category_id)
+        suffix = random_string(10)
+
+        yield 'SiteView.index', 'GET', '/api/sites/?rpp=100', None, 200
+        yield 'CategoryView.index', 'GET', '/api/categories/?rpp=100', \
+            None, 200
+        yield 'CategoryView.get', 'GET', category_url, None, 200
+        yield 'CategoryView.post', 'POST', '/api/categories/', \
+            {'categories': [{'name': 'query-count-post-' + suffix,
+                             'sites': site_ids}]}, 200
+        yield 'CategoryView.put', 'PUT', category_url, \
+            {'name': 'query-count-put-' + suffix, 'sites': site_ids}, 200
+        yield 'UsernameView.post', 'POST', '/api/username/', \
+            {'usernames': ['query-count'], 'category': category_id}, 400
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        database_config = dict(config.items('database'))
+        db = app.database.get_engine(database_config, super_user=True)
+        redis = app.database.get_redis(dict(config.items('redis')))
+        self._queries = 0
+        event.listen(db, 'before_cursor_execute', self._count_query)
+
+        # The views commit, so bind the session to a connection whose
+        # transaction is rolled back at the end.
+        connection = db.connect()
+        transaction = connection.begin()
+        session = app.database.get_session(connection)
+        flask_app, signer = self._get_flask_app(config, session, redis)
+        user_id = None
+
+        try:
+            user_id, category_id = self._seed_user(session)
+            expires = (datetime.now() + timedelta(hours=1)).isoformat()
+            headers = {
+                'X-Auth': signer.sign('{}|{}'.format(user_id, expires)
+                                      .encode('utf8')).decode('utf-8'),
+            }
+            site_ids = []
+            counts = []
+
+            with flask_app.test_client() as client:
+                for _ in range(2):
+                    self._logger.info('Seeding %d sites.' % args.sites)
+                    site_ids.extend(self._seed_sites(
+                        session, user_id, category_id, args.sites
+                    ))
+                    counts.append(self._check(
+                        client,
+                        headers,
+                        list(self._requests(category_id, site_ids)),
+                        args.max_queries
+                    ))
+        finally:
+            session.close()
+            transaction.rollback()
+            connection.close()
+
+            if user_id is not None:
+                redis.delete('{}:user:{}'.format(app.credits.KEY_PREFIX,
+                                                 user_id))
+
+        failures = 0
+
+        for name, count in counts[1].items():
+            if count > args.max_queries:
+                failures += 1
+            elif count > counts[0][name]:
+                self._logger.error('%s: %d queries for %d sites, %d for %d.'
+                                   % (name, counts[0][name], args.sites,
+                                      count, 2 * args.sites))
+                failures += 1
+
+        if failures > 0:
+            raise cli.CliError('%d views execute too many queries.'
+                               % failures)
+
+    def _seed_sites(self, session, user_id, category_id, sites):
+        '''
+        Add valid sites with test results (owned by `user_id`) to a category
+        and return their IDs.
+        '''
+
+        suffix = random_string(10)
+        site_ids = [row[0] for row in session.execute(text('''
+            INSERT INTO site (name, url, test_username_pos,
+                              test_username_neg, match_type, valid,
+                              censor_images, wait_time, use_proxy,
+                              probe_mode)
+            SELECT 'query-count-' || :suffix || '-' || i,
+                   'https://site' || i || '.' || :suffix || '.example/%s',
+                   'john',
+                   :suffix,
+                   'text',
+                   true,
+                   false,
+                   1,
+                   false,
+                   'render'
+            FROM generate_series(1, :sites) AS i
+            RETURNING id
+        '''), {'suffix': suffix, 'sites': sites})]
+
+        for result, status in (('pos', 'f'), ('neg', 'n')):
+            session.execute(text('''
+                WITH result AS (
+                    INSERT INTO result (tracker_id, site_name, site_url,
+                                        site_id, status, username,
+                                        created_at, user_id)
+                    SELECT 'query-count.' || :suffix,
+                           site.name,
+                           site.url,
+                           site.id,
+                           :status,
+                           site.test_username_{result},
+                           timezone('utc', now()),
+                           :user_id
+                    FROM site
+                    WHERE site.id = ANY(:site_ids)
+                    RETURNING id, site_id
+                )
+                UPDATE site
+                SET test_result_{result}_id = result.id
+                FROM result
+                WHERE site.id = result.site_id
+            '''.format(result=result)), {'suffix': suffix,
+                                          'status': status,
+                                          'user_id': user_id,
+                                          'site_ids': site_ids})
+
+        session.execute(text('''
+            INSERT INTO category_join_site (category_id, site_id)
+            SELECT :category_id, unnest(:site_ids)
+        '''), {'category_id': category_id, 'site_ids': site_ids})
+
+        return site_ids
+
+    def _seed_user(self, session):
+        '''
+        Add an admin without credits and an empty category, and return their
+        IDs.
+        '''
+
+        suffix = random_string(10)
+        user = User('query-count-{}'.format(suffix))
+        user.is_admin = True
+        category = Category('query-count-{}'.format(suffix), sites=[])
+        session.add_all([user, category])
+        session.flush()
+
+        return user.id, category.id
@@ -0,0 +1,68 @@
+import time
+
+import app.database
+import cli
+from worker.result_sink import publish_results, ResultSink, write_results
+
+
+class RunResultWriterCli(cli.BaseCli):
+    '''
+    Writes the results that scrape workers push onto the result sink to the
+    database, in batches (see worker.result_sink).
+
+    Only one writer may run at a time.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='The largest number of results to write in one transaction '
+                 '(default: [results] batch_size).'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        batch_size = args.batch_size or config.getint('results', 'batch_size')
+        poll_interval = config.getfloat('results', 'poll_interval')
+
+        database_config = dict(config.items('database'))
+        db = app.database.get_engine(database_config)
+        session = app.database.get_session(db)
+        redis = app.database.get_redis(dict(config.items('redis')))
+        sink = ResultSink(redis)
+
+        self._logger.info('Result writer started.')
+
+        while True:
+            try:
+                # Records that were popped but not written (e.g. because the
+                # last attempt failed) are written first.
+                records = sink.pending() or sink.pop(batch_size)
+
+                if len(records) == 0:
+                    time.sleep(poll_interval)
+                    continue
+
+                self._write(session, redis, sink, records)
+            except KeyboardInterrupt:
+                self._logger.info('Stopping the result writer.')
+                return
+            except Exception:
+                session.rollback()
+                self._logger.exception('Could not write results.')
+                time.sleep(poll_interval)
+
+    def _write(self, session, redis, sink, records):
+        ''' Write a batch of records and notify clients. '''
+
+        started = time.time()
+        saved = write_results(session, records)
+        sink.ack()
+        self._logger.debug('Wrote %d of %d results in %.3f seconds.'
+                           % (len(saved), len(records), time.time() - started))
+
+        publish_results(session, redis, saved)
@@ -1,6 +1,6 @@
 import sys
 from redis import Redis
-from rq import Queue, Connection, Worker
+from rq import Queue, Connection, SimpleWorker, Worker
 
 import cli
 import worker
@@ -22,6 +22,14 @@ class RunWorkerCli(cli.BaseCli):
             help='Names of queues for this worker to service.'
         )
 
+        arg_parser.add_argument(
+            '--no-fork',
+            action='store_true',
+            help='Run jobs in the worker process instead of forking a child '
+                 'for each job. Connection pools and caches (e.g. the Splash '
+                 'client) are then reused across jobs.'
+        )
+
     def _run(self, args, config):
         '''
         Main entry point.
@@ -35,5 +43,10 @@ class RunWorkerCli(cli.BaseCli):
 
         with Connection(Redis(host, port)):
             queues = map(Queue, args.queues)
-            w = Worker(queues, exc_handler=worker.handle_exception)
-            w.work()
+            worker_class = SimpleWorker if args.no_fork else Worker
+            w = worker_class(queues, exc_handler=worker.handle_exception)
+
+            try:
+                w.work()
+            finally:
+                worker.close()
@@ -1,8 +1,11 @@
 import schedule
 import time
 
+import app.credits
 import app.database
+import app.queue
 import worker.archive
+import worker.proxy_health
 import worker.scrape
 import cli
 from model import User
@@ -17,6 +20,7 @@ class SchedulerCli(cli.BaseCli):
         database_config = dict(config.items('database'))
         self._db = app.database.get_engine(database_config, super_user=True)
         session = app.database.get_session(self._db)
+        self._redis = app.database.get_redis(dict(config.items('redis')))
 
         # Get system user.
         # Required in order to request new site tests
@@ -26,9 +30,26 @@ class SchedulerCli(cli.BaseCli):
 
         self._logger.info('Scheduler started.')
 
-        # Schedule jobs
-        schedule.every().day.at('00:01').do(self._delete_expired_archives)
-        schedule.every().day.at('00:02').do(self._delete_expired_results)
+        # Schedule jobs. Each runs through _run_job(), so that a job that
+        # fails (e.g. while Redis is unavailable) does not stop the others.
+        schedule.every().day.at('00:01') \
+            .do(self._run_job, self._delete_expired_archives)
+        schedule.every().day.at('00:02') \
+            .do(self._run_job, self._delete_expired_results)
+        schedule.every().second \
+            .do(self._run_job, self._enqueue_delayed_jobs)
+
+        if config.get('proxy_health', 'canary_url'):
+            schedule.every(config.getint('proxy_health', 'interval')) \
+                .minutes.do(self._run_job, self._check_proxies)
+        else:
+            self._logger.warning('[proxy_health] canary_url is not set, so '
+                                 'proxies will not be checked.')
+
+        schedule.every(config.getint('credits', 'reconcile_interval')) \
+            .seconds.do(self._run_job, self._reconcile_credits)
+        schedule.every(config.getint('tracker', 'sweep_interval')).seconds \
+            .do(self._run_job, self._time_out_searches)
 
         # Process jobs
         while True:
@@ -45,6 +66,44 @@ class SchedulerCli(cli.BaseCli):
         """
         worker.archive.delete_expired_archives.enqueue()
 
+    def _enqueue_delayed_jobs(self):
+        """
+        Enqueue delayed jobs (i.e. retries) that are due.
+        """
+        app.queue.enqueue_delayed_jobs()
+
+    def _reconcile_credits(self):
+        """
+        Move credit charges from the credit ledger into the database.
+        """
+        session = app.database.get_session(self._db)
+
+        try:
+            app.credits.reconcile_credits(session, self._redis)
+        finally:
+            session.close()
+
+    def _run_job(self, job):
+        """
+        Run a scheduled job, logging any exception instead of raising it.
+        """
+        try:
+            job()
+        except Exception:
+            self._logger.exception('Scheduled job %s failed.' % job.__name__)
+
+    def _time_out_searches(self):
+        """
+        Finish searches that stopped making progress.
+        """
+        worker.scrape.time_out_searches.enqueue()
+
+    def _check_proxies(self):
+        """
+        Check proxy health.
+        """
+        worker.proxy_health.check_proxies.enqueue()
+
     def _delete_expired_results(self):
         """
         Delete results older than expiry date.
@@ -0,0 +1,186 @@
+'''
+A zip archive writer that compresses entries in parallel.
+
+Entries whose MIME type is already compressed (e.g. JPEG screenshots) are
+stored as is, and the others are deflated. Entries are loaded and
+compressed by a pool of threads (zlib releases the GIL while it works) and
+then written in order, so the archive can be streamed as it is built.
+
+The archives do not use ZIP64 extensions, so they are limited to 65,535
+entries and 4 GiB.
+'''
+
+import mimetypes
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# All entries get the same timestamp (1980-01-01 00:00:00 in MS-DOS format)
+# so that archives of identical entries are byte-identical.
+_DOS_TIME = 0
+_DOS_DATE = (1 << 5) | 1
+
+_ZIP_STORED = 0
+_ZIP_DEFLATED = 8
+_VERSION = 20
+_MADE_BY_UNIX = 3 << 8
+_UTF8_FLAG = 1 << 11
+_EXTERNAL_ATTR = 0o100644 << 16  # regular file, rw-r-r
+_ZIP_LIMIT = 0xffffffff
+_ENTRIES_LIMIT = 0xffff
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+
+
+class ZipWriter:
+    '''
+    Writes zip archives with a per-MIME compression policy.
+
+    After an archive is written, ``stats`` holds its build time in seconds,
+    its total uncompressed and compressed sizes, and the compression ratio.
+    '''
+
+    def __init__(self, stored_types=(), deflate_level=6, threads=4):
+        '''
+        Constructor.
+
+        ``stored_types`` is a collection of MIME types that are stored
+        without compression. ``deflate_level`` (1-9) is the zlib level of the
+        other entries.
+        '''
+
+        self.stored_types = set(stored_types)
+        self.deflate_level = deflate_level
+        self.threads = threads
+        self.stats = None
+
+    def compressible(self, name):
+        ''' Return True if the entry called ``name`` should be deflated. '''
+
+        mime = mimetypes.guess_type(name)[0]
+
+        return mime not in self.stored_types
+
+    def iter_zip(self, entries):
+        '''
+        Generate a zip archive of ``entries`` in chunks of bytes.
+
+        ``entries`` is an iterable of ``(name, load)`` tuples, where ``load``
+        is a function that returns the content of the entry as bytes. Entries
+        are loaded and compressed ahead of being written by up to
+        ``threads`` threads.
+        '''
+
+        started = time.time()
+        central_headers = []
+        offset = 0
+        uncompressed_size = 0
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            for name, method, crc, size, data in \
+                    self._compress_all(pool, entries):
+                name = name.encode('utf8')
+                header = _LOCAL_HEADER.pack(0x04034b50,
+                                            _VERSION,
+                                            _UTF8_FLAG,
+                                            method,
+                                            _DOS_TIME,
+                                            _DOS_DATE,
+                                            crc,
+                                            len(data),
+                                            size,
+                                            len(name),
+                                            0)
+                central_headers.append(_CENTRAL_HEADER.pack(0x02014b50,
+                                                            _MADE_BY_UNIX |
+                                                            _VERSION,
+                                                            _VERSION,
+                                                            _UTF8_FLAG,
+                                                            method,
+                                                            _DOS_TIME,
+                                                            _DOS_DATE,
+                                                            crc,
+                                                            len(data),
+                                                            size,
+                                                            len(name),
+                                                            0,
+                                                            0,
+                                                            0,
+                                                            0,
+                                                            _EXTERNAL_ATTR,
+                                                            offset) + name)
+                yield header + name
+                yield data
+                offset += len(header) + len(name) + len(data)
+                uncompressed_size += size
+
+                if offset > _ZIP_LIMIT or size > _ZIP_LIMIT:
+                    raise ValueError('Zip archive is larger than 4 GiB.')
+
+        if len(central_headers) > _ENTRIES_LIMIT:
+            raise ValueError('Zip archive has more than 65,535 entries.')
+
+        central_directory = b''.join(central_headers)
+        yield central_directory
+        yield _END_RECORD.pack(0x06054b50,
+                               0,
+                               0,
+                               len(central_headers),
+                               len(central_headers),
+                               len(central_directory),
+                               offset,
+                               0)
+
+        compressed_size = offset + len(central_directory) + _END_RECORD.size
+        self.stats = {
+            'build_time': round(time.time() - started, 3),
+            'uncompressed_size': uncompressed_size,
+            'compressed_size': compressed_size,
+            'ratio': round(compressed_size / max(uncompressed_size, 1), 3),
+        }
+
+    def _compress(self, name, load):
+        '''
+        Load and compress an entry.
+
+        Returns a tuple of the entry's name, compression method, CRC,
+        uncompressed size and (compressed) data.
+        '''
+
+        content = load()
+        crc = zlib.crc32(content)
+
+        if self.compressible(name):
+            compressor = zlib.compressobj(self.deflate_level,
+                                          zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+            data = compressor.compress(content) + compressor.flush()
+
+            # Store the entry if it is incompressible after all.
+            if len(data) < len(content):
+                return name, _ZIP_DEFLATED, crc, len(content), data
+
+        return name, _ZIP_STORED, crc, len(content), content
+
+    def _compress_all(self, pool, entries):
+        '''
+        Compress ``entries`` in ``pool`` and generate the results in order.
+
+        No more than twice as many entries as there are threads are held in
+        memory at a time.
+        '''
+
+        pending = deque()
+
+        for name, load in entries:
+            if len(pending) >= 2 * self.threads:
+                yield pending.popleft().result()
+
+            pending.append(pool.submit(self._compress, name, load))
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
@@ -3,10 +3,12 @@ from sqlalchemy import (DateTime,
                         Column,
                         func,
                         ForeignKey,
+                        Index,
                         Integer,
                         String,
                         UniqueConstraint)
 
+import coalesce as co
 from model import Base
 
 
@@ -20,6 +22,25 @@ class Archive(Base):
                          name='tracker_id_zip_file_id'),
     )
 
+    # The attributes that each field of as_dict() needs.
+    FIELDS = {
+        'id': ('id',),
+        'created_at': ('created_at',),
+        'tracker_id': ('tracker_id',),
+        'username': ('username',),
+        'category_id': ('category_id',),
+        'date': ('date',),
+        'site_count': ('site_count',),
+        'found_count': ('found_count',),
+        'not_found_count': ('not_found_count',),
+        'error_count': ('error_count',),
+        'zip_file_url': ('id',),
+        'zip_file_id': ('zip_file_id',),
+        'user_id': ('user_id',),
+    }
+
+    DEFAULT_FIELDS = tuple(sorted(FIELDS))
+
     id = Column(Integer, primary_key=True)
     tracker_id = Column(String(255), nullable=False)
     username = Column(String(255), nullable=False)
@@ -57,21 +78,40 @@ class Archive(Base):
         self.zip_file_id = zip_file_id
         self.user_id = user_id
 
-    def as_dict(self):
-        ''' Return dictionary representation of this archive. '''
+    def as_dict(self, fields=None):
+        '''
+        Return dictionary representation of this archive.
+
+        Only `fields` (by default, `DEFAULT_FIELDS`) are included.
+        '''
 
-        return {
-            'id': self.id,
-            'created_at': self.created_at.isoformat(),
-            'tracker_id': self.tracker_id,
-            'username': self.username,
-            'category_id': self.category_id,
-            'date': self.date.isoformat(),
-            'site_count': self.site_count,
-            'found_count': self.found_count,
-            'not_found_count': self.not_found_count,
-            'error_count': self.error_count,
-            'zip_file_url': '/api/files/{}'.format(self.zip_file_id),
-            'zip_file_id': self.zip_file_id,
-            'user_id': self.user_id
+        getters = {
+            'id': lambda: self.id,
+            'created_at': lambda: self.created_at.isoformat(),
+            'tracker_id': lambda: self.tracker_id,
+            'username': lambda: self.username,
+            'category_id': lambda: self.category_id,
+            'date': lambda: self.date.isoformat(),
+            'site_count': lambda: self.site_count,
+            'found_count': lambda: self.found_count,
+            'not_found_count': lambda: self.not_found_count,
+            'error_count': lambda: self.error_count,
+            'zip_file_url':
+                lambda: '/api/archives/{}/download'.format(self.id),
+            'zip_file_id': lambda: self.zip_file_id,
+            'user_id': lambda: self.user_id,
         }
+
+        return {field: getters[field]()
+                for field in co.first(fields, self.DEFAULT_FIELDS)}
+
+
+# Indexes for the archive list and expiry. See
+# migrations/add_archive_indexes.sql.
+Index('ix_archive_user_id_date', Archive.user_id, Archive.date, Archive.id)
+Index('ix_archive_user_id_username_date',
+      Archive.user_id,
+      Archive.username,
+      Archive.date,
+      Archive.id)
+Index('ix_archive_created_at', Archive.created_at)
@@ -5,6 +5,8 @@ from sqlalchemy import String
 from sqlalchemy import ForeignKey
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.orm import relationship
+
+import coalesce as co
 from model import Base
 
 
@@ -30,6 +32,16 @@ class Category(Base):
         UniqueConstraint('name', name='category_name'),
     )
 
+    # The attributes that each field of as_dict() needs.
+    FIELDS = {
+        'id': ('id',),
+        'name': ('name',),
+        'sites': ('sites',),
+        'cost': ('sites.valid',),
+    }
+
+    DEFAULT_FIELDS = tuple(sorted(FIELDS))
+
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
 
@@ -45,18 +57,30 @@ class Category(Base):
         self.name = name
         self.sites = sites
 
-    def as_dict(self):
-        ''' Return dictionary representation of this site. '''
-        # Sort labels by name
-        sites = [site.as_dict() for site in self.sites]
-        sorted_sites = sorted(sites, key=lambda x: x['name'])
-        return {
-            'id': self.id,
-            'name': self.name,
-            'sites': sorted_sites,
-            'cost': self.cost()
+    def as_dict(self, fields=None):
+        '''
+        Return dictionary representation of this category.
+
+        Only `fields` (by default, `DEFAULT_FIELDS`) are included.
+        '''
+
+        getters = {
+            'id': lambda: self.id,
+            'name': lambda: self.name,
+            'sites': self._sites_as_dicts,
+            'cost': self.cost,
         }
 
+        return {field: getters[field]()
+                for field in co.first(fields, self.DEFAULT_FIELDS)}
+
+    def _sites_as_dicts(self):
+        ''' Return the sites as dictionaries, sorted by name. '''
+
+        sites = [site.as_dict() for site in self.sites]
+
+        return sorted(sites, key=lambda x: x['name'])
+
     def cost(self):
         """
         Return credit cost of category.
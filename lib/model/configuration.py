@@ -32,3 +32,65 @@ def get_config(session, key, required=False):
         raise ValueError('(Configuration) {} cannot be blank.'.format(key))
 
     return result
+
+
+class ConfigurationCache:
+    '''
+    A process-local snapshot of all configuration key/value pairs.
+
+    The whole configuration table is loaded with a single query the first time
+    a value is requested, and subsequent lookups are served from memory. The
+    snapshot is discarded whenever a message is published on the
+    ``configuration`` channel, e.g. by ``ConfigurationView.put()``.
+    '''
+
+    CHANNEL = 'configuration'
+
+    def __init__(self, session_factory, redis):
+        '''
+        Constructor.
+
+        ``session_factory`` is a callable that returns a new database session.
+        '''
+
+        self._session_factory = session_factory
+        self._values = None
+
+        # Subscribe before loading so that no update can be missed.
+        self._pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.CHANNEL)
+
+    def get(self, key, required=False):
+        ''' Get a configuration value. '''
+
+        self._refresh()
+
+        try:
+            value = self._values[key]
+        except KeyError:
+            raise ValueError('(Configuration) {} does not exist.'.format(key))
+
+        if required and value == '':
+            raise ValueError('(Configuration) {} cannot be blank.'.format(key))
+
+        return value
+
+    def invalidate(self):
+        ''' Discard the snapshot so that it is reloaded on next use. '''
+
+        self._values = None
+
+    def _refresh(self):
+        ''' Reload the snapshot if it is missing or has been invalidated. '''
+
+        while self._pubsub.get_message() is not None:
+            self.invalidate()
+
+        if self._values is None:
+            session = self._session_factory()
+
+            try:
+                self._values = {c.key: c.value
+                                for c in session.query(Configuration)}
+            finally:
+                session.close()
@@ -1,16 +1,24 @@
-import time
 import binascii
+import functools
 import hashlib
 import os
-import zipfile
+import tempfile
+import time
 
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Index, Integer, String
 from sqlalchemy.dialects.postgresql import BYTEA
 from sqlalchemy_utils import ChoiceType
 
+import app.config
 from helper.functions import get_path, random_string
+from helper.zip_writer import ZipWriter
 from model import Base
 
+_CHUNK_SIZE = 1 << 16
+
+_fsync_mode = None
+_pending_fsyncs = set()
+
 
 class File(Base):
     '''
@@ -33,8 +41,11 @@ class File(Base):
         ('filename.csv','some,juicy,content')
     ]
 
-    zip_str_files are created in-memory using StringIO
-    and written as zipfile.ZipInfo.
+    The content of a string file may also be a function that returns it, in
+    which case it is only called (in order) while the archive is written.
+
+    Zip archives are written by a ``ZipWriter`` (see ``get_zip_writer()``),
+    which gives identical archives identical hashes.
     '''
 
     __tablename__ = 'file'
@@ -63,9 +74,19 @@ class File(Base):
                  zip_archive=False,
                  zip_files=[],
                  zip_str_files=[],
-                 access_type='private'):
+                 access_type='private',
+                 source_path=None,
+                 zip_writer=None,
+                 stored_hash=None):
         '''
         Constructor.
+
+        If ``source_path`` is given, then the file at that path (which must
+        be in the data directory) is moved into the store. If
+        ``stored_hash`` is given, then the content with that hash is already
+        stored (e.g. this is a copy of another file). Zip archives are
+        written by ``zip_writer``, if given, so that its ``stats`` can be
+        read afterwards.
         '''
 
         self.name = name
@@ -73,35 +94,57 @@ class File(Base):
         self.user_id = user_id
         self.access_type = access_type
 
-        # Create dummy content to use in hash if there is
-        # no content (zip archives)
-        if content is None:
-            content = ('DUMMY DATA - {}' + random_string(1000)).encode('utf8')
-
-        hash_ = hashlib.sha256()
-        hash_.update(content)
-        self.hash = hash_.digest()
+        if stored_hash is not None:
+            self.hash = stored_hash
+            # Mark the content as in use (see remove_unused_content()).
+            os.utime(self.path())
+        elif source_path is not None:
+            self.hash = _hash_path(source_path)
+            self._store(temp_path=source_path)
+        elif zip_archive:
+            # Archives are hashed by their real content, so they must be
+            # built before they can be stored.
+            temp_path = self._zip_to_temp(zip_files,
+                                          zip_str_files,
+                                          zip_writer)
+            self.hash = _hash_path(temp_path)
+            self._store(temp_path=temp_path)
+        else:
+            # Create dummy content to use in hash if there is no content.
+            if content is None:
+                content = ('DUMMY DATA - {}' + random_string(1000)) \
+                    .encode('utf8')
+
+            self.hash = hashlib.sha256(content).digest()
+            self._store(content=content)
+
+    @classmethod
+    def get_or_create(cls, db_session, name, mime, user_id, **kwargs):
+        '''
+        Return an existing file with the same content, name, MIME type, owner
+        and access type, or else create a new one and add it to
+        ``db_session``.
 
-        # Write content to file.
-        data_dir = get_path('data')
-        hash_hex = binascii.hexlify(self.hash).decode('ascii')
-        dir1 = os.path.join(data_dir, hash_hex[0])
-        dir2 = os.path.join(dir1, hash_hex[1])
-        path = os.path.join(dir2, hash_hex[2:])
+        Keyword arguments are the same as the constructor's.
+        '''
 
-        if not os.path.isdir(dir1):
-            os.mkdir(dir1)
+        file_ = cls(name=name, mime=mime, user_id=user_id, **kwargs)
+        existing = (
+            db_session
+            .query(cls)
+            .filter(cls.hash == file_.hash,
+                    cls.name == file_.name,
+                    cls.mime == file_.mime,
+                    cls.user_id == file_.user_id,
+                    cls.access_type == file_.access_type)
+            .first()
+        )
 
-        if not os.path.isdir(dir2):
-            os.mkdir(dir2)
+        if existing is not None:
+            return existing
 
-        if not os.path.isfile(path):
-            if zip_archive:
-                self.zip_files(path, zip_files, zip_str_files)
-            else:
-                file_ = open(path, 'wb')
-                file_.write(content)
-                file_.close()
+        db_session.add(file_)
+        return file_
 
     def chown(self, uid, gid):
         ''' Change ownership of this file and its two immediate ancestors. '''
@@ -115,29 +158,10 @@ class File(Base):
         ancestor2_path = os.path.dirname(ancestor1_path)
         os.chown(ancestor2_path, uid, gid)
 
-    def zip_files(self, path, files, str_files):
-        ''' Create a zip archive of files and string files.'''
-
-        zip_file = zipfile.ZipFile(path, 'w')
-        data_dir = get_path('data')
-
-        # Add files
-        for f in files:
-            f_path = os.path.join(data_dir, f[1])
-            zip_file.write(f_path,
-                           arcname=f[0],
-                           compress_type=zipfile.ZIP_DEFLATED)
+    def path(self):
+        ''' Return the absolute path to the file. '''
 
-        # Write string files
-        for str_file in str_files:
-            info = zipfile.ZipInfo(str_file[0])
-            info.date_time = time.localtime(time.time())[:6]
-            info.compress_type = zipfile.ZIP_DEFLATED
-            # http://stackoverflow.com/questions/434641/how-do-i-set-permissions-attributes-on-a-file-in-a-zip-file-using-pythons-zip/6297838#6297838
-            info.external_attr = 0o644 << 16  # rw-r-r
-            zip_file.writestr(info, str_file[1])
-
-        zip_file.close()
+        return os.path.join(get_path('data'), self.relpath())
 
     def relpath(self):
         ''' Return path to the file relative to the data directory. '''
@@ -163,3 +187,195 @@ class File(Base):
             'access_type': self.access_type,
             'url': '/api/files/{}'.format(self.id)
         }
+
+    def _store(self, content=None, temp_path=None):
+        '''
+        Store ``content`` (or the file at ``temp_path``) at this file's
+        path.
+
+        The content is written to a temporary file that is then renamed into
+        place, so that concurrent writers never expose a partial file. It is
+        written even if the same content is already stored, because that may
+        be about to be deleted (see remove_unused_content()).
+        '''
+
+        path = self.path()
+        dir_ = os.path.dirname(path)
+        os.makedirs(dir_, exist_ok=True)
+
+        if temp_path is None:
+            temp_file = tempfile.NamedTemporaryFile(dir=dir_, delete=False)
+
+            with temp_file:
+                temp_file.write(content)
+                _fsync(temp_file)
+
+            temp_path = temp_file.name
+
+        # Temporary files are private, but stored files are not.
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+        _fsync_later(path, dir_)
+
+    def _zip_to_temp(self, files, str_files, zip_writer=None):
+        '''
+        Create a zip archive of files and string files in a temporary file
+        in the data directory, and return its path.
+        '''
+
+        temp_file = tempfile.NamedTemporaryFile(dir=get_path('data'),
+                                                suffix='.zip',
+                                                delete=False)
+
+        with temp_file:
+            for chunk in iter_zip(files, str_files, zip_writer):
+                temp_file.write(chunk)
+
+            _fsync(temp_file)
+
+        return temp_file.name
+
+
+# Files that share stored content are looked up by hash. See
+# migrations/add_file_indexes.sql.
+Index('ix_file_hash', File.hash)
+
+
+def get_zip_writer():
+    ''' Return a ``ZipWriter`` configured by the ``[archive]`` settings. '''
+
+    config = app.config.get_config()
+    stored_types = config.get('archive', 'stored_types').split(',')
+
+    return ZipWriter(stored_types=[t.strip() for t in stored_types],
+                     deflate_level=config.getint('archive', 'deflate_level'),
+                     threads=config.getint('archive', 'threads'))
+
+
+def iter_zip(files, str_files, zip_writer=None):
+    '''
+    Generate a zip archive of files and string files (as described in
+    ``File``) in chunks of bytes, without holding the whole archive in memory
+    or writing it to disk.
+    '''
+
+    if zip_writer is None:
+        zip_writer = get_zip_writer()
+
+    return zip_writer.iter_zip(_zip_entries(files, str_files))
+
+
+def sync_files():
+    '''
+    Flush files stored in "batch" fsync mode (and their directories) to disk.
+    '''
+
+    paths = list(_pending_fsyncs)
+    _pending_fsyncs.clear()
+
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def remove_unused_content(path):
+    '''
+    Remove stored content at ``path`` that no file uses any more.
+
+    Content is stored before its file is saved (in the batched result mode,
+    a whole batch before), so content that was stored (or copied) in the
+    last ``[files] keep_unused`` seconds is kept for a file that may be
+    about to use it.
+    '''
+
+    keep_unused = app.config.get_config().getint('files', 'keep_unused')
+
+    try:
+        if time.time() - os.path.getmtime(path) > keep_unused:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _fsync(file_):
+    ''' Flush ``file_`` to disk if the fsync mode is "always". '''
+
+    if _get_fsync_mode() == 'always':
+        file_.flush()
+        os.fsync(file_.fileno())
+
+
+def _fsync_later(*paths):
+    '''
+    Remember ``paths`` to flush in ``sync_files()`` if the fsync mode is
+    "batch", or flush them now if it is "always".
+    '''
+
+    mode = _get_fsync_mode()
+
+    if mode == 'batch':
+        _pending_fsyncs.update(paths)
+    elif mode == 'always':
+        _pending_fsyncs.update(paths)
+        sync_files()
+
+
+def _get_fsync_mode():
+    ''' Return the ``[files] fsync`` setting. '''
+
+    global _fsync_mode
+
+    if _fsync_mode is None:
+        _fsync_mode = app.config.get_config().get('files', 'fsync')
+
+        if _fsync_mode not in ('never', 'batch', 'always'):
+            raise ValueError('[files] fsync must be never, batch or always.')
+
+    return _fsync_mode
+
+
+def _hash_path(path):
+    ''' Return the SHA-256 digest of the file at ``path``. '''
+
+    hash_ = hashlib.sha256()
+
+    with open(path, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(_CHUNK_SIZE), b''):
+            hash_.update(chunk)
+
+    return hash_.digest()
+
+
+def _zip_entries(files, str_files):
+    '''
+    Generate ``ZipWriter`` entries for files and string files.
+
+    String file functions are called here rather than in the writer's
+    threads, since they may not be thread safe (e.g. database queries).
+    '''
+
+    data_dir = get_path('data')
+
+    # Add files
+    for f in files:
+        f_path = os.path.join(data_dir, f[1])
+        yield f[0], functools.partial(_read_path, f_path)
+
+    # Add string files
+    for str_file in str_files:
+        content = str_file[1]() if callable(str_file[1]) else str_file[1]
+        yield str_file[0], functools.partial(bytes, content.encode('utf8'))
+
+
+def _read_path(path):
+    ''' Return the content of the file at ``path``. '''
+
+    with open(path, 'rb') as file_:
+        return file_.read()
@@ -1,5 +1,7 @@
 from sqlalchemy import Column
 from sqlalchemy import Boolean
+from sqlalchemy import DateTime
+from sqlalchemy import Float
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import UniqueConstraint
@@ -21,6 +23,13 @@ class Proxy(Base):
     username = Column(String(255), nullable=True)
     password = Column(String(255), nullable=True)
     active = Column(Boolean, nullable=False, default=True)
+    # Health check statistics: see worker.proxy_health.
+    latency = Column(Float, nullable=True)
+    failure_rate = Column(Float, nullable=False, default=0)
+    consecutive_failures = Column(Integer, nullable=False, default=0)
+    consecutive_successes = Column(Integer, nullable=False, default=0)
+    checked_at = Column(DateTime, nullable=True)
+    auto_disabled = Column(Boolean, nullable=False, default=False)
 
     __table_args__ = (
         UniqueConstraint('protocol',
@@ -39,9 +48,19 @@ class Proxy(Base):
         self.username = username
         self.password = password
         self.active = active
+        self.failure_rate = 0
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.auto_disabled = False
 
     def as_dict(self):
         ''' Return dictionary representation of this site. '''
+
+        if self.checked_at:
+            checked_at = self.checked_at.isoformat()
+        else:
+            checked_at = None
+
         return {
             'id': self.id,
             'protocol': self.protocol,
@@ -49,5 +68,10 @@ class Proxy(Base):
             'port': self.port,
             'username': self.username,
             'password': self.password,
-            'active': self.active
+            'active': self.active,
+            'latency': self.latency,
+            'failure_rate': self.failure_rate,
+            'consecutive_failures': self.consecutive_failures,
+            'checked_at': checked_at,
+            'auto_disabled': self.auto_disabled,
         }
@@ -2,14 +2,16 @@ from datetime import datetime
 from sqlalchemy import (Column,
                         DateTime,
                         ForeignKey,
+                        Index,
                         Integer,
                         String,
-                        Text,
                         UniqueConstraint)
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import ChoiceType
 
+import coalesce as co
 from model import Base
+from model.result_html import ResultHtml
 
 
 class Result(Base):
@@ -26,6 +28,29 @@ class Result(Base):
         (u'e', u'Error')
     ]
 
+    # The attributes that each field of as_dict() needs.
+    FIELDS = {
+        'created_at': ('created_at',),
+        'error': ('error',),
+        'html': ('html_row',),
+        'id': ('id',),
+        'image_file_id': ('image_file_id',),
+        'image_file_url': ('image_file',),
+        'image_file_name': ('image_file',),
+        'thumb_file_id': ('thumb_file_id',),
+        'thumb_file_url': ('image_file', 'thumb_file'),
+        'site_id': ('site_id',),
+        'site_name': ('site_name',),
+        'site_url': ('site_url',),
+        'status': ('status',),
+        'tracker_id': ('tracker_id',),
+        'username': ('username',),
+        'user_id': ('user_id',),
+    }
+
+    # HTML is large, so clients must ask for it.
+    DEFAULT_FIELDS = tuple(f for f in sorted(FIELDS) if f != 'html')
+
     id = Column(Integer, primary_key=True)
     tracker_id = Column(String(255), nullable=False)
     site_name = Column(String(255), nullable=False)
@@ -39,10 +64,26 @@ class Result(Base):
     image_file = relationship('File',
                               lazy='joined',
                               backref='result',
+                              foreign_keys='Result.image_file_id',
+                              uselist=False,
+                              cascade='save-update, merge')
+    thumb_file_id = Column(Integer,
+                           ForeignKey('file.id',
+                                      name='fk_thumb_file'),
+                           nullable=True)
+    thumb_file = relationship('File',
+                              lazy='joined',
+                              foreign_keys='Result.thumb_file_id',
                               uselist=False,
-                              cascade='all')
+                              cascade='save-update, merge')
     error = Column(String(255), nullable=True)
-    html = Column(Text, nullable=True)
+    # HTML is stored compressed in another table and loaded when it is first
+    # used (see the html property).
+    html_row = relationship('ResultHtml',
+                            lazy='select',
+                            uselist=False,
+                            cascade='all, delete-orphan',
+                            passive_deletes=True)
     username = Column(String(255), nullable=False)
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     user_id = Column(Integer,
@@ -58,7 +99,7 @@ class Result(Base):
                  username,
                  user_id=None,
                  image_file_id=None,
-                 thumb=None,
+                 thumb_file_id=None,
                  error=None,
                  html=None):
         ''' Constructor. '''
@@ -69,35 +110,101 @@ class Result(Base):
         self.site_url = site_url
         self.status = status
         self.image_file_id = image_file_id
-        self.thumb = thumb
+        self.thumb_file_id = thumb_file_id
         self.error = error
         self.html = html
         self.username = username
         self.user_id = user_id
 
-    def as_dict(self):
-        ''' Return dictionary representation of this result. '''
+    @property
+    def html(self):
+        ''' Return the HTML of the result, or None if it has none. '''
 
-        if self.image_file is not None:
-            image_file_url = self.image_file.url()
-            image_file_name = self.image_file.name
+        if self.html_row is None:
+            return None
+
+        return self.html_row.get_html()
+
+    @html.setter
+    def html(self, html):
+        ''' Set the HTML of the result. '''
+
+        if html is None:
+            self.html_row = None
+        elif self.html_row is None:
+            self.html_row = ResultHtml(html)
         else:
-            image_file_url = None
-            image_file_name = None
-
-        return {
-            'created_at': self.created_at.isoformat(),
-            'error': self.error,
-            'html': self.html,
-            'id': self.id,
-            'image_file_id': self.image_file_id,
-            'image_file_url': image_file_url,
-            'image_file_name': image_file_name,
-            'site_id': self.site_id,
-            'site_name': self.site_name,
-            'site_url': self.site_url,
-            'status': self.status.code,
-            'tracker_id': self.tracker_id,
-            'username': self.username,
-            'user_id': self.user_id,
+            self.html_row.set_html(html)
+
+    def as_dict(self, fields=None):
+        '''
+        Return dictionary representation of this result.
+
+        Only `fields` (by default, `DEFAULT_FIELDS`) are included, and the
+        attributes that other fields need are not used (so they need not be
+        loaded).
+        '''
+
+        getters = {
+            'created_at': lambda: self.created_at.isoformat(),
+            'error': lambda: self.error,
+            'html': lambda: self.html,
+            'id': lambda: self.id,
+            'image_file_id': lambda: self.image_file_id,
+            'image_file_url': self._image_file_url,
+            'image_file_name': lambda: co.member(self.image_file, 'name'),
+            'thumb_file_id': lambda: self.thumb_file_id,
+            'thumb_file_url': self._thumb_file_url,
+            'site_id': lambda: self.site_id,
+            'site_name': lambda: self.site_name,
+            'site_url': lambda: self.site_url,
+            'status': lambda: self.status.code,
+            'tracker_id': lambda: self.tracker_id,
+            'username': lambda: self.username,
+            'user_id': lambda: self.user_id,
         }
+
+        return {field: getters[field]()
+                for field in co.first(fields, self.DEFAULT_FIELDS)}
+
+    def _image_file_url(self):
+        ''' Return the URL of the screenshot, if any. '''
+
+        if self.image_file is None:
+            return None
+
+        return self.image_file.url()
+
+    def _thumb_file_url(self):
+        '''
+        Return the URL of the screenshot's thumbnail.
+
+        Clients should show the thumbnail rather than the full screenshot
+        where possible. Results without a thumbnail (e.g. those showing the
+        error image) fall back to the full screenshot.
+        '''
+
+        if self.thumb_file is None:
+            return self._image_file_url()
+
+        return self.thumb_file.url()
+
+
+# Indexes for the result lists, expiry and file cleanup. See
+# migrations/add_result_indexes.sql.
+Index('ix_result_user_id_created_at',
+      Result.user_id,
+      Result.created_at,
+      Result.id)
+Index('ix_result_username_user_id_site_name',
+      Result.username,
+      Result.user_id,
+      Result.site_name,
+      Result.created_at.desc())
+Index('ix_result_created_at', Result.created_at)
+Index('ix_result_image_file_id',
+      Result.image_file_id,
+      postgresql_where=Result.image_file_id.isnot(None))
+Index('ix_result_thumb_file_id',
+      Result.thumb_file_id,
+      postgresql_where=Result.thumb_file_id.isnot(None))
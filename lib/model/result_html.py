@@ -0,0 +1,53 @@
+import zlib
+
+from sqlalchemy import Column, ForeignKey, Integer, LargeBinary
+from sqlalchemy_utils import ChoiceType
+
+from model import Base
+
+_ZLIB_LEVEL = 6
+
+
+class ResultHtml(Base):
+    '''
+    Data model for the HTML of a result.
+
+    HTML is stored apart from the result table, which is queried often and
+    rarely needs HTML. It is normally compressed with zlib. Rows migrated
+    from the old result.html column are stored as is until they are
+    compressed (see ``python3 bin/database.py compress``).
+    '''
+
+    __tablename__ = 'result_html'
+
+    ENCODING_TYPES = [
+        (u'identity', u'Identity'),
+        (u'zlib', u'zlib'),
+    ]
+
+    result_id = Column(Integer,
+                       ForeignKey('result.id',
+                                  name='fk_result_html_result',
+                                  ondelete='CASCADE'),
+                       primary_key=True)
+    encoding = Column(ChoiceType(ENCODING_TYPES), nullable=False)
+    content = Column(LargeBinary, nullable=False)
+
+    def __init__(self, html):
+        ''' Constructor. '''
+
+        self.set_html(html)
+
+    def get_html(self):
+        ''' Return the decompressed HTML. '''
+
+        if self.encoding == 'zlib':
+            return zlib.decompress(self.content).decode('utf8')
+        else:
+            return self.content.decode('utf8')
+
+    def set_html(self, html):
+        ''' Compress and store `html`. '''
+
+        self.encoding = 'zlib'
+        self.content = zlib.compress(html.encode('utf8'), _ZLIB_LEVEL)
@@ -9,6 +9,7 @@ from sqlalchemy import (Boolean,
                         UniqueConstraint)
 from sqlalchemy.orm import relationship
 
+import coalesce as co
 from model import Base
 from helper.functions import random_string
 
@@ -27,6 +28,42 @@ class Site(Base):
         'xpath': 'XPath Query',
     }
 
+    PROBE_MODES = {
+        'render': 'Render With Splash',
+        'http': 'Direct HTTP Request',
+        'http_then_render': 'Direct HTTP Request, Render If Needed',
+    }
+
+    # The attributes that each field of as_dict() needs.
+    FIELDS = {
+        'id': ('id',),
+        'name': ('name',),
+        'url': ('url',),
+        'status_code': ('status_code',),
+        'match_type': ('match_type',),
+        'match_type_description': ('match_type',),
+        'match_expr': ('match_expr',),
+        'test_username_pos': ('test_username_pos',),
+        'test_username_pos_url': ('url', 'test_username_pos'),
+        'test_username_neg': ('test_username_neg',),
+        'test_username_neg_url': ('url', 'test_username_neg'),
+        'test_result_pos': ('test_result_pos',),
+        'test_result_neg': ('test_result_neg',),
+        'tested_at': ('tested_at',),
+        'valid': ('valid',),
+        'headers': ('headers',),
+        'censor_images': ('censor_images',),
+        'wait_time': ('wait_time',),
+        'use_proxy': ('use_proxy',),
+        'probe_mode': ('probe_mode',),
+        'probe_mode_description': ('probe_mode',),
+        'cache_ttl': ('cache_ttl',),
+        'rate_limit': ('rate_limit',),
+        'max_concurrency': ('max_concurrency',),
+    }
+
+    DEFAULT_FIELDS = tuple(sorted(FIELDS))
+
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
     url = Column(String(255), nullable=False)
@@ -39,8 +76,10 @@ class Site(Base):
                                 ForeignKey('result.id',
                                            name='fk_pos_result'),
                                 nullable=True)
+    # Test results are only loaded where they are needed (e.g. with
+    # selectinload() in views that show them).
     test_result_pos = relationship('Result',
-                                   lazy='joined',
+                                   lazy='select',
                                    backref='site_pos_result',
                                    foreign_keys='Site.test_result_pos_id',
                                    uselist=False,
@@ -50,7 +89,7 @@ class Site(Base):
                                            name='fk_neg_result'),
                                 nullable=True)
     test_result_neg = relationship('Result',
-                                   lazy='joined',
+                                   lazy='select',
                                    backref='site_neg_result',
                                    foreign_keys='Site.test_result_neg_id',
                                    uselist=False,
@@ -61,11 +100,19 @@ class Site(Base):
     censor_images = Column(Boolean, nullable=False, default=False)
     wait_time = Column(Integer, nullable=False, default=1)
     use_proxy = Column(Boolean, nullable=False, default=False)
+    probe_mode = Column(Enum(*tuple(PROBE_MODES.keys()), name='probe_mode'),
+                        nullable=False,
+                        default='render')
+    cache_ttl = Column(Integer, nullable=True)
+    rate_limit = Column(Integer, nullable=True)
+    max_concurrency = Column(Integer, nullable=True)
 
     def __init__(self, name, url, test_username_pos,
                  status_code=None, match_type=None, match_expr=None,
                  test_username_neg=None, headers={},
-                 censor_images=False, wait_time=1, use_proxy=False):
+                 censor_images=False, wait_time=1, use_proxy=False,
+                 probe_mode='render', cache_ttl=None, rate_limit=None,
+                 max_concurrency=None):
         ''' Constructor. '''
 
         self.name = name
@@ -78,58 +125,72 @@ class Site(Base):
         self.censor_images = censor_images
         self.use_proxy = use_proxy
         self.wait_time = wait_time
+        self.probe_mode = probe_mode
+        self.cache_ttl = cache_ttl
+        self.rate_limit = rate_limit
+        self.max_concurrency = max_concurrency
 
         if test_username_neg is None:
             self.test_username_neg = random_string(16)
         else:
             self.test_username_neg = test_username_neg
 
-    def as_dict(self):
-        ''' Return dictionary representation of this site. '''
-
-        # Preformat..
-        if self.tested_at:
-            tested_at = self.tested_at.isoformat()
-        else:
-            tested_at = None
+    def as_dict(self, fields=None):
+        '''
+        Return dictionary representation of this site.
 
-        if self.test_result_pos:
-            test_result_pos = self.test_result_pos.as_dict()
-            # Remove HTML to minimise memory footprint
-            test_result_pos.pop('html', None)
-        else:
-            test_result_pos = None
+        Only `fields` (by default, `DEFAULT_FIELDS`) are included, and the
+        attributes that other fields need are not used (so they need not be
+        loaded).
+        '''
 
-        if self.test_result_neg:
-            test_result_neg = self.test_result_neg.as_dict()
-            # Remove HTML to minimise memory footprint
-            test_result_neg.pop('html', None)
-        else:
-            test_result_neg = None
-
-        return {
-            'id': self.id,
-            'name': self.name,
-            'url': self.url,
-            'status_code': self.status_code,
-            'match_type': self.match_type,
-            'match_type_description': self.MATCH_TYPES[self.match_type],
-            'match_expr': self.match_expr,
-            'test_username_pos': self.test_username_pos,
-            'test_username_pos_url': self.get_url(self.test_username_pos),
-            'test_username_neg': self.test_username_neg,
-            'test_username_neg_url': self.get_url(self.test_username_neg),
-            'test_result_pos': test_result_pos,
-            'test_result_neg': test_result_neg,
-            'tested_at': tested_at,
-            'valid': self.valid,
-            'headers': self.headers,
-            'censor_images': self.censor_images,
-            'wait_time': self.wait_time,
-            'use_proxy': self.use_proxy
+        getters = {
+            'id': lambda: self.id,
+            'name': lambda: self.name,
+            'url': lambda: self.url,
+            'status_code': lambda: self.status_code,
+            'match_type': lambda: self.match_type,
+            'match_type_description':
+                lambda: self.MATCH_TYPES[self.match_type],
+            'match_expr': lambda: self.match_expr,
+            'test_username_pos': lambda: self.test_username_pos,
+            'test_username_pos_url':
+                lambda: self.get_url(self.test_username_pos),
+            'test_username_neg': lambda: self.test_username_neg,
+            'test_username_neg_url':
+                lambda: self.get_url(self.test_username_neg),
+            'test_result_pos': lambda: _result_dict(self.test_result_pos),
+            'test_result_neg': lambda: _result_dict(self.test_result_neg),
+            'tested_at': lambda: _isoformat(self.tested_at),
+            'valid': lambda: self.valid,
+            'headers': lambda: self.headers,
+            'censor_images': lambda: self.censor_images,
+            'wait_time': lambda: self.wait_time,
+            'use_proxy': lambda: self.use_proxy,
+            'probe_mode': lambda: self.probe_mode,
+            'probe_mode_description':
+                lambda: self.PROBE_MODES[self.probe_mode],
+            'cache_ttl': lambda: self.cache_ttl,
+            'rate_limit': lambda: self.rate_limit,
+            'max_concurrency': lambda: self.max_concurrency,
         }
 
+        return {field: getters[field]()
+                for field in co.first(fields, self.DEFAULT_FIELDS)}
+
     def get_url(self, username):
         ''' Interpolate a username into this site's URL. '''
         replacements = [username for i in range(0, self.url.count('%s'))]
         return self.url % tuple(replacements)
+
+
+def _isoformat(datetime_):
+    ''' Return `datetime_` in ISO-8601 format, or None. '''
+
+    return None if datetime_ is None else datetime_.isoformat()
+
+
+def _result_dict(result):
+    ''' Return the dictionary representation of a test result, or None. '''
+
+    return None if result is None else result.as_dict()
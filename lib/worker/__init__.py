@@ -3,16 +3,42 @@ This package contains workers that handle work placed on the message queues.
 '''
 
 import json
+from datetime import datetime
 
+import requests
 import rq
+from requests.adapters import HTTPAdapter
 
 import app.config
 import app.database
+import app.queue
+from model.configuration import ConfigurationCache
+from model.file import sync_files
+from worker.proxy_pool import ProxyPool
+from worker.splash import SplashClient
 
 
 _config = None
+_configuration = None
 _db = None
+_http_session = None
+_proxy_pool = None
 _redis = None
+_splash_client = None
+
+# Jobs that check sites for a username search.
+_search_jobs = ('worker.scrape.check_username',
+                'worker.scrape.search_username')
+
+
+def close():
+    ''' Close the connection pools of this worker process. '''
+
+    global _splash_client
+
+    if _splash_client is not None:
+        _splash_client.close()
+        _splash_client = None
 
 
 def finish_job():
@@ -31,6 +57,7 @@ def finish_job():
     })
 
     get_redis().publish('worker', notification)
+    sync_files()
 
 
 def get_config():
@@ -44,6 +71,20 @@ def get_config():
     return _config
 
 
+def get_configuration():
+    '''
+    Get the cached runtime configuration, i.e. the key/value pairs stored in
+    the database (as opposed to get_config(), which reads the INI files).
+    '''
+
+    global _configuration
+
+    if _configuration is None:
+        _configuration = ConfigurationCache(get_session, get_redis())
+
+    return _configuration
+
+
 def get_db():
     ''' Get a database handle. '''
 
@@ -56,12 +97,42 @@ def get_db():
     return _db
 
 
+def get_http_session():
+    '''
+    Get a pooled HTTP session for making direct requests to sites (i.e.
+    without Splash).
+    '''
+
+    global _http_session
+
+    if _http_session is None:
+        pool_size = get_config().getint('probe', 'pool_size')
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        _http_session = requests.Session()
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+
+    return _http_session
+
+
 def get_job():
     ''' Return the RQ job instance. '''
 
     return rq.get_current_job(connection=get_redis())
 
 
+def get_proxy_pool():
+    ''' Get the proxy pool for this worker process. '''
+
+    global _proxy_pool
+
+    if _proxy_pool is None:
+        _proxy_pool = ProxyPool(get_session, get_redis())
+
+    return _proxy_pool
+
+
 def get_redis():
     ''' Get a Redis connection handle. '''
 
@@ -74,6 +145,29 @@ def get_redis():
     return _redis
 
 
+def get_splash_client():
+    ''' Get the pooled Splash client for this worker process. '''
+
+    global _splash_client
+
+    if _splash_client is None:
+        splash_config = get_config()['splash']
+
+        try:
+            _splash_client = SplashClient(
+                pool_size=splash_config.getint('pool_size'),
+                connect_timeout=splash_config.getfloat('connect_timeout'),
+                read_timeout_margin=splash_config.getfloat(
+                    'read_timeout_margin'
+                ),
+                retries=splash_config.getint('retries')
+            )
+        except ValueError as e:
+            raise ValueError('Invalid [splash] configuration: {}'.format(e))
+
+    return _splash_client
+
+
 def get_session():
     ''' Get a database session (a.k.a. transaction). '''
 
@@ -86,7 +180,9 @@ def handle_exception(job, exc_type, exc_value, traceback):
 
     Note `return True` at the end of this function: this tells RQ to continue
     handling this exception. We only register this exception handler so that
-    we can send a notification to the client.
+    we can send a notification to the client, and so that the sites of a
+    failed username search job get error results (otherwise the search would
+    not complete until it times out).
     '''
 
     notification = json.dumps({
@@ -96,6 +192,18 @@ def handle_exception(job, exc_type, exc_value, traceback):
     })
 
     get_redis().publish('worker', notification)
+
+    if job.func_name in _search_jobs:
+        # Imported here because worker.scrape imports this package.
+        import worker.scrape
+
+        site_ids = job.kwargs.get('site_ids', [job.kwargs.get('site_id')])
+        worker.scrape.fail_sites.enqueue(
+            tracker_id=job.kwargs['tracker_id'],
+            site_ids=site_ids,
+            error='{}: {}'.format(exc_type.__name__, exc_value)
+        )
+
     return True
 
 
@@ -114,6 +222,64 @@ def init_job(job, description):
     get_redis().publish('worker', notification)
 
 
+def record_latency(latency):
+    '''
+    Record the latency (in seconds) of an attempt at the current job.
+
+    Retries inherit the latencies of previous attempts.
+    '''
+
+    job = get_job()
+    job.meta.setdefault('latencies', []).append(round(latency, 3))
+    job.save()
+
+
+def remaining_time():
+    '''
+    Return the number of seconds left before the current job times out, or
+    None if it has no timeout.
+    '''
+
+    job = get_job()
+
+    if job.timeout is None or job.started_at is None:
+        return None
+
+    elapsed = (datetime.utcnow() - job.started_at).total_seconds()
+
+    return max(0, int(job.timeout) - elapsed)
+
+
+def retry_job():
+    '''
+    Schedule another attempt at the current job on its retry queue.
+
+    Returns True if a retry was scheduled, or False if the job has no
+    attempts left.
+    '''
+
+    job = get_job()
+    max_backoff = get_config().getfloat('retry', 'max_backoff')
+    retry = app.queue.retry_job(job, max_backoff)
+
+    if retry is None:
+        return False
+
+    job.meta['retried_as'] = retry.id
+    job.save()
+
+    notification = json.dumps({
+        'id': job.id,
+        'status': 'retrying',
+        'queue': job.origin,
+        'retry_id': retry.id,
+        'attempt': retry.meta['attempt'],
+    })
+
+    get_redis().publish('worker', notification)
+    return True
+
+
 def start_job(total=None):
     ''' Mark the current job as started. '''
 
@@ -133,10 +299,16 @@ def start_job(total=None):
     get_redis().publish('worker', notification)
 
 
-def update_job(current):
-    ''' Update the current job with new progress information. '''
+def update_job(current, job=None):
+    '''
+    Update the current job with new progress information.
 
-    job = get_job()
+    RQ's current job is local to the thread that runs it, so other threads
+    must pass the `job`.
+    '''
+
+    if job is None:
+        job = get_job()
 
     if 'total' not in job.meta:
         raise ValueError('Cannot call update_job() because job does not have '
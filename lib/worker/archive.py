@@ -1,16 +1,34 @@
 import re
 import io
 import csv
+import fcntl
+import functools
 import json
+import logging
+import os
+import zipfile
 
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from sqlalchemy.orm import subqueryload
+from sqlalchemy import func
+from sqlalchemy.orm import lazyload, selectinload
 
+import app.config
+import coalesce as co
 import worker
 from app.queue import archive_queue, queueable
-from model import Archive, File, Result
+from app.tracker import Tracker
+from helper.functions import get_path
+from model import Archive, File, Result, ResultHtml
+from model.file import get_zip_writer
+
+_logger = logging.getLogger(__name__)
 
 _days_to_keep_archive = 7
+_yield_per = 100
+
+_config = app.config.get_config()
+_mode = _config.get('archive', 'mode')
 
 
 class ArchiveException(Exception):
@@ -20,13 +38,15 @@ class ArchiveException(Exception):
         self.message = message
 
 
-def results_csv_string(results):
+def results_csv_string(results, header=True):
     ''' Generate in-memory csv of the results and return it as a string. '''
 
     data = []
-    # Column headers
-    row = ['Site Name', 'Profile URL', 'Status', 'Screenshot', 'HTML']
-    data.append(row)
+
+    if header:
+        # Column headers
+        row = ['Site Name', 'Profile URL', 'Status', 'Screenshot', 'HTML']
+        data.append(row)
 
     # In-memory csv
     output = io.StringIO()
@@ -36,7 +56,7 @@ def results_csv_string(results):
     for result in results:
 
         if result.status == 'f':
-            html_filename = '{}.html'.format(result.site_name.replace(' ', ''))
+            html_filename = _html_filename(result)
         else:
             html_filename = None
 
@@ -44,7 +64,7 @@ def results_csv_string(results):
             result.site_name,
             result.site_url,
             result.status.value,
-            result.image_file.name,
+            co.member(result.image_file, 'name'),
             html_filename
         ])
 
@@ -53,47 +73,189 @@ def results_csv_string(results):
     return output.getvalue()
 
 
-def create_zip(filename, results, user_id):
+def result_counts(db_session, tracker_id):
+    '''
+    Return a dict of the number of a tracker's results with each status.
+    '''
+
+    query = (
+        db_session
+        .query(Result.status, func.count(Result.id))
+        .filter(Result.tracker_id == tracker_id)
+        .group_by(Result.status)
+    )
+
+    return {status.code: count for status, count in query}
+
+
+def zip_entries(db_session, filename, tracker_id):
     '''
-    Generate zip archive of results and return the file id.
+    Return the files and string files (as described in ``model.File``) of
+    the zip archive of a tracker's results.
 
     Adds screenshots and HTML for found results.
     Adds csv result summary.
+
+    Results are streamed without their HTML, which is instead fetched for
+    one result at a time while the archive is written. Their image files are
+    loaded for each batch of results, and their thumbnails (which archives
+    do not include) not at all.
     '''
 
-    db_session = worker.get_session()
     files = []
     str_files = []
+    csv_rows = [results_csv_string([])]
+
+    results = (
+        db_session
+        .query(Result)
+        .filter(Result.tracker_id == tracker_id)
+        .options(selectinload(Result.image_file),
+                 lazyload(Result.thumb_file))
+        .order_by(Result.id)
+        .yield_per(_yield_per)
+    )
 
     # Get images and HTML
     for result in results:
-        if result.status == 'f':
-            # Add the image file
-            files.append((result.image_file.name, result.image_file.relpath()))
-            # Add the HTML as a string file
-            html_filename = '{}.html'.format(result.site_name.replace(' ', ''))
-            html_file = (html_filename, result.html)
-            str_files.append(html_file)
-
-    # Generate in-memory results csv
-    csv_string = results_csv_string(results)
-    str_file = ('{}.csv'.format(filename), csv_string)
+        html = functools.partial(_fetch_html, db_session, result.id)
+        result_files, result_str_files = _result_entries(result, html)
+        files.extend(result_files)
+        str_files.extend(result_str_files)
+        csv_rows.append(results_csv_string([result], header=False))
+
+    # Add results csv
+    str_file = ('{}.csv'.format(filename), ''.join(csv_rows))
     str_files.append(str_file)
 
-    zip_file = File(name='{}.zip'.format(filename),
-                    mime='application/zip',
-                    zip_archive=True,
-                    zip_files=files,
-                    zip_str_files=str_files,
-                    user_id=user_id)
+    return files, str_files
+
+
+def stage_result(redis, tracker_id, result):
+    '''
+    Append the zip archive entries of a result to the tracker's staging
+    archive, and its CSV row to the tracker's staging CSV.
+
+    This is used in the "incremental" archive mode, so that the archive is
+    nearly complete by the time the last result arrives. Each result is
+    counted in its tracker. If one cannot be staged (e.g. because its image
+    is missing or the disk is full), then the error is logged rather than
+    raised, and ``create_archive()`` generates the archive from the
+    database instead.
+    '''
+
+    if _mode != 'incremental':
+        return
 
-    db_session.add(zip_file)
+    tracker = Tracker(redis)
+
+    try:
+        _stage_result(tracker_id, result)
+    except Exception:
+        _logger.exception('Could not stage result %d for archive of %s.'
+                          % (result.id, tracker_id))
+        tracker.record_staging(tracker_id, staged=False)
+    else:
+        tracker.record_staging(tracker_id, staged=True)
+
+
+def _stage_result(tracker_id, result):
+    ''' Append a result's entries to the tracker's staging files. '''
+
+    zip_path, csv_path = _staging_paths(tracker_id)
+    files, str_files = _result_entries(result, result.html)
+    data_dir = get_path('data')
+    zip_writer = get_zip_writer()
+
+    with _staging_lock(tracker_id):
+        with zipfile.ZipFile(zip_path, 'a') as zip_file:
+            for f in files:
+                zip_file.write(os.path.join(data_dir, f[1]),
+                               arcname=f[0],
+                               **_compression(zip_writer, f[0]))
+
+            for str_file in str_files:
+                zip_file.writestr(str_file[0],
+                                  str_file[1],
+                                  **_compression(zip_writer, str_file[0]))
+
+        header = not os.path.exists(csv_path)
+
+        with open(csv_path, 'a', newline='') as csv_file:
+            csv_file.write(results_csv_string([result], header=header))
+
+
+def zip_filename(username):
+    ''' Return the file name (without extension) of an archive. '''
+
+    return re.sub('[\W_]+', '', username)  # Strip non-alphanumeric char
+
+
+def finish_staged_zip(filename, tracker_id, user_id):
+    '''
+    Add the CSV summary to the tracker's staging archive, store the archive
+    and return its file id, or None if there is no staging archive.
+    '''
+
+    zip_path, csv_path = _staging_paths(tracker_id)
+
+    with _staging_lock(tracker_id):
+        if not os.path.exists(zip_path):
+            return None
+
+        with zipfile.ZipFile(zip_path, 'a') as staged_zip:
+            staged_zip.write(csv_path,
+                             arcname='{}.csv'.format(filename),
+                             **_compression(get_zip_writer(), csv_path))
+
+        db_session = worker.get_session()
+        zip_file = File.get_or_create(db_session,
+                                      name='{}.zip'.format(filename),
+                                      mime='application/zip',
+                                      source_path=zip_path,
+                                      user_id=user_id)
+
+        try:
+            db_session.commit()
+        except Exception as e:
+            raise ArchiveException(e)
+
+        # The lock file is kept: another worker may already have opened it
+        # and be waiting for the lock, which it would then hold on an
+        # unlinked file while a third worker locks a new one. Lock files are
+        # deleted with the expired staging files.
+        os.remove(csv_path)
+
+    return zip_file.id
+
+
+def create_zip(filename, tracker_id, user_id):
+    '''
+    Generate zip archive of a tracker's results and return the file id.
+    '''
+
+    db_session = worker.get_session()
+    files, str_files = zip_entries(db_session, filename, tracker_id)
+    zip_writer = get_zip_writer()
+    zip_file = File.get_or_create(db_session,
+                                  name='{}.zip'.format(filename),
+                                  mime='application/zip',
+                                  zip_archive=True,
+                                  zip_files=files,
+                                  zip_str_files=str_files,
+                                  user_id=user_id,
+                                  zip_writer=zip_writer)
 
     try:
         db_session.commit()
     except Exception as e:
         raise ArchiveException(e)
 
+    # Report the build time and compression ratio.
+    job = worker.get_job()
+    job.meta['zip'] = zip_writer.stats
+    job.save()
+
     return zip_file.id
 
 
@@ -111,38 +273,27 @@ def create_archive(username, category_id, tracker_id, user_id):
     redis = worker.get_redis()
     worker.start_job()
     db_session = worker.get_session()
-    found_count = 0
-    not_found_count = 0
-    error_count = 0
-
-    results = (
-        db_session
-        .query(Result)
-        .options(subqueryload(Result.image_file))
-        .filter(Result.tracker_id == tracker_id)
-        .all()
-    )
-    site_count = len(results)
+    counts = result_counts(db_session, tracker_id)
+    filename = zip_filename(username)
+    zip_file_id = None
 
-    # Generate zip file
-    filename = re.sub('[\W_]+', '', username)  # Strip non-alphanumeric char
-    zip_file_id = create_zip(filename, results, user_id)
+    # Results that are published concurrently may still be staging, and
+    # some may have failed to stage.
+    if _mode == 'incremental' and \
+            Tracker(redis).staging_complete(tracker_id):
+        zip_file_id = finish_staged_zip(filename, tracker_id, user_id)
 
-    for result in results:
-        if result.status == 'e':
-            error_count += 1
-        elif result.status == 'f':
-            found_count += 1
-        elif result.status == 'n':
-            not_found_count += 1
+    # Generate zip file, unless it is generated when it is downloaded.
+    if zip_file_id is None and _mode != 'on_demand':
+        zip_file_id = create_zip(filename, tracker_id, user_id)
 
     archive = Archive(tracker_id=tracker_id,
                       username=username,
                       category_id=category_id,
-                      site_count=site_count,
-                      found_count=found_count,
-                      not_found_count=not_found_count,
-                      error_count=error_count,
+                      site_count=sum(counts.values()),
+                      found_count=counts.get('f', 0),
+                      not_found_count=counts.get('n', 0),
+                      error_count=counts.get('e', 0),
                       zip_file_id=zip_file_id,
                       user_id=user_id)
 
@@ -161,6 +312,30 @@ def create_archive(username, category_id, tracker_id, user_id):
     worker.finish_job()
 
 
+@queueable(
+    queue=archive_queue,
+    timeout=60,
+    jobdesc='Caching archive.'
+)
+def cache_archive(archive_id):
+    """
+    Store the zip archive of an archive that is generated on download, so
+    that later downloads can be served from the data directory.
+    """
+
+    worker.start_job()
+    db_session = worker.get_session()
+    archive = db_session.query(Archive).get(archive_id)
+
+    if archive is not None and archive.zip_file_id is None:
+        archive.zip_file_id = create_zip(zip_filename(archive.username),
+                                         archive.tracker_id,
+                                         archive.user_id)
+        db_session.commit()
+
+    worker.finish_job()
+
+
 @queueable(
     queue=archive_queue,
     timeout=60,
@@ -175,4 +350,109 @@ def delete_expired_archives():
     expiry = datetime.utcnow() - timedelta(days=_days_to_keep_archive)
     db_session.query(Archive).filter(Archive.created_at < expiry).delete()
     db_session.commit()
+
+    # Delete staging archives of searches that never finished.
+    staging_dir = get_path('data/staging')
+
+    if os.path.isdir(staging_dir):
+        for name in os.listdir(staging_dir):
+            path = os.path.join(staging_dir, name)
+
+            if datetime.utcfromtimestamp(os.path.getmtime(path)) < expiry:
+                os.remove(path)
+
     worker.finish_job()
+
+
+def _compression(zip_writer, name):
+    '''
+    Return the ``zipfile`` compression arguments for the entry called
+    ``name`` according to the compression policy of ``zip_writer``.
+    '''
+
+    if zip_writer.compressible(name):
+        return {'compress_type': zipfile.ZIP_DEFLATED,
+                'compresslevel': zip_writer.deflate_level}
+    else:
+        return {'compress_type': zipfile.ZIP_STORED}
+
+
+def _html_filename(result):
+    ''' Return the name of a result's HTML file in a zip archive. '''
+
+    return '{}.html'.format(result.site_name.replace(' ', ''))
+
+
+def _fetch_html(db_session, result_id):
+    ''' Return the HTML of a result. '''
+
+    html_row = db_session.query(ResultHtml).get(result_id)
+
+    return None if html_row is None else html_row.get_html()
+
+
+def _result_entries(result, html):
+    '''
+    Return the files and string files of a result's zip archive entries.
+
+    ``html`` is the result's HTML, or a function that returns it.
+    '''
+
+    files = []
+    str_files = []
+
+    if result.status == 'f':
+        # Add the image file (direct HTTP results have no screenshot)
+        if result.image_file is not None:
+            files.append((result.image_file.name,
+                          result.image_file.relpath()))
+
+        # Add the HTML as a string file
+        str_files.append((_html_filename(result), html))
+
+    return files, str_files
+
+
+@contextmanager
+def _staging_lock(tracker_id):
+    '''
+    Hold an exclusive lock on a tracker's staging files, which may be
+    written by several workers.
+    '''
+
+    with open(_staging_lock_path(tracker_id), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _staging_lock_path(tracker_id):
+    ''' Return the path of a tracker's staging lock file. '''
+
+    return os.path.join(_staging_dir(), '{}.lock'.format(tracker_id))
+
+
+def _staging_paths(tracker_id):
+    ''' Return the paths of a tracker's staging archive and CSV. '''
+
+    staging_dir = _staging_dir()
+
+    return (os.path.join(staging_dir, '{}.zip'.format(tracker_id)),
+            os.path.join(staging_dir, '{}.csv'.format(tracker_id)))
+
+
+def _staging_dir():
+    '''
+    Return the directory of staging archives, creating it if necessary.
+
+    It is in the data directory so that finished archives can be moved into
+    the file store.
+    '''
+
+    staging_dir = get_path('data/staging')
+    os.makedirs(staging_dir, exist_ok=True)
+
+    return staging_dir
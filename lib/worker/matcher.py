@@ -0,0 +1,132 @@
+'''
+Compiled matchers for testing page HTML against a site's match expression.
+
+Compiling a match expression (e.g. translating CSS to XPath) is expensive
+compared to evaluating it, so compiled matchers are cached per process.
+'''
+
+import lxml.etree
+import parsel
+from cssselect import SelectorError
+from parsel.csstranslator import HTMLTranslator
+
+# The same EXSLT namespaces that parsel registers for XPath queries.
+_namespaces = {
+    're': 'http://exslt.org/regular-expressions',
+    'set': 'http://exslt.org/sets',
+}
+
+# Characters that may be entity-encoded in raw HTML.
+_encodable_chars = set('&<>"\'')
+
+_cache_size = 1000
+_cache = {}
+_css_translator = HTMLTranslator()
+
+
+class Matcher:
+    ''' Tests page HTML against a compiled match expression. '''
+
+    def __init__(self, match_type, match_expr):
+        '''
+        Constructor.
+
+        Raises ValueError if ``match_type`` is unknown or ``match_expr`` does
+        not compile.
+        '''
+
+        self.match_type = match_type
+        self.match_expr = match_expr
+        self._tokens = []
+
+        try:
+            if match_type == 'css':
+                xpath = _css_translator.css_to_xpath(match_expr)
+            elif match_type == 'text':
+                xpath = _css_translator.css_to_xpath(
+                    ':not(script):not(style)::text'
+                )
+                self._tokens = _raw_tokens(match_expr)
+            elif match_type == 'xpath':
+                xpath = match_expr
+            else:
+                raise ValueError('Unknown match_type: {}'.format(match_type))
+
+            self._xpath = lxml.etree.XPath(xpath,
+                                           namespaces=_namespaces,
+                                           smart_strings=False)
+        except (SelectorError, lxml.etree.XPathError) as e:
+            raise ValueError('Invalid {} expression "{}": {}'
+                             .format(match_type, match_expr, e))
+
+    def match(self, html):
+        ''' Return True if ``html`` matches the expression. '''
+
+        # A text match cannot succeed unless every word of the expression
+        # appears verbatim in the raw HTML, so skip parsing when one is
+        # missing.
+        for token in self._tokens:
+            if token not in html:
+                return False
+
+        nodes = self._xpath(parsel.Selector(text=html).root)
+
+        if self.match_type == 'text':
+            stripped = (node.strip() for node in nodes)
+            text = ' '.join(node for node in stripped if node != '') + ' '
+            return self.match_expr in text
+        elif isinstance(nodes, list):
+            return len(nodes) > 0
+        else:
+            # Like parsel, treat a scalar XPath result as a single match.
+            return True
+
+
+def compile_matcher(match_type, match_expr):
+    '''
+    Compile a matcher without caching it, e.g. to validate an expression.
+
+    Raises ValueError if the expression is invalid.
+    '''
+
+    return Matcher(match_type, match_expr)
+
+
+def get_matcher(site):
+    '''
+    Return the cached, compiled matcher for ``site``, or None if the site
+    does not have a match expression.
+    '''
+
+    if site.match_expr is None:
+        return None
+
+    key = (site.id, site.match_type, site.match_expr)
+
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+
+    if len(_cache) >= _cache_size:
+        _cache.clear()
+
+    matcher = Matcher(site.match_type, site.match_expr)
+    _cache[key] = matcher
+
+    return matcher
+
+
+def _raw_tokens(match_expr):
+    '''
+    Return the words of a text match expression that must appear verbatim in
+    the raw HTML of any matching page.
+
+    Returns an empty list (i.e. no pre-filtering) if the expression contains
+    characters that could be entity-encoded in HTML.
+    '''
+
+    if not match_expr.isascii() or _encodable_chars & set(match_expr):
+        return []
+
+    return match_expr.split()
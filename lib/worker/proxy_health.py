@@ -0,0 +1,143 @@
+'''
+Periodic health checks of proxies.
+
+Every proxy is asked to fetch a canary URL (e.g. the canary endpoint of
+this application's public URL). Proxies that fail several checks in a row
+are deactivated, and proxies that were deactivated this way are reactivated
+once they pass several checks in a row. Proxies deactivated by an
+administrator are not checked. There is no default canary URL, because a
+URL that proxies cannot reach would deactivate all of them: until one is
+configured, proxies are not checked.
+'''
+
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import aiohttp
+from sqlalchemy import or_
+
+import app.config
+import worker
+from app.queue import archive_queue, queueable
+from model import Proxy
+from worker.proxy_pool import proxy_url
+
+_config = app.config.get_config()
+_canary_url = _config.get('proxy_health', 'canary_url')
+_timeout = _config.getfloat('proxy_health', 'timeout')
+_concurrency = _config.getint('proxy_health', 'concurrency')
+_alpha = _config.getfloat('proxy_health', 'alpha')
+_disable_after = _config.getint('proxy_health', 'disable_after')
+_enable_after = _config.getint('proxy_health', 'enable_after')
+
+
+@queueable(
+    queue=archive_queue,
+    timeout=300,
+    jobdesc='Checking proxies.'
+)
+def check_proxies():
+    '''
+    Check every proxy against the canary URL, update its statistics, and
+    deactivate or reactivate it as necessary.
+
+    Does nothing if ``[proxy_health] canary_url`` is not set.
+    '''
+
+    worker.start_job()
+
+    if not _canary_url:
+        worker.finish_job()
+        return
+
+    redis = worker.get_redis()
+    db_session = worker.get_session()
+    proxies = db_session.query(Proxy).filter(or_(
+        Proxy.active == True, # noqa
+        Proxy.auto_disabled == True # noqa
+    )).all()
+
+    outcomes = asyncio.run(_probe_proxies([proxy_url(p) for p in proxies]))
+    changed = []
+
+    for proxy, (success, latency) in zip(proxies, outcomes):
+        if _update_proxy(proxy, success, latency):
+            changed.append(proxy)
+
+    db_session.commit()
+
+    # Notify clients and worker proxy pools of activation changes.
+    for proxy in changed:
+        message = {
+            'proxy': proxy.as_dict(),
+            'status': 'updated',
+            'resource': None,
+        }
+        redis.publish('proxy', json.dumps(message))
+
+    worker.finish_job()
+
+
+async def _probe_proxies(urls):
+    '''
+    Fetch the canary URL through each proxy in `urls` concurrently.
+
+    Returns a list of (success, latency) tuples in the same order as `urls`.
+    '''
+
+    semaphore = asyncio.Semaphore(_concurrency)
+    timeout = aiohttp.ClientTimeout(total=_timeout)
+
+    async with aiohttp.ClientSession(timeout=timeout) as http_session:
+        async def probe(url):
+            async with semaphore:
+                started = time.time()
+
+                try:
+                    async with http_session.get(_canary_url,
+                                                proxy=url) as response:
+                        await response.read()
+                        success = response.status < 400
+                except Exception:
+                    success = False
+
+                return success, time.time() - started
+
+        return await asyncio.gather(*[probe(url) for url in urls])
+
+
+def _update_proxy(proxy, success, latency):
+    '''
+    Update `proxy` with the outcome of a check.
+
+    Returns True if the proxy was deactivated or reactivated.
+    '''
+
+    was_active = proxy.active
+    proxy.checked_at = datetime.utcnow()
+    proxy.failure_rate += _alpha * ((0 if success else 1) - proxy.failure_rate)
+
+    if success:
+        if proxy.latency is None:
+            proxy.latency = latency
+        else:
+            proxy.latency += _alpha * (latency - proxy.latency)
+
+        proxy.consecutive_failures = 0
+        proxy.consecutive_successes += 1
+
+        if proxy.auto_disabled and \
+                proxy.consecutive_successes >= _enable_after:
+            proxy.active = True
+            proxy.auto_disabled = False
+    else:
+        proxy.consecutive_failures += 1
+        proxy.consecutive_successes = 0
+
+        if proxy.active and proxy.consecutive_failures >= _disable_after:
+            proxy.active = False
+            proxy.auto_disabled = True
+
+    return proxy.active != was_active
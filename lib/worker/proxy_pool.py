@@ -0,0 +1,267 @@
+'''
+A health-scored pool of proxies.
+
+Each worker process keeps the active proxies in memory and reloads them when
+a message is published on the ``proxy`` channel (e.g. by ``ProxiesView``).
+The outcome of every proxied request is recorded in Redis, so that all
+workers share each proxy's success rate and latency. Proxies are picked at
+random, weighted by their success rate and speed, and a proxy that fails
+several times in a row is quarantined for a while.
+'''
+
+import random
+import time
+
+import app.config
+import coalesce as co
+from model import Proxy
+
+KEY_PREFIX = 'proxy_pool'
+
+_config = app.config.get_config()
+_stats_interval = _config.getfloat('proxy_pool', 'stats_interval')
+_alpha = _config.getfloat('proxy_pool', 'alpha')
+_quarantine_after = _config.getint('proxy_pool', 'quarantine_after')
+_quarantine_time = _config.getint('proxy_pool', 'quarantine_time')
+_min_success_rate = _config.getfloat('proxy_pool', 'min_success_rate')
+_default_latency = _config.getfloat('proxy_pool', 'default_latency')
+
+# Update a proxy's moving averages and quarantine it after too many
+# consecutive failures. (Numbers are stored as strings because Redis
+# truncates Lua numbers to integers.)
+#
+# KEYS: stats, quarantine
+# ARGV: success (1 or 0), latency (ignored on failure), alpha,
+#       quarantine after, quarantine time
+_record_script = '''
+local success = tonumber(ARGV[1])
+local alpha = tonumber(ARGV[3])
+local rate = tonumber(redis.call('hget', KEYS[1], 'success_rate') or '1')
+
+rate = rate + alpha * (success - rate)
+redis.call('hset', KEYS[1], 'success_rate', tostring(rate))
+
+if success == 1 then
+    local latency = tonumber(ARGV[2])
+    local average = redis.call('hget', KEYS[1], 'latency')
+
+    if average then
+        latency = tonumber(average) + alpha * (latency - tonumber(average))
+    end
+
+    redis.call('hset', KEYS[1], 'latency', tostring(latency))
+    redis.call('hincrby', KEYS[1], 'successes', 1)
+    redis.call('hset', KEYS[1], 'consecutive_failures', 0)
+    return 0
+end
+
+redis.call('hincrby', KEYS[1], 'failures', 1)
+local failures = redis.call('hincrby', KEYS[1], 'consecutive_failures', 1)
+
+if failures >= tonumber(ARGV[4]) then
+    redis.call('setex', KEYS[2], ARGV[5], 1)
+    redis.call('hset', KEYS[1], 'consecutive_failures', 0)
+end
+
+return failures
+'''
+
+
+class ProxyPool:
+    '''
+    A process-local pool of the active proxies.
+
+    The proxies are loaded the first time a proxy is requested, and reloaded
+    after any message on the ``proxy`` channel. Their health statistics are
+    read from Redis at most once every ``[proxy_pool] stats_interval``
+    seconds.
+    '''
+
+    CHANNEL = 'proxy'
+
+    def __init__(self, session_factory, redis):
+        '''
+        Constructor.
+
+        ``session_factory`` is a callable that returns a new database session.
+        '''
+
+        self._session_factory = session_factory
+        self._redis = redis
+        self._record = redis.register_script(_record_script)
+        self._proxies = None
+        self._stats = {}
+        self._stats_loaded_at = 0
+
+        # Subscribe before loading so that no update can be missed.
+        self._pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.CHANNEL)
+
+    def choose(self, exclude=()):
+        '''
+        Return the URL of a healthy proxy, or None if there are no active
+        proxies.
+
+        Proxies whose URLs are in ``exclude`` are only returned if there are
+        no other proxies. Quarantined proxies are only returned if all of the
+        proxies are quarantined.
+        '''
+
+        self._refresh()
+
+        if len(self._proxies) == 0:
+            return None
+
+        candidates = [p for p in self._proxies if p['url'] not in exclude]
+        healthy = [p for p in _first_nonempty(candidates, self._proxies)
+                   if not self._stats[p['id']]['quarantined']]
+        candidates = _first_nonempty(healthy, candidates, self._proxies)
+        weights = [self._weight(p['id']) for p in candidates]
+
+        return random.choices(candidates, weights)[0]['url']
+
+    def record(self, proxy_url, success, latency):
+        '''
+        Record the outcome of a request made through the proxy at
+        ``proxy_url``.
+
+        ``success`` is False if the request failed in a way that may be the
+        proxy's fault, e.g. a connection error or timeout.
+        '''
+
+        self._refresh()
+        proxy_id = self._ids_by_url.get(proxy_url)
+
+        if proxy_id is None:
+            # The proxy was deleted since this request was made.
+            return
+
+        self._record(keys=[_stats_key(proxy_id), _quarantine_key(proxy_id)],
+                     args=[1 if success else 0,
+                           latency,
+                           _alpha,
+                           _quarantine_after,
+                           _quarantine_time])
+
+    def invalidate(self):
+        ''' Discard the proxies so that they are reloaded on next use. '''
+
+        self._proxies = None
+
+    def _refresh(self):
+        '''
+        Reload the proxies if they are missing or have been invalidated, and
+        reload the statistics if they are stale.
+        '''
+
+        while self._pubsub.get_message() is not None:
+            self.invalidate()
+
+        if self._proxies is None:
+            session = self._session_factory()
+
+            try:
+                query = session.query(Proxy).filter(Proxy.active == True) # noqa
+                self._proxies = [{'id': p.id, 'url': proxy_url(p)}
+                                 for p in query]
+            finally:
+                session.close()
+
+            self._ids_by_url = {p['url']: p['id'] for p in self._proxies}
+            self._stats_loaded_at = 0
+
+        if time.time() - self._stats_loaded_at > _stats_interval:
+            proxy_ids = [p['id'] for p in self._proxies]
+            self._stats = get_proxy_stats(self._redis, proxy_ids)
+            self._stats_loaded_at = time.time()
+            latencies = [s['latency'] for s in self._stats.values()
+                         if s['latency'] is not None]
+
+            # Give untried proxies an average chance.
+            if len(latencies) > 0:
+                self._untried_latency = sum(latencies) / len(latencies)
+            else:
+                self._untried_latency = _default_latency
+
+    def _weight(self, proxy_id):
+        '''
+        Return the selection weight of a proxy: its success rate divided by
+        its average latency.
+        '''
+
+        stats = self._stats[proxy_id]
+        latency = co.first(stats['latency'], self._untried_latency)
+        success_rate = max(stats['success_rate'], _min_success_rate)
+
+        return success_rate / max(latency, 0.001)
+
+
+def get_proxy_stats(redis, proxy_ids):
+    '''
+    Return a dict of health statistics for each proxy in ``proxy_ids``.
+    '''
+
+    pipeline = redis.pipeline()
+
+    for proxy_id in proxy_ids:
+        pipeline.hgetall(_stats_key(proxy_id))
+        pipeline.exists(_quarantine_key(proxy_id))
+
+    replies = pipeline.execute()
+    stats = {}
+
+    for index, proxy_id in enumerate(proxy_ids):
+        raw = {k.decode('ascii'): v.decode('ascii')
+               for k, v in replies[2 * index].items()}
+        latency = raw.get('latency')
+
+        stats[proxy_id] = {
+            'success_rate': float(raw.get('success_rate', 1)),
+            'latency': None if latency is None else float(latency),
+            'successes': int(raw.get('successes', 0)),
+            'failures': int(raw.get('failures', 0)),
+            'consecutive_failures': int(raw.get('consecutive_failures', 0)),
+            'quarantined': bool(replies[2 * index + 1]),
+        }
+
+    return stats
+
+
+def proxy_url(proxy):
+    ''' Return the URL of ``proxy``. '''
+
+    url = '{}://'.format(proxy.protocol)
+
+    if proxy.username:
+        url += '{}:'.format(proxy.username)
+
+        if proxy.password:
+            url += proxy.password
+
+        url += '@'
+
+    url += '{}:{}'.format(proxy.host, proxy.port)
+
+    return url
+
+
+def _first_nonempty(*lists):
+    ''' Return the first non-empty list in ``lists``. '''
+
+    for list_ in lists:
+        if len(list_) > 0:
+            return list_
+
+    return lists[-1]
+
+
+def _quarantine_key(proxy_id):
+    ''' Return the Redis key that marks a proxy as quarantined. '''
+
+    return '{}:quarantine:{}'.format(KEY_PREFIX, proxy_id)
+
+
+def _stats_key(proxy_id):
+    ''' Return the Redis key for a proxy's statistics. '''
+
+    return '{}:stats:{}'.format(KEY_PREFIX, proxy_id)
@@ -0,0 +1,121 @@
+'''
+A result cache shared by all users.
+
+When a username is checked on a site, the ID of the saved result is cached
+in Redis so that checks of the same username on the same site within the
+site's cache TTL can reuse it instead of rendering the page again.
+
+Cache keys include a hash of the site definition, so editing a site (e.g.
+changing its URL or match expression) implicitly invalidates its cached
+results.
+'''
+
+import hashlib
+import json
+import time
+
+import app.config
+from model import Result
+
+KEY_PREFIX = 'result_cache'
+
+_config = app.config.get_config()
+_default_ttl = _config.getint('result_cache', 'default_ttl')
+
+
+def get_cached_result(redis, db_session, site, username, max_age=None):
+    '''
+    Return the cached result of checking `username` on `site`, or None if
+    there is no fresh result.
+
+    If `max_age` is not None, then a cached result older than `max_age`
+    seconds is ignored. (A `max_age` of 0 always ignores the cache.)
+    '''
+
+    if max_age == 0 or get_ttl(site) <= 0:
+        return None
+
+    key = _cache_key(site, username)
+    entry = redis.get(key)
+
+    if entry is None:
+        return None
+
+    entry = json.loads(entry.decode('utf8'))
+
+    if max_age is not None and time.time() - entry['cached_at'] > max_age:
+        return None
+
+    result = db_session.query(Result).get(entry['result_id'])
+
+    if result is None:
+        # The result has been deleted, e.g. because it expired.
+        redis.delete(key)
+
+    return result
+
+
+def cache_result(redis, site, username, result):
+    '''
+    Cache `result` as the result of checking `username` on `site`.
+
+    Error results are not cached.
+    '''
+
+    ttl = get_ttl(site)
+
+    if ttl <= 0 or result.status == 'e':
+        return
+
+    entry = json.dumps({
+        'result_id': result.id,
+        'cached_at': time.time(),
+    })
+
+    redis.setex(_cache_key(site, username), ttl, entry)
+
+
+def get_ttl(site):
+    '''
+    Return the number of seconds that results for `site` stay fresh.
+    '''
+
+    if site.cache_ttl is None:
+        return _default_ttl
+
+    return site.cache_ttl
+
+
+def site_version(site):
+    '''
+    Return a hash of the parts of the site definition that affect the result
+    of a username check.
+    '''
+
+    definition = json.dumps({
+        'url': site.url,
+        'status_code': site.status_code,
+        'match_type': site.match_type,
+        'match_expr': site.match_expr,
+        'headers': site.headers,
+        'censor_images': site.censor_images,
+        'wait_time': site.wait_time,
+        'use_proxy': site.use_proxy,
+        'probe_mode': site.probe_mode,
+    }, sort_keys=True, default=str)
+
+    return hashlib.sha1(definition.encode('utf8')).hexdigest()
+
+
+def _cache_key(site, username):
+    '''
+    Return the Redis key for `username` on `site`.
+
+    Usernames are case sensitive on some sites, so they are not normalized
+    (like the URLs and singleflight keys of checks).
+    '''
+
+    return '{}:{}:{}:{}'.format(KEY_PREFIX,
+                                site.id,
+                                site_version(site),
+                                username)
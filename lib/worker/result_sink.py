@@ -0,0 +1,366 @@
+'''
+Write scrape results to the database in batches.
+
+In the "batched" result mode (see ``[results] mode``), scrape workers do not
+commit the results they save. Instead they push them onto a Redis list, and
+a single writer process (``bin/run-result-writer.py``) pops them in batches
+and inserts each batch -- files, results and HTML -- in one transaction.
+Users are charged for a result (see ``app.credits``) and clients are notified
+of it only once its batch is committed.
+
+Result IDs are taken from the database sequence when results are pushed, so
+that workers can share and cache them right away. Until the writer commits a
+result, other workers that look it up do not find it and check the page
+themselves.
+
+Popped batches are kept in a second list until they are committed, and the
+writer writes that list again when it starts. Results that are already
+in the database are skipped, so a batch is never written twice (although the
+clients may miss the notifications of a batch that was being written when the
+writer stopped).
+'''
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+import dateutil.parser
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+import app.config
+import coalesce as co
+import worker.archive
+from app.credits import CreditLedger
+from app.tracker import Tracker
+from model import File, Result, ResultHtml, Site
+from worker.result_cache import cache_result
+
+KEY_PREFIX = 'result_sink'
+
+_config = app.config.get_config()
+_archive_timeout = _config.get('redis_worker', 'archive_timeout')
+
+# Move up to ARGV[1] records from the head of the queue to the tail of the
+# processing list, and return them.
+#
+# KEYS: queue, processing list
+# ARGV: batch size
+_pop_script = '''
+local records = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+
+if #records > 0 then
+    redis.call('ltrim', KEYS[1], #records, -1)
+    redis.call('rpush', KEYS[2], unpack(records))
+end
+
+return records
+'''
+
+
+class ResultSink:
+    '''
+    A Redis list of results waiting to be written to the database.
+    '''
+
+    def __init__(self, redis):
+        ''' Constructor. '''
+
+        self.redis = redis
+        self._queue_key = '{}:queue'.format(KEY_PREFIX)
+        self._processing_key = '{}:processing'.format(KEY_PREFIX)
+        self._pop = redis.register_script(_pop_script)
+
+    def ack(self):
+        ''' Forget the popped records, once they are written. '''
+
+        self.redis.delete(self._processing_key)
+
+    def pending(self):
+        '''
+        Return the records that were popped but never acknowledged, e.g.
+        because the writer stopped while it was writing them.
+        '''
+
+        return self._decode(self.redis.lrange(self._processing_key, 0, -1))
+
+    def pop(self, size):
+        ''' Pop up to `size` records, without waiting. '''
+
+        return self._decode(self._pop(keys=[self._queue_key,
+                                            self._processing_key],
+                                      args=[size]))
+
+    def push(self, result, image_file, thumb_file, cache=False):
+        '''
+        Push an unsaved `result`, whose ID must already be set, for the
+        writer to save.
+
+        The image and thumbnail files may be saved (e.g. the error image) or
+        unsaved, in which case the writer saves or reuses an identical file.
+        If `cache`, then the result is added to the result cache when it is
+        saved.
+        '''
+
+        html_row = result.html_row
+
+        record = {
+            'id': result.id,
+            'tracker_id': result.tracker_id,
+            'site_id': result.site_id,
+            'site_name': result.site_name,
+            'site_url': result.site_url,
+            'status': result.status,
+            'username': result.username,
+            'error': result.error,
+            'user_id': result.user_id,
+            'created_at': co.first(result.created_at, datetime.utcnow)
+                            .isoformat(),
+            'html': None,
+            'image_file': _file_record(image_file),
+            'thumb_file': _file_record(thumb_file),
+            'cache': cache,
+        }
+
+        if html_row is not None:
+            record['html'] = base64.b64encode(html_row.content) \
+                                   .decode('ascii')
+
+        self.redis.rpush(self._queue_key, json.dumps(record))
+
+    def _decode(self, records):
+        ''' Decode records read from Redis. '''
+
+        return [json.loads(record.decode('utf8')) for record in records]
+
+
+def next_result_id(db_session):
+    ''' Take a result ID from the database sequence. '''
+
+    return db_session.query(func.nextval('result_id_seq')).scalar()
+
+
+def publish_result(redis, result):
+    '''
+    Record a saved result in its tracker, stage its archive entries (see
+    ``worker.archive.stage_result()``), charge the user for it (error
+    results and test searches are free) and notify clients.
+
+    Results that the tracker does not expect, e.g. a second result for a
+    site or a result for a search that timed out, are ignored. When this is
+    the last result for its tracker, the credits still reserved for it are
+    released and an archive job is queued.
+    '''
+
+    tracker = Tracker(redis)
+
+    if not tracker.expects(result.tracker_id, result.site_id):
+        return
+
+    result_dict = result.as_dict()
+    progress = tracker.record(result.tracker_id,
+                              result.site_id,
+                              result_dict['status'])
+
+    if progress is None:
+        return
+
+    # Only the recorded result of each site is staged. (The archive job
+    # checks that every site was staged before it uses the staged archive.)
+    worker.archive.stage_result(redis, result.tracker_id, result)
+
+    ledger = CreditLedger(redis)
+
+    if not progress['test']:
+        ledger.charge(result.user_id,
+                      result.tracker_id,
+                      charged=result_dict['status'] != 'e')
+
+    result_dict['current'] = progress['current']
+    result_dict['total'] = progress['total']
+    redis.publish('result', json.dumps(result_dict))
+
+    # If this username search is complete, then queue an archive job.
+    if progress['complete']:
+        ledger.release(result.user_id, result.tracker_id)
+        search = tracker.get(result.tracker_id)
+        description = 'Archiving results ' \
+                      'for username "{}"'.format(result.username)
+        worker.archive.create_archive.enqueue(
+            username=result.username,
+            category_id=search['category_id'],
+            tracker_id=result.tracker_id,
+            jobdesc=description,
+            timeout=_archive_timeout,
+            user_id=result.user_id
+        )
+
+
+def publish_results(db_session, redis, records):
+    '''
+    Publish the results of written `records` (see ``publish_result()``) and
+    add them to the result cache.
+    '''
+
+    if len(records) == 0:
+        return
+
+    ids = [record['id'] for record in records]
+    results = {result.id: result for result in
+               db_session.query(Result).filter(Result.id.in_(ids))}
+    site_ids = {record['site_id'] for record in records if record['cache']}
+    sites = {site.id: site for site in
+             db_session.query(Site).filter(Site.id.in_(site_ids))}
+
+    for record in records:
+        result = results[record['id']]
+
+        if record['cache'] and result.site_id in sites:
+            cache_result(redis, sites[result.site_id], result.username, result)
+
+        publish_result(redis, result)
+
+
+def write_results(db_session, records):
+    '''
+    Save the results of `records` in one transaction.
+
+    Results that are already saved are skipped, and so are the files that
+    were added for them. Returns the records of the results that are saved.
+    '''
+
+    if len(records) == 0:
+        return []
+
+    file_ids, new_file_ids = _file_ids(db_session, records)
+    rows = []
+
+    for record in records:
+        rows.append({
+            'id': record['id'],
+            'tracker_id': record['tracker_id'],
+            'site_id': record['site_id'],
+            'site_name': record['site_name'],
+            'site_url': record['site_url'],
+            'status': record['status'],
+            'username': record['username'],
+            'error': record['error'],
+            'user_id': record['user_id'],
+            'created_at': dateutil.parser.parse(record['created_at']),
+            'image_file_id': file_ids.get(_file_key(record['image_file'])),
+            'thumb_file_id': file_ids.get(_file_key(record['thumb_file'])),
+        })
+
+    statement = insert(Result.__table__) \
+        .values(rows) \
+        .on_conflict_do_nothing(constraint='tracker_id_site_url') \
+        .returning(Result.__table__.c.id)
+    saved_ids = {row[0] for row in db_session.execute(statement)}
+    saved = [record for record in records if record['id'] in saved_ids]
+
+    # Delete the added files that no saved result refers to.
+    for row in rows:
+        if row['id'] in saved_ids:
+            new_file_ids.discard(row['image_file_id'])
+            new_file_ids.discard(row['thumb_file_id'])
+
+    if len(new_file_ids) > 0:
+        db_session.query(File) \
+                  .filter(File.id.in_(new_file_ids)) \
+                  .delete(synchronize_session=False)
+
+    html_rows = [{'result_id': record['id'],
+                  'encoding': 'zlib',
+                  'content': base64.b64decode(record['html'])}
+                 for record in saved if record['html'] is not None]
+
+    if len(html_rows) > 0:
+        db_session.execute(insert(ResultHtml.__table__).values(html_rows))
+
+    db_session.commit()
+
+    return saved
+
+
+def _file_ids(db_session, records):
+    '''
+    Return a dict of the IDs of the files of `records`, keyed by
+    ``_file_key()``, and a set of the IDs of the files that were added.
+
+    Unsaved files are matched to an identical saved file (as in
+    ``File.get_or_create()``), or else saved.
+    '''
+
+    file_ids = {}
+    new_file_ids = set()
+    unsaved = {}
+
+    for record in records:
+        for file_ in (record['image_file'], record['thumb_file']):
+            if file_ is None:
+                continue
+            elif 'id' in file_:
+                file_ids[_file_key(file_)] = file_['id']
+            else:
+                unsaved[_file_key(file_)] = file_
+
+    if len(unsaved) == 0:
+        return file_ids, new_file_ids
+
+    columns = (File.hash, File.name, File.mime, File.user_id)
+    query = db_session.query(File.id, *columns) \
+                      .filter(tuple_(*columns).in_(list(unsaved))) \
+                      .filter(File.access_type == 'private')
+
+    for id_, *key in query:
+        key = tuple(key)
+        file_ids[key] = id_
+        unsaved.pop(key, None)
+
+    if len(unsaved) > 0:
+        statement = insert(File.__table__) \
+            .values([{'hash': key[0],
+                      'name': key[1],
+                      'mime': key[2],
+                      'user_id': key[3],
+                      'access_type': 'private'}
+                     for key in unsaved]) \
+            .returning(File.__table__.c.id, *columns)
+
+        for id_, *key in db_session.execute(statement):
+            file_ids[tuple(key)] = id_
+            new_file_ids.add(id_)
+
+    return file_ids, new_file_ids
+
+
+def _file_key(file_):
+    '''
+    Return the key of a file record: its ID if it is saved, or else a tuple
+    of its hash, name, MIME type and owner.
+    '''
+
+    if file_ is None:
+        return None
+    elif 'id' in file_:
+        return file_['id']
+    else:
+        return (binascii.unhexlify(file_['hash']),
+                file_['name'],
+                file_['mime'],
+                file_['user_id'])
+
+
+def _file_record(file_):
+    ''' Return a record of a saved or unsaved file, or None. '''
+
+    if file_ is None:
+        return None
+    elif file_.id is not None:
+        return {'id': file_.id}
+    else:
+        return {'hash': binascii.hexlify(file_.hash).decode('ascii'),
+                'name': file_.name,
+                'mime': file_.mime,
+                'user_id': file_.user_id}
@@ -1,20 +1,37 @@
-import base64
+import asyncio
+import functools
 import json
-import parsel
+import os
+import random
+import time
+import aiohttp
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from sqlalchemy.sql.expression import func
-from sqlalchemy.orm.exc import NoResultFound
 from urllib.parse import urljoin
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
 import app.config
+import coalesce as co
 import worker
-import worker.archive
-from app.queue import scrape_queue, queueable
+from app.queue import (archive_queue,
+                       scrape_queue,
+                       scrape_retry_queue,
+                       queueable)
+from app.tracker import Tracker
 from helper.functions import random_string
-from model import File, Result, Site, Proxy, User
-from model.configuration import get_config
+from model import File, Result, Site, User
+from model.file import remove_unused_content
+from worker.matcher import get_matcher
+from worker.screenshot import process_screenshot
+from worker.result_cache import cache_result, get_cached_result, site_version
+from worker.result_sink import next_result_id, publish_result, ResultSink
+from worker.singleflight import Flight
+from worker.throttle import HostThrottle
 
 USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:40.0) '\
              'Gecko/20100101 Firefox/40.1'
@@ -22,12 +39,27 @@ USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:40.0) '\
 _config = app.config.get_config()
 _redis_worker = dict(_config.items('redis_worker'))
 _days_to_keep_result = 7
+_result_mode = _config.get('results', 'mode')
 _censored_image_name = _config.get('images', 'censored_image')
 _error_image_name = _config.get('images', 'error_image')
 _permanent_images = [
     _censored_image_name,
     _error_image_name
 ]
+_probe_timeout = _config.getfloat('probe', 'timeout')
+_throttle_max_wait = _config.getfloat('throttle', 'max_wait')
+_search_concurrency = _config.getint('redis_worker', 'search_concurrency')
+_retries = _config.getint('retry', 'retries')
+_backoff = _config.getfloat('retry', 'backoff')
+_max_backoff = _config.getfloat('retry', 'max_backoff')
+
+# Direct HTTP responses with these status codes are inconclusive, e.g. the
+# site may be blocking or throttling us, unless the site expects them.
+_inconclusive_status_codes = (401, 403, 407, 429)
+
+# Splash responds with these status codes when a render fails for reasons
+# that may not recur, e.g. a render timeout or an overloaded instance.
+_transient_splash_status_codes = (502, 503, 504)
 
 
 class ScrapeException(Exception):
@@ -94,13 +126,18 @@ def test_site(site_id, tracker_id, user_id, request_timeout=10):
         site.valid = False
 
     site.tested_at = datetime.utcnow()
+
+    # Clients replace the whole site, so send all of its fields. They are
+    # read before committing, while the site and its test results are still
+    # loaded.
+    site_dict = site.as_dict()
     db_session.commit()
 
     # Send redis notification
     msg = {
         'tracker_id': tracker_id,
         'status': 'tested',
-        'site': site.as_dict(),
+        'site': site_dict,
         'resource': None,
     }
     redis.publish('site', json.dumps(msg))
@@ -109,12 +146,35 @@ def test_site(site_id, tracker_id, user_id, request_timeout=10):
 @queueable(
     queue=scrape_queue,
     timeout=60,
-    jobdesc='Checking username.'
+    jobdesc='Checking username.',
+    retries=_retries,
+    retry_queue=scrape_retry_queue,
+    backoff=_backoff
 )
 def check_username(username, site_id, category_id, total,
-                   tracker_id, user_id, test=False):
+                   tracker_id, user_id, test=False, max_age=None):
     """
     Check if `username` exists on the specified site.
+
+    A cached result that is at most `max_age` seconds old is reused, if one
+    exists (see worker.result_cache). Test checks always render the site.
+
+    If another worker is already checking the same page, then this waits for
+    and reuses its result (see worker.singleflight), unless the result is
+    more than `max_age` seconds old. (If `max_age` is 0, then this never
+    waits.) At most half of the job's remaining time is spent waiting.
+
+    Requests are subject to the site's host limits (see worker.throttle). If
+    the host stays saturated for more than `[throttle] max_wait` seconds,
+    this job is requeued, to run once the host is expected to have capacity,
+    rather than holding the worker. (Test checks wait for up to half of the
+    job's remaining time instead, and then fail.)
+
+    If the check fails with a transient error (e.g. a Splash timeout or a
+    proxy failure), then the job is retried with exponential backoff on the
+    retry queue, using a different proxy and Splash endpoint where possible.
+    An error result is only saved once the retries are exhausted. (Test
+    checks are not retried.)
     """
 
     worker.start_job()
@@ -127,14 +187,277 @@ def check_username(username, site_id, category_id, total,
     # Get user
     user = db_session.query(User).get(user_id)
 
-    # Check site for username
-    splash_result = _splash_username_request(username,
-                                             site)
+    if not test:
+        cached_result = get_cached_result(redis, db_session, site,
+                                          username, max_age)
+
+        if cached_result is not None:
+            result = _clone_result(db_session=db_session,
+                                   redis=redis,
+                                   cached_result=cached_result,
+                                   site=site,
+                                   username=username,
+                                   tracker_id=tracker_id,
+                                   user=user)
+            worker.finish_job()
+            return result.id
+
+    flight = _flight(redis, site, username)
+
+    if not flight.acquire() and max_age != 0:
+        shared_result_id = flight.wait(max_age, _wait_budget())
+
+        if shared_result_id is not None:
+            shared_result = db_session.query(Result).get(shared_result_id)
+
+            if shared_result is not None:
+                result = _clone_result(db_session=db_session,
+                                       redis=redis,
+                                       cached_result=shared_result,
+                                       site=site,
+                                       username=username,
+                                       tracker_id=tracker_id,
+                                       user=user,
+                                       test=test)
+                worker.finish_job()
+                return result.id
+
+    throttle = HostThrottle(redis, site)
+
+    if not throttle.acquire(_wait_budget() if test else _throttle_max_wait):
+        flight.release()
+
+        if test:
+            raise ScrapeException('Timed out waiting for {}.'
+                                  .format(throttle.host))
+
+        job = check_username.enqueue(
+            username=username,
+            site_id=site_id,
+            category_id=category_id,
+            total=total,
+            tracker_id=tracker_id,
+            user_id=user_id,
+            test=test,
+            max_age=max_age,
+            jobdesc='Checking username (deferred: {} is busy).'
+                    .format(throttle.host),
+            delay=throttle.retry_after
+        )
+        current_job = worker.get_job()
+        current_job.meta['deferred_to'] = job.id
+        current_job.save()
+        worker.finish_job()
+        return None
+
+    try:
+        # Check site for username
+        job = worker.get_job()
+        avoid = None if test else job.meta.get('avoid')
+        started = time.time()
+
+        try:
+            splash_result = _username_request(username, site, avoid)
+        finally:
+            throttle.release()
+
+        latency = time.time() - started
+        _record_proxy(splash_result, latency)
+
+        if not test:
+            worker.record_latency(latency)
+
+        if not test and splash_result.get('transient', False):
+            job = worker.get_job()
+            job.meta['avoid'] = _avoid(job.meta.get('avoid'), splash_result)
+            job.save()
+
+            if worker.retry_job():
+                flight.release()
+                worker.finish_job()
+                return None
+
+        result = _save_result(db_session=db_session,
+                              redis=redis,
+                              splash_result=splash_result,
+                              site=site,
+                              username=username,
+                              tracker_id=tracker_id,
+                              user=user,
+                              test=test)
+    except:
+        flight.release()
+        raise
+
+    flight.complete(result)
+    worker.finish_job()
+    return result.id
+
+
+@queueable(
+    queue=scrape_queue,
+    timeout=600,
+    jobdesc='Searching username.'
+)
+def search_username(username, site_ids, category_id, total,
+                    tracker_id, user_id, test=False, max_age=None):
+    """
+    Check if `username` exists on each of the sites in `site_ids`.
+
+    Unlike check_username(), this checks all of the sites from one job:
+    requests are issued concurrently, with at most `search_concurrency`
+    requests in flight at once. Each result is saved and published as soon as
+    its request completes, on a thread of its own so that the requests carry
+    on meanwhile. A site whose result cannot be saved gets an error result;
+    the other sites are not affected.
+
+    Sites with a cached result that is at most `max_age` seconds old are not
+    requested at all: the cached result is copied instead. Likewise, pages
+    that another worker is already checking are not requested twice.
+
+    Requests that fail with a transient error are retried within this job,
+    with exponential backoff, up to `[retry] retries` times. The number of
+    requests made and their latencies are recorded in the job metadata.
+    """
+
+    worker.start_job(total=len(site_ids))
+    job = worker.get_job()
+    redis = worker.get_redis()
+    db_session = worker.get_session()
+    user = db_session.query(User).get(user_id)
+    sites = db_session.query(Site).filter(Site.id.in_(site_ids)).all()
+    completed = 0
+    latencies = []
+    flights = {}
+
+    # Results are saved on a thread of their own (see _username_requests()),
+    # which needs a session (and so sites and a user) of its own.
+    executor = ThreadPoolExecutor(max_workers=1)
+    save_session = worker.get_session()
+    save_user = save_session.query(User).get(user_id)
+    save_sites = {site.id: site for site in
+                  save_session.query(Site).filter(Site.id.in_(site_ids))}
+
+    def save_result(site, splash_result, shared_result_id=None):
+        nonlocal completed
+        flight = flights[site.id]
+        site = save_sites[site.id]
+
+        try:
+            if shared_result_id is not None:
+                shared_result = save_session.query(Result) \
+                                            .get(shared_result_id)
+
+                if shared_result is None:
+                    # The shared result is not saved yet (e.g. in the
+                    # batched result mode) or has been deleted since it was
+                    # shared.
+                    return False
+
+                _clone_result(db_session=save_session,
+                              redis=redis,
+                              cached_result=shared_result,
+                              site=site,
+                              username=username,
+                              tracker_id=tracker_id,
+                              user=save_user,
+                              test=test)
+            else:
+                latencies.extend(splash_result['latencies'])
+                result = _save_result(db_session=save_session,
+                                      redis=redis,
+                                      splash_result=splash_result,
+                                      site=site,
+                                      username=username,
+                                      tracker_id=tracker_id,
+                                      user=save_user,
+                                      test=test)
+                flight.complete(result)
+        except Exception as e:
+            # Only this site fails, not the whole search.
+            save_session.rollback()
+            flight.release()
+            _fail_sites(db_session=save_session,
+                        redis=redis,
+                        tracker_id=tracker_id,
+                        site_ids=[site.id],
+                        error='{}: {}'.format(type(e).__name__, e))
+
+        completed += 1
+        worker.update_job(completed, job)
+        return True
+
+    uncached_sites = []
+
+    for site in sites:
+        cached_result = None
+
+        if not test:
+            cached_result = get_cached_result(redis, db_session, site,
+                                              username, max_age)
+
+        if cached_result is None:
+            flights[site.id] = _flight(redis, site, username)
+            uncached_sites.append(site)
+            continue
+
+        _clone_result(db_session=db_session,
+                      redis=redis,
+                      cached_result=cached_result,
+                      site=site,
+                      username=username,
+                      tracker_id=tracker_id,
+                      user=user)
+
+        completed += 1
+        worker.update_job(completed)
+
+    try:
+        if len(uncached_sites) > 0:
+            worker.get_splash_client().run(_username_requests(
+                username,
+                uncached_sites,
+                _search_concurrency,
+                save_result,
+                executor,
+                flights,
+                max_age
+            ))
+    finally:
+        executor.shutdown()
+        save_session.close()
+
+        for flight in flights.values():
+            flight.release()
+
+    job = worker.get_job()
+    job.meta['attempts'] = len(latencies)
+    job.meta['latencies'] = latencies
+    job.save()
+    worker.finish_job()
+
+
+def _save_result(db_session, redis, splash_result, site, username,
+                 tracker_id, user, test=False):
+    """
+    Save a Splash username result and publish it (see
+    worker.result_sink.publish_result()).
+
+    The result is also added to the result cache.
+
+    In the "batched" result mode, the result is pushed onto the result sink
+    instead, and saved later (see worker.result_sink). Test results are
+    always saved right away.
+    """
+
+    batched = _result_mode == 'batched' and not test
+
     # Save image file
-    image_file = _save_image(db_session=db_session,
-                             scrape_result=splash_result,
-                             user_id=user_id,
-                             censor=site.censor_images)
+    image_file, thumb_file = _save_image(db_session=db_session,
+                                         scrape_result=splash_result,
+                                         user_id=user.id,
+                                         censor=site.censor_images,
+                                         batched=batched)
 
     # Save result to DB.
     result = Result(
@@ -143,76 +466,176 @@ def check_username(username, site_id, category_id, total,
         site_name=splash_result['site']['name'],
         site_url=splash_result['url'],
         status=splash_result['status'],
-        image_file_id=image_file.id,
+        image_file_id=co.member(image_file, 'id'),
+        thumb_file_id=co.member(thumb_file, 'id'),
         username=username,
         error=splash_result['error'],
-        user_id=user_id
+        user_id=user.id
     )
 
     if result.status == 'f':
         result.html = splash_result['html']
 
+    if batched:
+        _push_result(db_session=db_session,
+                     redis=redis,
+                     result=result,
+                     image_file=image_file,
+                     thumb_file=thumb_file,
+                     cache=True)
+        return result
+
+    saved_result = _add_result(db_session, result)
+
+    if not test and saved_result is result:
+        cache_result(redis, site, username, result)
+
+    publish_result(redis, saved_result)
+
+    return saved_result
+
+
+def _clone_result(db_session, redis, cached_result, site, username,
+                  tracker_id, user, test=False):
+    """
+    Save a copy of `cached_result` for `user` and publish it (see
+    worker.result_sink.publish_result()).
+
+    The copy's images are file records owned by `user` (see _copy_image()).
+    Identical files are deduplicated, so the copy may share a record with
+    the cached result or another of the user's results, and the content is
+    always shared through the content-addressed file store. A file is only
+    deleted once no result refers to it (see delete_expired_results()).
+
+    In the "batched" result mode, the copy is pushed onto the result sink
+    (see worker.result_sink).
+    """
+
+    batched = _result_mode == 'batched' and not test
+    result = Result(
+        tracker_id=tracker_id,
+        site_id=site.id,
+        site_name=site.name,
+        site_url=site.get_url(username),
+        status=cached_result.status.code,
+        image_file_id=None,
+        username=username,
+        error=cached_result.error,
+        html=cached_result.html,
+        user_id=user.id
+    )
+
+    image_file = _copy_image(db_session,
+                             cached_result.image_file,
+                             user.id,
+                             batched)
+    thumb_file = _copy_image(db_session,
+                             cached_result.thumb_file,
+                             user.id,
+                             batched)
+
+    if batched:
+        _push_result(db_session=db_session,
+                     redis=redis,
+                     result=result,
+                     image_file=image_file,
+                     thumb_file=thumb_file,
+                     cache=False)
+        return result
+
+    result.image_file = image_file
+    result.thumb_file = thumb_file
+    saved_result = _add_result(db_session, result)
+    publish_result(redis, saved_result)
+
+    return saved_result
+
+
+def _add_result(db_session, result):
+    """
+    Save `result` and return it.
+
+    If its tracker already has a result for the same page, e.g. because the
+    search timed out and an error result was saved in its place, then that
+    result is returned instead.
+    """
     db_session.add(result)
-    db_session.commit()
 
-    if not test:
-        # Notify clients of the result.
-        current = redis.incr(tracker_id)
-        result_dict = result.as_dict()
-        result_dict['current'] = current
-        # result_dict['image_file_url'] = image_file.url()
-        # result_dict['image_name'] = image_file.name
-        result_dict['total'] = total
-        redis.publish('result', json.dumps(result_dict))
-
-        # Subtract credit costs for non-error
-        # results
-        if result.status != 'e':
-            user.credits -= 1
-            redis.publish('user', json.dumps(user.as_dict()))
-            db_session.commit()
-
-        # If this username search is complete, then queue an archive job.
-        if current == total:
-            description = 'Archiving results ' \
-                          'for username "{}"'.format(username)
-            worker.archive.create_archive.enqueue(
-                username=username,
-                category_id=category_id,
-                tracker_id=tracker_id,
-                jobdesc=description,
-                timeout=_redis_worker['archive_timeout'],
-                user_id=user_id
-            )
+    try:
+        db_session.commit()
+    except IntegrityError:
+        db_session.rollback()
+        return (
+            db_session
+            .query(Result)
+            .filter(Result.tracker_id == result.tracker_id)
+            .filter(Result.site_url == result.site_url)
+            .one()
+        )
 
-    worker.finish_job()
-    return result.id
+    return result
+
+
+def _push_result(db_session, redis, result, image_file, thumb_file, cache):
+    """
+    Push an unsaved result onto the result sink, which saves and publishes
+    it (see worker.result_sink).
+
+    The result's ID is set, so that it can be shared right away.
+    """
+
+    result.id = next_result_id(db_session)
+    ResultSink(redis).push(result=result,
+                           image_file=image_file,
+                           thumb_file=thumb_file,
+                           cache=cache)
 
 
 def splash_request(target_url, headers={}, request_timeout=None,
                    wait=1, use_proxy=False):
     ''' Ask splash to render a page. '''
-    db_session = worker.get_session()
-    splash_url = get_config(db_session, 'splash_url', required=True).value
-    splash_user = get_config(db_session, 'splash_user',
-                             required=True).value
-    splash_pass = get_config(db_session, 'splash_password',
-                             required=True).value
-    splash_user_agent = get_config(db_session, 'splash_user_agent',
-                                   required=True).value
+    render_url, auth, payload = _splash_render_args(target_url,
+                                                    headers,
+                                                    request_timeout,
+                                                    wait,
+                                                    use_proxy)
+
+    splash_client = worker.get_splash_client()
+
+    return splash_client.render(render_url, payload, auth)
+
+
+def _splash_render_args(target_url, headers={}, request_timeout=None,
+                        wait=1, use_proxy=False, avoid=None):
+    """
+    Return the render URL, credentials and JSON payload for a Splash
+    request.
+
+    The `splash_url` setting may list several Splash endpoints separated by
+    commas, in which case one is picked at random. Endpoints and proxies
+    listed in `avoid` (see _avoid()) are not picked unless there is no
+    alternative.
+    """
+    avoid = co.first(avoid, lambda: _avoid(None))
+    configuration = worker.get_configuration()
+    splash_url = _splash_endpoint(configuration.get('splash_url',
+                                                    required=True),
+                                  avoid['splash_urls'])
+    splash_user = configuration.get('splash_user', required=True)
+    splash_pass = configuration.get('splash_password', required=True)
+    splash_user_agent = configuration.get('splash_user_agent',
+                                          required=True)
     proxy = None
 
     if request_timeout is None:
         try:
-            request_timeout = int(get_config(db_session,
-                                             'splash_request_timeout',
-                                             required=True).value)
+            request_timeout = int(configuration.get('splash_request_timeout',
+                                                    required=True))
         except:
             raise ScrapeException('Request timeout must be an integer: {}',
                                   request_timeout)
 
     auth = (splash_user, splash_pass)
-    splash_headers = {'content-type': 'application/json'}
 
     if 'user-agent' not in [header.lower() for
                             header in headers.keys()]:
@@ -235,46 +658,484 @@ def splash_request(target_url, headers={}, request_timeout=None,
 
     # Use proxy if enabled
     if use_proxy:
-        proxy = random_proxy(db_session)
+        proxy = worker.get_proxy_pool().choose(exclude=avoid['proxies'])
 
     if proxy:
         payload['proxy'] = proxy
 
-    splash_response = requests.post(
-        urljoin(splash_url, 'render.json'),
-        headers=splash_headers,
-        json=payload,
-        auth=auth
-    )
+    return urljoin(splash_url, 'render.json'), auth, payload
+
+
+def _splash_endpoint(splash_urls, exclude=()):
+    """
+    Pick one of the comma-separated Splash endpoints in `splash_urls`,
+    preferring endpoints that are not in `exclude`.
+    """
+    endpoints = [url.strip() for url in splash_urls.split(',') if url.strip()]
+    preferred = [url for url in endpoints if url not in exclude]
 
-    return splash_response
+    return random.choice(preferred or endpoints)
 
 
-def _splash_username_request(username, site):
+def _splash_username_request(username, site, avoid=None):
     """
     Ask splash to render a `username` search
     result for `site`.
+
+    A failed request is returned as an error result.
+    """
+    target_url = site.get_url(username)
+
+    if site.headers is None:
+        site.headers = {}
+
+    result = _username_result(site, target_url)
+
+    try:
+        render_url, auth, payload = _splash_render_args(
+            target_url,
+            site.headers,
+            wait=site.wait_time,
+            use_proxy=site.use_proxy,
+            avoid=avoid
+        )
+        _record_route(result, render_url, payload)
+
+        splash_client = worker.get_splash_client()
+        splash_response = splash_client.render(render_url, payload, auth)
+        result['code'] = splash_response.status_code
+        _check_username_result(result,
+                               site,
+                               splash_response,
+                               splash_response.json())
+    except Exception as e:
+        _error_result(result, e)
+
+    return result
+
+
+def _username_request(username, site, avoid=None):
+    """
+    Check `site` for `username` according to the site's probe mode.
+    """
+    if site.probe_mode == 'render':
+        return _splash_username_request(username, site, avoid)
+
+    result = _http_username_request(username, site, avoid)
+
+    if _needs_render(site, result):
+        return _splash_username_request(username, site, avoid)
+
+    return result
+
+
+async def _username_requests(username, sites, concurrency, callback,
+                             executor, flights, max_age=None):
+    """
+    Check each of `sites` for `username`, keeping at most `concurrency`
+    requests in flight.
+
+    `flights` maps site IDs to singleflight leases, which are taken when a
+    request slot is free, so that they do not expire while requests are
+    queued. For sites where another worker holds the lease, this waits for
+    that worker's result instead of making a request, unless the result is
+    more than `max_age` seconds old. (If `max_age` is 0, then this never
+    waits.)
+
+    `callback(site, result, shared_result_id)` is called on `executor` as
+    each check completes, where either `result` is the result of a request
+    made by this job or `shared_result_id` is the ID of another worker's
+    result. (Saving a result blocks, so it must not run on the event loop,
+    where it would hold up every other request.) If the callback returns
+    False (e.g. because the shared result is not saved yet), then the site
+    is requested after all.
+
+    Requests are subject to each site's host limits (see worker.throttle).
+    While a host is saturated, its requests wait without occupying any of
+    the `concurrency` slots.
+
+    Requests that fail with a transient error are retried with exponential
+    backoff, using a different proxy and Splash endpoint where possible. The
+    latency of each attempt is recorded in `result['latencies']`.
+
+    This must run on the Splash client's event loop (see
+    `SplashClient.run()`), which owns the worker's aiohttp session.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    splash_client = worker.get_splash_client()
+    http_session = splash_client.async_session()
+    redis = worker.get_redis()
+
+    async def request(site, share=True):
+        flight = flights[site.id]
+
+        if share:
+            async with semaphore:
+                flight.acquire()
+
+            if not flight.leader and max_age != 0:
+                shared_result_id = await flight.wait_async(
+                    max_age,
+                    _wait_budget()
+                )
+
+                if shared_result_id is not None:
+                    return site, None, shared_result_id
+
+        throttle = HostThrottle(redis, site)
+        avoid = None
+        latencies = []
+
+        while True:
+            async with semaphore:
+                delay = throttle.try_acquire()
+
+                if delay == 0:
+                    # The lease may have waited for a slot or a retry.
+                    flight.renew()
+                    started = time.time()
+
+                    try:
+                        result = await _async_username_request(
+                            splash_client,
+                            http_session,
+                            username,
+                            site,
+                            avoid
+                        )
+                    finally:
+                        throttle.release()
+
+                    latency = time.time() - started
+                    latencies.append(round(latency, 3))
+                    _record_proxy(result, latency)
+
+                    if not result.get('transient', False) or \
+                            len(latencies) > _retries:
+                        result['latencies'] = latencies
+                        return site, result, None
+
+                    avoid = _avoid(avoid, result)
+                    delay = _retry_delay(len(latencies))
+
+            await asyncio.sleep(delay)
+
+    loop = asyncio.get_event_loop()
+
+    async def check(site):
+        share = True
+
+        while True:
+            site, result, shared_result_id = await request(site, share)
+            saved = await loop.run_in_executor(executor,
+                                               callback,
+                                               site,
+                                               result,
+                                               shared_result_id)
+
+            if saved:
+                return
+
+            share = False
+
+    await asyncio.gather(*(check(site) for site in sites))
+
+
+async def _async_username_request(splash_client, http_session, username,
+                                  site, avoid=None):
+    """
+    Check `site` for `username` according to the site's probe mode, using
+    the aiohttp session `http_session`.
+    """
+    if site.probe_mode != 'render':
+        result = await _async_http_username_request(http_session,
+                                                    username,
+                                                    site,
+                                                    avoid)
+
+        if not _needs_render(site, result):
+            return result
+
+    return await _async_splash_username_request(splash_client,
+                                                http_session,
+                                                username,
+                                                site,
+                                                avoid)
+
+
+def _needs_render(site, http_result):
+    """
+    Return True if a direct HTTP result must be escalated to a Splash
+    render: the profile was found (and needs a screenshot) or the direct
+    request was inconclusive.
+    """
+    return site.probe_mode == 'http_then_render' and (
+        http_result['status'] == 'f' or http_result.get('inconclusive', False)
+    )
+
+
+def _http_request_args(site, avoid=None):
+    """
+    Return the headers and proxy URL for a direct HTTP request to `site`.
+
+    Proxies listed in `avoid` (see _avoid()) are not picked unless there is
+    no alternative.
+    """
+    headers = dict(site.headers or {})
+
+    if 'user-agent' not in [header.lower() for header in headers.keys()]:
+        configuration = worker.get_configuration()
+        headers['user-agent'] = configuration.get('splash_user_agent',
+                                                  required=True)
+
+    if site.use_proxy:
+        exclude = avoid['proxies'] if avoid else ()
+        proxy = worker.get_proxy_pool().choose(exclude=exclude)
+    else:
+        proxy = None
+
+    return headers, proxy
+
+
+def _http_username_request(username, site, avoid=None):
+    """
+    Check `site` for `username` with a direct HTTP request (no rendering).
+    """
+    target_url = site.get_url(username)
+    result = _username_result(site, target_url)
+
+    try:
+        headers, proxy = _http_request_args(site, avoid)
+        result['proxy'] = proxy
+        proxies = {'http': proxy, 'https': proxy} if proxy else None
+        response = worker.get_http_session().get(target_url,
+                                                 headers=headers,
+                                                 proxies=proxies,
+                                                 timeout=_probe_timeout)
+        _check_http_result(result, site, response.status_code, response.text)
+    except Exception as e:
+        _error_result(result, e)
+        result['inconclusive'] = True
+
+    return result
+
+
+async def _async_http_username_request(http_session, username, site,
+                                       avoid=None):
+    """
+    Check `site` for `username` with a direct HTTP request (no rendering)
+    using the aiohttp session `http_session`.
+    """
+    target_url = site.get_url(username)
+    result = _username_result(site, target_url)
+
+    try:
+        headers, proxy = _http_request_args(site, avoid)
+        result['proxy'] = proxy
+        timeout = aiohttp.ClientTimeout(total=_probe_timeout)
+
+        async with http_session.get(target_url,
+                                    headers=headers,
+                                    proxy=proxy,
+                                    timeout=timeout) as response:
+            html = await response.text(errors='replace')
+            _check_http_result(result, site, response.status, html)
+    except Exception as e:
+        _error_result(result, e)
+        result['inconclusive'] = True
+
+    return result
+
+
+def _check_http_result(result, site, status_code, html):
+    """
+    Update `result` with the status and HTML of a direct HTTP response.
+    """
+    result['code'] = status_code
+
+    if status_code != site.status_code and \
+            (status_code in _inconclusive_status_codes or status_code >= 500):
+        result['status'] = 'e'
+        result['error'] = 'Inconclusive HTTP status: {}'.format(status_code)
+        result['inconclusive'] = True
+        # The site may respond differently to another proxy or later on.
+        result['transient'] = True
+        return
+
+    try:
+        if _check_response(site, status_code, html):
+            result['status'] = 'f'
+            result['html'] = html
+        else:
+            result['status'] = 'n'
+    except Exception as e:
+        result['status'] = 'e'
+        result['error'] = str(e)
+
+
+async def _async_splash_username_request(splash_client, http_session,
+                                         username, site, avoid=None):
+    """
+    Ask splash to render a `username` search result for `site` using the
+    aiohttp session `http_session`.
+
+    Like _splash_username_request(), a failed request is returned as an
+    error result so that it does not abort the other requests in the search.
     """
     target_url = site.get_url(username)
 
     if site.headers is None:
         site.headers = {}
 
-    splash_response = splash_request(target_url,
-                                     site.headers,
-                                     wait=site.wait_time,
-                                     use_proxy=site.use_proxy)
+    result = _username_result(site, target_url)
+
+    try:
+        render_url, auth, payload = _splash_render_args(
+            target_url,
+            site.headers,
+            wait=site.wait_time,
+            use_proxy=site.use_proxy,
+            avoid=avoid
+        )
+        _record_route(result, render_url, payload)
+
+        splash_response = await splash_client.render_async(http_session,
+                                                           render_url,
+                                                           payload,
+                                                           auth)
+        splash_data = await splash_response.json(content_type=None)
+        result['code'] = splash_response.status
+        _check_username_result(result, site, splash_response, splash_data)
+    except Exception as e:
+        _error_result(result, e)
+
+    return result
+
+
+def _record_route(result, render_url, payload):
+    """
+    Record the Splash endpoint and proxy used for a render in `result`.
+    """
+    result['splash_url'] = render_url[:-len('render.json')]
+    result['proxy'] = payload.get('proxy')
+
+
+def _record_proxy(result, latency):
+    """
+    Record the outcome of a request in the proxy pool, if the request was
+    proxied. Transient errors count against the proxy.
+    """
+    if result.get('proxy') is None:
+        return
+
+    success = not result.get('transient', False)
+    worker.get_proxy_pool().record(result['proxy'], success, latency)
+
+
+def _avoid(avoid, result=None):
+    """
+    Return a copy of `avoid` (the Splash endpoints and proxies to avoid on
+    the next attempt at a request) with the ones used by `result` added.
+    """
+    avoid = {
+        'proxies': list(co.index(avoid, 'proxies') or []),
+        'splash_urls': list(co.index(avoid, 'splash_urls') or []),
+    }
+
+    if result is not None:
+        if result.get('proxy') is not None:
+            avoid['proxies'].append(result['proxy'])
+
+        if result.get('splash_url') is not None:
+            avoid['splash_urls'].append(result['splash_url'])
+
+    return avoid
+
+
+def _retry_delay(attempt):
+    """
+    Return the delay (in seconds) before retrying a request after `attempt`
+    attempts: exponential backoff with random jitter of +/-50%.
+    """
+    delay = min(_backoff * 2 ** (attempt - 1), _max_backoff)
+
+    return delay * random.uniform(0.5, 1.5)
+
+
+def _error_result(result, e):
+    """
+    Update `result` with the exception `e`, noting whether the error is
+    transient, i.e. whether the request is worth retrying.
+    """
+    result['status'] = 'e'
+    result['error'] = str(e)
+    result['transient'] = _is_transient(e)
 
-    result = {
-        'code': splash_response.status_code,
+
+def _is_transient(e):
+    """
+    Return True if the exception `e` may not recur on another attempt, e.g.
+    a timeout, a connection or proxy failure, or a Splash 502/503/504.
+    """
+    if isinstance(e, (requests.exceptions.ConnectionError,
+                      requests.exceptions.Timeout,
+                      aiohttp.ClientConnectionError,
+                      asyncio.TimeoutError)):
+        return True
+
+    if isinstance(e, requests.exceptions.HTTPError):
+        status_code = co.member(e.response, 'status_code')
+        return status_code in _transient_splash_status_codes
+
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in _transient_splash_status_codes
+
+    return False
+
+
+def _wait_budget():
+    """
+    Return the number of seconds that the current job may spend waiting
+    (for another worker's result or for a busy host): half of its remaining
+    time, so that it can still check the page afterwards.
+    """
+    remaining = worker.remaining_time()
+
+    return None if remaining is None else remaining / 2
+
+
+def _flight(redis, site, username):
+    """
+    Return a singleflight lease for checking `site` for `username`.
+
+    The lease is keyed by the target URL and the site definition, which
+    includes the render parameters.
+    """
+    key = '{} {}'.format(site.get_url(username), site_version(site))
+
+    return Flight(redis, key)
+
+
+def _username_result(site, target_url, status_code=None):
+    """
+    Return an empty result for a `site` username search.
+
+    Only the site's ID and name are included, so that its test results are
+    not loaded.
+    """
+    return {
+        'code': status_code,
         'error': None,
         'image': None,
-        'site': site.as_dict(),
+        'site': site.as_dict(('id', 'name')),
         'url': target_url,
     }
 
-    splash_data = splash_response.json()
 
+def _check_username_result(result, site, splash_response, splash_data):
+    """
+    Update `result` with the status, image and HTML of a Splash response.
+    """
     try:
         splash_response.raise_for_status()
 
@@ -286,10 +1147,7 @@ def _splash_username_request(username, site):
         result['image'] = splash_data['jpeg']
         result['html'] = splash_data['html']
     except Exception as e:
-        result['status'] = 'e'
-        result['error'] = str(e)
-
-    return result
+        _error_result(result, e)
 
 
 def _check_splash_response(site, splash_response, splash_data):
@@ -297,35 +1155,47 @@ def _check_splash_response(site, splash_response, splash_data):
     Parse response and test against site criteria to determine
     whether username exists. Used with requests response object.
     """
-    sel = parsel.Selector(text=splash_data['html'])
-    status_ok = True
-    match_ok = True
+    upstream_status = None
 
     if site.status_code is not None:
         upstream_status = splash_data['history'][0]['response']['status']
-        status_ok = site.status_code == upstream_status
-
-    if site.match_expr is not None:
-        if site.match_type == 'css':
-            match_ok = len(sel.css(site.match_expr)) > 0
-        elif site.match_type == 'text':
-            text_nodes = sel.css(':not(script):not(style)::text').extract()
-            text = ''
-            for text_node in text_nodes:
-                stripped = text_node.strip()
-                if stripped != '':
-                    text += stripped + ' '
-            match_ok = site.match_expr in text
-        elif site.match_type == 'xpath':
-            match_ok = len(sel.xpath(site.match_expr)) > 0
-        else:
-            raise ValueError('Unknown match_type: {}'.format(site.match_type))
 
-    return status_ok and match_ok
+    return _check_response(site, upstream_status, splash_data['html'])
+
+
+def _check_response(site, status_code, html):
+    """
+    Test the upstream `status_code` and `html` of a page against site
+    criteria to determine whether username exists.
+
+    The status code is checked first so that the HTML is only parsed when
+    it can affect the outcome.
+    """
+    if site.status_code is not None and site.status_code != status_code:
+        return False
+
+    matcher = get_matcher(site)
+
+    if matcher is None:
+        return True
+
+    return matcher.match(html)
+
+
+def _save_image(db_session, scrape_result, user_id, censor=False,
+                batched=False):
+    """
+    Save the image returned by Splash and its thumbnail to local files.
+
+    Returns a tuple of the image file and the thumbnail file. The image is
+    None if there is no image, i.e. the result came from a direct HTTP
+    request. The thumbnail is None unless the image is a screenshot.
 
+    If `batched`, then new files are stored but not added to the database:
+    the result writer does that (see worker.result_sink).
+    """
+    thumb_file = None
 
-def _save_image(db_session, scrape_result, user_id, censor=False):
-    """ Save the image returned by Splash to a local file. """
     if scrape_result['error'] is None and censor is True:
         # Get the generic censored image.
         image_file = (
@@ -334,21 +1204,28 @@ def _save_image(db_session, scrape_result, user_id, censor=False):
             .filter(File.name == _censored_image_name)
             .one()
         )
+    elif scrape_result['error'] is None and scrape_result['image'] is None:
+        image_file = None
     elif scrape_result['error'] is None:
-        image_name = '{}.jpg'.format(scrape_result['site']['name']
-                                     .replace(' ', ''))
-        content = base64.decodestring(scrape_result['image'].encode('utf8'))
-        image_file = File(name=image_name,
-                          mime='image/jpeg',
-                          content=content,
-                          user_id=user_id)
-        db_session.add(image_file)
-
-        try:
-            db_session.commit()
-        except:
-            db_session.rollback()
-            raise ScrapeException('Could not save image')
+        site_name = scrape_result['site']['name'].replace(' ', '')
+        content, thumb_content = process_screenshot(scrape_result['image'])
+        # Identical screenshots (e.g. of "not found" pages) share a file.
+        new_file = _new_file(db_session, batched)
+        image_file = new_file(name='{}.jpg'.format(site_name),
+                              mime='image/jpeg',
+                              content=content,
+                              user_id=user_id)
+        thumb_file = new_file(name='{}-thumb.jpg'.format(site_name),
+                              mime='image/jpeg',
+                              content=thumb_content,
+                              user_id=user_id)
+
+        if not batched:
+            try:
+                db_session.commit()
+            except:
+                db_session.rollback()
+                raise ScrapeException('Could not save image')
     else:
         # Get the generic error image.
         image_file = (
@@ -358,35 +1235,35 @@ def _save_image(db_session, scrape_result, user_id, censor=False):
             .one()
         )
 
-    return image_file
+    return image_file, thumb_file
 
 
-def random_proxy(db_session=None):
+def _copy_image(db_session, image_file, user_id, batched=False):
     """
-    Return a random proxy as URL string.
-    """
-    if db_session is None:
-        db_session = worker.get_session()
-
-    try:
-        proxy = db_session.query(Proxy).filter(Proxy.active == True) \
-            .order_by(func.random()).limit(1).one() # noqa
-    except NoResultFound:
-        return None
-
-    proxy_url = '{}://'.format(proxy.protocol)
+    Return a copy of `image_file` owned by `user_id`.
 
-    if proxy.username:
-        proxy_url += '{}:'.format(proxy.username)
+    Permanent images (e.g. the error image) are shared by all results, so
+    they are returned as is. If `batched`, then the copy is not added to the
+    database (see _save_image()).
+    """
+    if image_file is None or image_file.name in _permanent_images:
+        return image_file
 
-        if proxy.password:
-            proxy_url += proxy.password
+    return _new_file(db_session, batched)(name=image_file.name,
+                                          mime=image_file.mime,
+                                          stored_hash=image_file.hash,
+                                          user_id=user_id)
 
-        proxy_url += '@'
 
-    proxy_url += '{}:{}'.format(proxy.host, proxy.port)
+def _new_file(db_session, batched):
+    """
+    Return a function that makes files: File.get_or_create() for
+    `db_session`, or, if `batched`, the File constructor.
+    """
+    if batched:
+        return File
 
-    return proxy_url
+    return functools.partial(File.get_or_create, db_session)
 
 
 @queueable(
@@ -404,16 +1281,17 @@ def delete_expired_results(user_id):
     db_session = worker.get_session()
     tested_sites = set()
     expiry = datetime.utcnow() - timedelta(days=_days_to_keep_result)
+    # Files are loaded by ID, rather than joined to every expired result.
     expired_results = db_session.query(Result).filter(
-        Result.created_at < expiry).all()
+        Result.created_at < expiry).options(
+            selectinload(Result.image_file),
+            selectinload(Result.thumb_file)).all()
 
-    for result in expired_results:
-        # Don't delete permanent image files
-        if result.image_file.name in _permanent_images:
-            result.image_file = None
-            result.image_file_id = None
-            db_session.flush()
+    files = set()
 
+    for result in expired_results:
+        files.update(f for f in (result.image_file, result.thumb_file)
+                     if f is not None and f.name not in _permanent_images)
         db_session.delete(result)
 
         if result.site_id not in tested_sites:
@@ -421,5 +1299,145 @@ def delete_expired_results(user_id):
             test_site.enqueue(result.site_id, tracker_id, user_id)
             tested_sites.add(result.site_id)
 
+    db_session.flush()
+    paths = _delete_orphaned_files(db_session, files)
     db_session.commit()
+
+    for path in paths:
+        remove_unused_content(path)
+
     worker.finish_job()
+
+
+@queueable(
+    queue=archive_queue,
+    timeout=60,
+    jobdesc='Failing sites.'
+)
+def fail_sites(tracker_id, site_ids, error):
+    """
+    Save error results for those of `site_ids` that are still pending in a
+    search's tracker (see app.tracker), e.g. because their job failed, and
+    publish them, so that the search completes.
+    """
+    worker.start_job()
+    _fail_sites(db_session=worker.get_session(),
+                redis=worker.get_redis(),
+                tracker_id=tracker_id,
+                site_ids=site_ids,
+                error=error)
+    worker.finish_job()
+
+
+@queueable(
+    queue=archive_queue,
+    timeout=300,
+    jobdesc='Timing out searches.'
+)
+def time_out_searches():
+    """
+    Finish the searches whose trackers have not made progress for
+    `[tracker] stale_after` seconds: their pending sites get error results,
+    and then they are archived as usual.
+
+    A search stays stale, and is retried by later calls, until all of its
+    sites are recorded or its tracker expires.
+    """
+    worker.start_job()
+    db_session = worker.get_session()
+    redis = worker.get_redis()
+    tracker = Tracker(redis)
+
+    for tracker_id in tracker.stale():
+        _fail_sites(db_session=db_session,
+                    redis=redis,
+                    tracker_id=tracker_id,
+                    site_ids=tracker.time_out(tracker_id),
+                    error='Timed out.')
+
+    worker.finish_job()
+
+
+def _fail_sites(db_session, redis, tracker_id, site_ids, error):
+    """
+    Save error results for those of `site_ids` that are pending in a
+    tracker, and publish them.
+
+    Sites that already have a result (e.g. one that was saved after its
+    search timed out) keep it, and it is published instead.
+    """
+    search = Tracker(redis).get(tracker_id)
+
+    if search is None:
+        return
+
+    site_ids = [site_id for site_id in site_ids
+                if site_id in search['sites'] and
+                search['sites'][site_id] is None]
+
+    if len(site_ids) == 0:
+        return
+
+    username = search['username']
+    sites = db_session.query(Site).filter(Site.id.in_(site_ids)).all()
+    error_image = (
+        db_session
+        .query(File)
+        .filter(File.name == _error_image_name)
+        .one()
+    )
+
+    if len(sites) > 0:
+        statement = insert(Result.__table__) \
+            .values([{'tracker_id': tracker_id,
+                      'site_id': site.id,
+                      'site_name': site.name,
+                      'site_url': site.get_url(username),
+                      'status': 'e',
+                      'username': username,
+                      'error': error[:255],
+                      'user_id': search['user_id'],
+                      'created_at': datetime.utcnow(),
+                      'image_file_id': error_image.id}
+                     for site in sites]) \
+            .on_conflict_do_nothing(constraint='tracker_id_site_url')
+        db_session.execute(statement)
+        db_session.commit()
+
+    results = db_session.query(Result) \
+                        .filter(Result.tracker_id == tracker_id) \
+                        .filter(Result.site_id.in_(site_ids))
+
+    for result in results:
+        publish_result(redis, result)
+
+
+def _delete_orphaned_files(db_session, files):
+    """
+    Delete those of `files` that are no longer used by any result.
+
+    Files are shared by results with identical screenshots, and the stored
+    content is shared by files with the same hash, so returns the paths of
+    the stored content that is no longer used by any file.
+    """
+    paths = []
+
+    for file_ in files:
+        used = db_session.query(Result.id).filter(or_(
+            Result.image_file_id == file_.id,
+            Result.thumb_file_id == file_.id,
+        )).first()
+
+        if used is not None:
+            continue
+
+        db_session.delete(file_)
+        db_session.flush()
+        shared = db_session.query(File.id) \
+                           .filter(File.hash == file_.hash) \
+                           .first()
+
+        if shared is None and os.path.isfile(file_.path()):
+            paths.append(file_.path())
+
+    return paths
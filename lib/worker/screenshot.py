@@ -0,0 +1,63 @@
+'''
+Screenshot processing.
+
+Splash returns a base64 encoded JPEG for each render. Screenshots are
+decoded once, optionally recompressed, and shrunk into a thumbnail that
+clients can show in place of the full screenshot.
+'''
+
+import base64
+from io import BytesIO
+
+from PIL import Image
+
+import app.config
+
+_config = app.config.get_config()
+_jpeg_quality = _config.getint('images', 'jpeg_quality')
+_thumb_size = (_config.getint('images', 'thumb_width'),
+               _config.getint('images', 'thumb_height'))
+_thumb_quality = _config.getint('images', 'thumb_quality')
+
+
+def process_screenshot(image_b64):
+    '''
+    Decode a base64 encoded JPEG screenshot.
+
+    Returns a tuple of the screenshot's JPEG content and its thumbnail's
+    JPEG content. If ``[images] jpeg_quality`` is non-zero, then the
+    screenshot is recompressed at that quality, unless that would make it
+    larger.
+    '''
+
+    # b64decode() accepts an ASCII str, which avoids encoding a copy of the
+    # (large) screenshot first.
+    content = base64.b64decode(image_b64)
+    image = Image.open(BytesIO(content))
+
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    if _jpeg_quality > 0:
+        recompressed = _encode(image, _jpeg_quality)
+
+        if len(recompressed) < len(content):
+            content = recompressed
+    else:
+        # Let the JPEG decoder downscale while decoding: much faster than
+        # decoding the full image when only the thumbnail is needed.
+        image.draft('RGB', _thumb_size)
+
+    image.thumbnail(_thumb_size)
+    thumb_content = _encode(image, _thumb_quality)
+
+    return content, thumb_content
+
+
+def _encode(image, quality):
+    ''' Return the JPEG encoding of ``image`` at ``quality``. '''
+
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+
+    return output.getvalue()
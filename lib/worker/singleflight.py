@@ -0,0 +1,187 @@
+'''
+Coalesce identical site checks that are in flight at the same time.
+
+The first worker to check a page takes a lease on it in Redis and renders
+it. Other workers that want the same page wait for the leader to publish the
+ID of its result and then copy that result instead of rendering the page
+again. If the leader fails or takes too long, a waiting worker renders the
+page itself.
+
+Shared results are stored with the time when they were completed, so that
+waiting workers can refuse results that are older than they allow.
+'''
+
+import asyncio
+import hashlib
+import time
+
+import app.config
+from helper.functions import random_string
+
+KEY_PREFIX = 'singleflight'
+
+_config = app.config.get_config()
+_lease_ttl = _config.getint('singleflight', 'lease_ttl')
+_result_ttl = _config.getint('singleflight', 'result_ttl')
+_wait_timeout = _config.getfloat('singleflight', 'wait_timeout')
+_poll_interval = _config.getfloat('singleflight', 'poll_interval')
+
+# Delete the lease only if this worker still holds it.
+_release_script = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+# Extend the lease only if this worker still holds it.
+#
+# KEYS: lease
+# ARGV: token, TTL
+_renew_script = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+
+class Flight:
+    '''
+    A lease on checking one page.
+
+    Call ``acquire()`` first. If it returns True, this worker is the leader:
+    it must check the page and then call ``complete()`` (or ``release()`` if
+    there is no result to share). Otherwise call ``wait()`` (or
+    ``wait_async()``) to get the ID of the leader's result.
+    '''
+
+    def __init__(self, redis, key):
+        ''' Constructor. '''
+
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        self.redis = redis
+        self.leader = False
+        self._lease_key = '{}:lease:{}'.format(KEY_PREFIX, digest)
+        self._result_key = '{}:result:{}'.format(KEY_PREFIX, digest)
+        self._token = random_string(16)
+        self._release = redis.register_script(_release_script)
+        self._renew = redis.register_script(_renew_script)
+
+    def acquire(self):
+        ''' Try to become the leader. Return True if successful. '''
+
+        self.leader = bool(self.redis.set(self._lease_key,
+                                          self._token,
+                                          nx=True,
+                                          ex=_lease_ttl))
+
+        return self.leader
+
+    def complete(self, result):
+        '''
+        Share the leader's `result` with waiting workers and release the
+        lease.
+
+        Error results are not shared: waiting workers check the page
+        themselves instead.
+        '''
+
+        if self.leader and result.status != 'e':
+            self.redis.setex(self._result_key,
+                             _result_ttl,
+                             '{}:{}'.format(result.id, time.time()))
+
+        self.release()
+
+    def release(self):
+        ''' Release the lease without sharing a result. '''
+
+        if self.leader:
+            self._release(keys=[self._lease_key], args=[self._token])
+            self.leader = False
+
+    def renew(self):
+        '''
+        Extend the lease, e.g. before each attempt at a slow check. Returns
+        True if this worker still holds it.
+        '''
+
+        if self.leader:
+            self.leader = bool(self._renew(keys=[self._lease_key],
+                                           args=[self._token, _lease_ttl]))
+
+        return self.leader
+
+    def wait(self, max_age=None, timeout=None):
+        '''
+        Wait for the leader's result.
+
+        Returns the result ID, or None if this worker should check the page
+        itself: either the wait timed out, or the leader gave up and this
+        worker has taken over the lease.
+
+        Shared results more than `max_age` seconds old are not used. The
+        wait lasts at most `timeout` seconds, or ``[singleflight]
+        wait_timeout`` seconds if that is less.
+        '''
+
+        deadline = time.time() + _wait_time(timeout)
+
+        while time.time() < deadline:
+            result_id = self._poll(max_age)
+
+            if result_id is not None or self.leader:
+                return result_id
+
+            time.sleep(_poll_interval)
+
+        return None
+
+    async def wait_async(self, max_age=None, timeout=None):
+        ''' Like ``wait()``, but does not block the event loop. '''
+
+        deadline = time.time() + _wait_time(timeout)
+
+        while time.time() < deadline:
+            result_id = self._poll(max_age)
+
+            if result_id is not None or self.leader:
+                return result_id
+
+            await asyncio.sleep(_poll_interval)
+
+        return None
+
+    def _poll(self, max_age=None):
+        '''
+        Return the shared result ID if there is one that is at most
+        `max_age` seconds old. Otherwise, if the lease has been released,
+        try to take it over.
+        '''
+
+        shared = self.redis.get(self._result_key)
+
+        if shared is not None:
+            result_id, completed_at = shared.decode('ascii').split(':')
+
+            if max_age is None or \
+                    time.time() - float(completed_at) <= max_age:
+                return int(result_id)
+
+        if not self.redis.exists(self._lease_key):
+            self.acquire()
+
+        return None
+
+
+def _wait_time(timeout):
+    '''
+    Return how long to wait for a shared result: `timeout` seconds, but at
+    most ``[singleflight] wait_timeout``.
+    '''
+
+    if timeout is None:
+        return _wait_timeout
+
+    return max(0, min(timeout, _wait_timeout))
@@ -0,0 +1,146 @@
+''' A pooled HTTP client for the Splash render API. '''
+
+import asyncio
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SplashClient:
+    '''
+    A long-lived client for Splash that keeps connections alive between
+    renders.
+
+    The synchronous client keeps a pool of up to ``pool_size`` connections,
+    and so does the asynchronous session (see ``async_session()``), which
+    shares the same timeout and retry policy. Both are kept until
+    ``close()``.
+
+    Connect and read timeouts are kept separate from the render timeout: a
+    connection must be established within ``connect_timeout`` seconds, and
+    Splash must respond within the render timeout plus ``read_timeout_margin``
+    seconds. Requests that fail because a connection was refused or reset are
+    retried up to ``retries`` times.
+    '''
+
+    def __init__(self, pool_size=10, connect_timeout=5,
+                 read_timeout_margin=10, retries=2):
+        ''' Constructor. '''
+
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout_margin = read_timeout_margin
+        self.retries = retries
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session = requests.Session()
+        self._session.headers['content-type'] = 'application/json'
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._loop = None
+        self._async_session = None
+
+    def async_session(self):
+        '''
+        Return the aiohttp session, which keeps up to ``pool_size``
+        connections open to Splash.
+
+        The session is created on first use. It belongs to the client's event
+        loop, so it may only be used in coroutines run by ``run()``.
+        '''
+
+        if self._async_session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._async_session = aiohttp.ClientSession(connector=connector)
+
+        return self._async_session
+
+    def close(self):
+        ''' Close the sessions and the event loop. '''
+
+        self._session.close()
+
+        if self._loop is None:
+            return
+
+        if self._async_session is not None:
+            self._loop.run_until_complete(self._async_session.close())
+            self._async_session = None
+
+        self._loop.close()
+        self._loop = None
+
+    def run(self, coroutine):
+        '''
+        Run `coroutine` on the client's event loop and return its result.
+
+        Unlike ``asyncio.run()``, the loop (and so the asynchronous session)
+        is kept for the next coroutine. Tasks that the coroutine leaves
+        pending are cancelled.
+        '''
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+
+        try:
+            return self._loop.run_until_complete(coroutine)
+        finally:
+            tasks = asyncio.all_tasks(self._loop)
+
+            for task in tasks:
+                task.cancel()
+
+            self._loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True)
+            )
+
+    def render(self, render_url, payload, auth):
+        ''' Post a render request and return the ``requests`` response. '''
+
+        timeout = (self.connect_timeout, self._read_timeout(payload))
+        attempt = 0
+
+        while True:
+            try:
+                return self._session.post(render_url,
+                                          json=payload,
+                                          auth=auth,
+                                          timeout=timeout)
+            except requests.exceptions.ConnectionError:
+                attempt += 1
+
+                if attempt > self.retries:
+                    raise
+
+    async def render_async(self, http_session, render_url, payload, auth):
+        '''
+        Post a render request using ``http_session`` and return the aiohttp
+        response. The response body has already been read.
+        '''
+
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=self.connect_timeout,
+                                        sock_read=self._read_timeout(payload))
+        attempt = 0
+
+        while True:
+            try:
+                async with http_session.post(render_url,
+                                             json=payload,
+                                             auth=aiohttp.BasicAuth(*auth),
+                                             timeout=timeout) as response:
+                    await response.read()
+                    return response
+            except aiohttp.ServerTimeoutError:
+                raise
+            except aiohttp.ClientConnectionError:
+                attempt += 1
+
+                if attempt > self.retries:
+                    raise
+
+    def _read_timeout(self, payload):
+        ''' Return the read timeout for a render ``payload``. '''
+
+        return payload.get('timeout', 30) + self.read_timeout_margin
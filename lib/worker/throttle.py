@@ -0,0 +1,158 @@
+'''
+Limit the rate and concurrency of requests to each target host across all
+workers.
+
+Each host has a token bucket (the rate limit) and a set of slots (the
+concurrency limit) in Redis. A worker must take a token and a slot before
+requesting a page from the host, and it must give the slot back afterwards.
+Slots expire in case a worker dies while holding one.
+'''
+
+import time
+from urllib.parse import urlparse
+
+import app.config
+import coalesce as co
+from helper.functions import random_string
+
+KEY_PREFIX = 'throttle'
+
+_config = app.config.get_config()
+_default_rate_limit = _config.getint('throttle', 'default_rate_limit')
+_default_max_concurrency = _config.getint('throttle',
+                                          'default_max_concurrency')
+_burst = _config.getint('throttle', 'burst')
+_slot_ttl = _config.getint('throttle', 'slot_ttl')
+_poll_interval = _config.getfloat('throttle', 'poll_interval')
+
+# Take a token and a slot atomically. Returns the number of seconds to wait
+# before trying again, or 0 if successful. (The result is a string because
+# Redis truncates Lua numbers to integers.)
+#
+# KEYS: bucket, slots
+# ARGV: now, rate (tokens per second), burst, max concurrency, slot ID,
+#       slot TTL, poll interval
+_acquire_script = '''
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local max_concurrency = tonumber(ARGV[4])
+local slot_ttl = tonumber(ARGV[6])
+
+redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+
+if max_concurrency > 0 and
+        redis.call('zcard', KEYS[2]) >= max_concurrency then
+    return ARGV[7]
+end
+
+if rate > 0 then
+    local tokens = burst
+    local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+
+    if bucket[1] then
+        local elapsed = math.max(0, now - tonumber(bucket[2]))
+        tokens = math.min(burst, tonumber(bucket[1]) + elapsed * rate)
+    end
+
+    if tokens < 1 then
+        return tostring((1 - tokens) / rate)
+    end
+
+    redis.call('hmset', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+    redis.call('expire', KEYS[1], math.ceil(burst / rate) + 1)
+end
+
+redis.call('zadd', KEYS[2], now + slot_ttl, ARGV[5])
+redis.call('expire', KEYS[2], slot_ttl)
+return '0'
+'''
+
+
+class HostThrottle:
+    '''
+    The rate and concurrency limits for requesting a site's pages.
+
+    The limits are shared by all sites on the same host. Each site may set
+    its own limits (``Site.rate_limit`` in requests per minute and
+    ``Site.max_concurrency``); otherwise the defaults in the ``[throttle]``
+    configuration section apply. A limit of 0 means unlimited.
+    '''
+
+    def __init__(self, redis, site):
+        ''' Constructor. '''
+
+        self.redis = redis
+        self.host = get_host(site)
+        self.rate_limit = co.first(site.rate_limit, _default_rate_limit)
+        self.max_concurrency = co.first(site.max_concurrency,
+                                        _default_max_concurrency)
+        self._bucket_key = '{}:bucket:{}'.format(KEY_PREFIX, self.host)
+        self._slots_key = '{}:slots:{}'.format(KEY_PREFIX, self.host)
+        self._slot_id = None
+        self._acquire = redis.register_script(_acquire_script)
+        self.retry_after = 0
+
+    def try_acquire(self):
+        '''
+        Try to take a token and a slot without waiting.
+
+        Returns 0 if successful, or else the number of seconds to wait before
+        trying again.
+        '''
+
+        slot_id = random_string(16)
+        delay = float(self._acquire(
+            keys=[self._bucket_key, self._slots_key],
+            args=[time.time(),
+                  self.rate_limit / 60,
+                  _burst,
+                  self.max_concurrency,
+                  slot_id,
+                  _slot_ttl,
+                  _poll_interval]
+        ))
+
+        if delay == 0:
+            self._slot_id = slot_id
+
+        return delay
+
+    def acquire(self, timeout):
+        '''
+        Take a token and a slot, waiting up to `timeout` seconds (or as long
+        as necessary if `timeout` is None).
+
+        Returns True if successful. Otherwise, ``retry_after`` is the number
+        of seconds to wait before trying again.
+        '''
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            delay = self.try_acquire()
+
+            self.retry_after = delay
+
+            if delay == 0:
+                return True
+
+            if timeout is not None and time.time() + delay > deadline:
+                return False
+
+            time.sleep(delay)
+
+    def release(self):
+        ''' Give back the slot. '''
+
+        if self._slot_id is not None:
+            self.redis.zrem(self._slots_key, self._slot_id)
+            self._slot_id = None
+
+
+def get_host(site):
+    ''' Return the lower case host name of `site`. '''
+
+    return urlparse(site.get_url('')).hostname or ''
+
@@ -0,0 +1,7 @@
+-- Archives of a user, optionally for a username (ArchiveView.index).
+CREATE INDEX ix_archive_user_id_date ON archive (user_id, date, id);
+CREATE INDEX ix_archive_user_id_username_date
+    ON archive (user_id, username, date, id);
+
+-- Expired archives (delete_expired_archives).
+CREATE INDEX ix_archive_created_at ON archive (created_at);
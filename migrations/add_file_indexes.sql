@@ -0,0 +1,2 @@
+-- Files that share stored content (File.get_or_create, FileView.delete).
+CREATE INDEX ix_file_hash ON file (hash);
@@ -0,0 +1,6 @@
+ALTER TABLE proxy ADD COLUMN latency DOUBLE PRECISION;
+ALTER TABLE proxy ADD COLUMN failure_rate DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE proxy ADD COLUMN consecutive_failures INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE proxy ADD COLUMN consecutive_successes INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE proxy ADD COLUMN checked_at TIMESTAMP WITHOUT TIME ZONE;
+ALTER TABLE proxy ADD COLUMN auto_disabled BOOLEAN NOT NULL DEFAULT FALSE;
@@ -0,0 +1,17 @@
+CREATE TABLE result_html (
+    result_id INTEGER NOT NULL,
+    encoding VARCHAR(255) NOT NULL,
+    content BYTEA NOT NULL,
+    PRIMARY KEY (result_id),
+    CONSTRAINT fk_result_html_result FOREIGN KEY (result_id)
+        REFERENCES result (id) ON DELETE CASCADE
+);
+
+-- Existing HTML is copied uncompressed. Compress it afterwards with:
+--   python3 bin/database.py compress
+INSERT INTO result_html (result_id, encoding, content)
+    SELECT id, 'identity', convert_to(html, 'UTF8')
+    FROM result
+    WHERE html IS NOT NULL;
+
+ALTER TABLE result DROP COLUMN html;
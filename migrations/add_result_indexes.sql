@@ -0,0 +1,16 @@
+-- Results of a user in the order they were created (ResultView.index).
+CREATE INDEX ix_result_user_id_created_at
+    ON result (user_id, created_at, id);
+
+-- Latest result of each site for a username (ResultView.get_by_username).
+CREATE INDEX ix_result_username_user_id_site_name
+    ON result (username, user_id, site_name, created_at DESC);
+
+-- Expired results (delete_expired_results).
+CREATE INDEX ix_result_created_at ON result (created_at);
+
+-- Results that use a file, which most results do not.
+CREATE INDEX ix_result_image_file_id ON result (image_file_id)
+    WHERE image_file_id IS NOT NULL;
+CREATE INDEX ix_result_thumb_file_id ON result (thumb_file_id)
+    WHERE thumb_file_id IS NOT NULL;
@@ -0,0 +1,3 @@
+ALTER TABLE result ADD COLUMN thumb_file_id INTEGER;
+ALTER TABLE result ADD CONSTRAINT fk_thumb_file
+    FOREIGN KEY (thumb_file_id) REFERENCES file (id);
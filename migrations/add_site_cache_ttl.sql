@@ -0,0 +1 @@
+ALTER TABLE site ADD COLUMN cache_ttl INTEGER;
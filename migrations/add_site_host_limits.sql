@@ -0,0 +1,2 @@
+ALTER TABLE site ADD COLUMN rate_limit INTEGER;
+ALTER TABLE site ADD COLUMN max_concurrency INTEGER;
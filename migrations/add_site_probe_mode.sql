@@ -0,0 +1,2 @@
+CREATE TYPE probe_mode AS ENUM ('render', 'http', 'http_then_render');
+ALTER TABLE site ADD COLUMN probe_mode probe_mode NOT NULL DEFAULT 'render';
@@ -194,13 +194,21 @@ def _get_all_results(endpoint_url, key, headers, interval=5):
     :param key (str): json result key.
     :param key (dict): request headers.
     :param interval (int): request interval (seconds) (default:5).
+
+    Endpoints that return a ``next_after`` cursor are followed from cursor
+    to cursor, which is faster than paging for large result sets.
     """
     page = 1
     pages = 1
+    after = None
     results = []
 
     while page <= pages:
-        params = {'rpp': 100, 'page': page}
+        if after is None:
+            params = {'rpp': 100, 'page': page}
+        else:
+            params = {'rpp': 100, 'after': after, 'count': 'none'}
+
         response = requests.get(endpoint_url,
                                 headers=headers,
                                 params=params,
@@ -209,6 +217,21 @@ def _get_all_results(endpoint_url, key, headers, interval=5):
         _validate_response(response)
 
         data = response.json()
+
+        try:
+            results += data[key]
+        except KeyError:
+            raise ProfilerError('Json result does not contain "{}"'.format(key))
+
+        if 'next_after' in data:
+            after = data['next_after']
+
+            if after is None:
+                break
+
+            time.sleep(interval)
+            continue
+
         try:
             total = int(data['total_count'])
         except KeyError:
@@ -219,11 +242,6 @@ def _get_all_results(endpoint_url, key, headers, interval=5):
         if total > 0:
             pages = math.ceil(total / 100)
 
-        try:
-            results += data[key]
-        except KeyError:
-            raise ProfilerError('Json result does not contain "{}"'.format(key))
-
         page += 1
         time.sleep(interval)
 
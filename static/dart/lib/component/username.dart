@@ -198,6 +198,7 @@ class UsernameComponent implements ShadowRootAware {
         Map urlArgs = {
             'page': page,
             'rpp': 100,
+            'fields': 'id,name,cost',
         };
         int totalCount = 0;
         this.api
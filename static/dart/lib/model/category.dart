@@ -18,10 +18,13 @@ class Category {
     Category.fromJson(Map json) {
         this.id = json['id'];
         this.name = json['name'];
-        this.sites = new List.generate(
-            json['sites'].length,
-            (index) => new Site.fromJson(json['sites'][index])
-        );
+        // Sites are left out of responses that do not ask for them.
+        if (json['sites'] != null) {
+            this.sites = new List.generate(
+                json['sites'].length,
+                (index) => new Site.fromJson(json['sites'][index])
+            );
+        }
         this.cost = json['cost'];
     }
 }
@@ -7,6 +7,8 @@ class Result {
     String siteUrl;
     int imageFileId;
     String imageFileUrl;
+    int thumbFileId;
+    String thumbFileUrl;
     int number;
     String status;
     int total;
@@ -35,6 +37,8 @@ class Result {
         this.siteUrl = json['site_url'];
         this.imageFileId = json['image_file_id'];
         this.imageFileUrl = json['image_file_url'];
+        this.thumbFileId = json['thumb_file_id'];
+        this.thumbFileUrl = json['thumb_file_url'];
         this.number = json['number'];
         this.total = json['total'];
         this.error = json['error'];